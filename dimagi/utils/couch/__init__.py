@@ -1,10 +1,16 @@
 from __future__ import absolute_import
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import hashlib
+import time
 from datetime import timedelta
 from dimagi.utils.couch.cache.cache_core import get_redis_client
 from dimagi.ext.couchdbkit import DateTimeProperty, DocumentSchema
 from couchdbkit.exceptions import ResourceConflict
 from redis.exceptions import RedisError, LockError
+from dimagi.utils.locks import keep_alive, stop_keep_alive
+from dimagi.utils.locks.backends import get_lock_backend
+from dimagi.utils.locks.local import LOCAL_LOCKS
+from dimagi.utils.locks.metrics import record_acquire, record_release
 import json
 
 LOCK_EXPIRATION = timedelta(hours=1)
@@ -71,10 +77,65 @@ class ReleaseOnError(object):
             release_lock(self.lock, degrade_gracefully=True)
 
 
+class BatchLockManager(object):
+    """
+    The result of get_locked_objs.
+
+    objs - the locked objects, in the order of the ids asked for
+    locks - the acquired locks, {id: lock}
+    not_locked - ids whose lock was held by someone else
+    missing - ids that were locked but had no object; their locks are
+      already released
+
+    As a context manager it returns itself and releases every lock at once
+    when done, even if an error is thrown in the body.
+
+    >>> with Patient.get_locked_objs(patient_ids) as batch:
+    ...     for patient in batch.objs:
+    ...         # do stuff...
+    ...     retry_later(batch.not_locked)
+    """
+    def __init__(self, objs, locks, not_locked, missing=()):
+        self.objs = objs
+        self.locks = locks
+        self.not_locked = list(not_locked)
+        self.missing = list(missing)
+
+    def release(self, degrade_gracefully=True):
+        locks, self.locks = self.locks.values(), {}
+        if locks:
+            for lock in locks:
+                stop_keep_alive(lock)
+            try:
+                get_lock_backend().release_locks(locks)
+            except RedisError:
+                if not degrade_gracefully:
+                    raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+def _acquire(lock, **kwargs):
+    """
+    Acquire a lock, recording how long it took and whether it was contended
+    """
+    start = time.time()
+    acquired = lock.acquire(blocking=False)
+    contended = not acquired
+    if contended and kwargs.get('blocking', True):
+        acquired = lock.acquire(**kwargs)
+    record_acquire(lock, acquired, time.time() - start, contended)
+    return acquired
+
+
 def acquire_lock(lock, degrade_gracefully, **kwargs):
     acquired = False
     try:
-        acquired = lock.acquire(**kwargs)
+        acquired = _acquire(lock, **kwargs)
     except RedisError:
         if degrade_gracefully:
             lock = None
@@ -87,9 +148,12 @@ def acquire_lock(lock, degrade_gracefully, **kwargs):
 
 def release_lock(lock, degrade_gracefully):
     if lock:
+        stop_keep_alive(lock)
         try:
             lock.release()
         except RedisError as e:
+            if isinstance(e, LockError):
+                record_release(lock, expired=True)
             if not degrade_gracefully:
                 raise
             elif isinstance(e, LockError):
@@ -100,9 +164,28 @@ def release_lock(lock, degrade_gracefully):
                     #    'redis lock. This may mean the timeout is too small.')
                 except:
                     pass
+        else:
+            record_release(lock, expired=False)
+
+
+def renew_lock(lock, timeout, on_lock_lost=None):
+    """
+    Keep extending an acquired lock (if any) to timeout seconds until it's
+    released, see dimagi.utils.locks.watchdog
+    """
+    if lock:
+        keep_alive(lock, timeout, on_lock_lost)
+    return lock
 
 
 class RedisLockableMixIn(object):
+    # If True, get_locked_obj without _id locks on a key derived from the lookup
+    # args instead of the class lock, so lookups and creates of unrelated objects
+    # don't wait for each other. Only safe if equal lookup args are the only way
+    # to find (or create) the same object; otherwise override _redis_lookup_lock_key
+    # to normalize the args.
+    lock_by_lookup_args = False
+
     @classmethod
     def _redis_obj_lock_key(cls, obj_id):
         """
@@ -119,6 +202,15 @@ class RedisLockableMixIn(object):
         """
         return "redis-class-lock-%s" % cls.__name__
 
+    @classmethod
+    def _redis_lookup_lock_key(cls, *args, **kwargs):
+        """
+        This method should return a string representing the name of the key
+        that will be used to lock lookups (and creates) with the given arguments.
+        """
+        lookup = json.dumps([args, kwargs], sort_keys=True, default=unicode)
+        return "redis-lookup-lock-%s-%s" % (cls.__name__, hashlib.sha1(lookup.encode('utf-8')).hexdigest())
+
     @classmethod
     def get_obj_id(cls, obj):
         """
@@ -150,6 +242,14 @@ class RedisLockableMixIn(object):
         """
         raise NotImplementedError("Please implement this method.")
 
+    @classmethod
+    def get_objs_by_ids(cls, ids):
+        """
+        This method should return the instances of this class matching the
+        passed ids, in any order, leaving out the ones that are not found.
+        """
+        return [obj for obj in map(cls.get_obj_by_id, ids) if obj]
+
     @classmethod
     def get_latest_obj(cls, obj):
         obj_id = cls.get_obj_id(obj)
@@ -166,14 +266,17 @@ class RedisLockableMixIn(object):
 
     @classmethod
     def get_redis_lock(cls, key, timeout_seconds):
-        client = get_redis_client()
-        lock = client.lock(key, timeout=timeout_seconds)
-        return lock
+        return get_lock_backend().lock(key, timeout_seconds)
 
     @classmethod
     def get_class_lock(cls, timeout_seconds=120):
         return cls.get_redis_lock(cls._redis_class_lock_key(), timeout_seconds)
 
+    @classmethod
+    def get_lookup_lock(cls, *args, **kwargs):
+        timeout_seconds = kwargs.pop('timeout_seconds', 120)
+        return cls.get_redis_lock(cls._redis_lookup_lock_key(*args, **kwargs), timeout_seconds)
+
     @classmethod
     def get_locked_obj(cls, *args, **kwargs):
         """
@@ -189,18 +292,29 @@ class RedisLockableMixIn(object):
         The object will be created calling create_obj and passing it all of the
         args. If create is False or is not set, and if the object doesn't exist,
         (None, None) is returned.
+
+        Pass in renew=True to keep extending the locks to timeout_seconds for as
+        long as they are held, so a short timeout_seconds works for long
+        processing; on_lock_lost(lock, error) is called if a renewal fails.
         """
         create = kwargs.pop("create", False)
         _id = kwargs.get("_id", None)
         degrade_gracefully = kwargs.pop('degrade_gracefully', False)
         timeout_seconds = kwargs.pop('timeout_seconds', 120)
+        renew = kwargs.pop('renew', False)
+        on_lock_lost = kwargs.pop('on_lock_lost', None)
 
         if _id:
             lock = cls.get_obj_lock_by_id(_id, timeout_seconds=timeout_seconds)
+        elif cls.lock_by_lookup_args:
+            lookup_kwargs = dict((k, v) for k, v in kwargs.items() if k != '_id')
+            lock = cls.get_lookup_lock(*args, timeout_seconds=timeout_seconds, **lookup_kwargs)
         else:
             lock = cls.get_class_lock(timeout_seconds=timeout_seconds)
 
         lock = acquire_lock(lock, degrade_gracefully, blocking=True)
+        if renew:
+            renew_lock(lock, timeout_seconds, on_lock_lost)
         try:
             if _id:
                 obj = cls.get_obj_by_id(_id)
@@ -219,14 +333,53 @@ class RedisLockableMixIn(object):
             if _id:
                 return LockManager(obj, lock)
             else:
-                obj_lock = cls.get_obj_lock(obj)
+                obj_lock = cls.get_obj_lock(obj, timeout_seconds=timeout_seconds)
                 obj_lock = acquire_lock(obj_lock, degrade_gracefully)
+                if renew:
+                    renew_lock(obj_lock, timeout_seconds, on_lock_lost)
                 # Refresh the object in case another thread has updated it
                 obj = cls.get_latest_obj(obj)
                 release_lock(lock, degrade_gracefully)
                 return LockManager(obj, obj_lock)
 
 
+    @classmethod
+    def get_locked_objs(cls, ids, timeout_seconds=120, degrade_gracefully=False):
+        """
+        Lock many objects by id without blocking: try every object lock in one
+        pipelined round trip, then fetch the objects that could be locked with
+        get_objs_by_ids. Returns a BatchLockManager, which reports the ids that
+        could not be locked because someone else holds them.
+
+        If redis is down and degrade_gracefully is True, every object is
+        returned without locks.
+        """
+        ids = list(OrderedDict.fromkeys(ids))
+        locks = dict((_id, cls.get_obj_lock_by_id(_id, timeout_seconds=timeout_seconds)) for _id in ids)
+        try:
+            acquired = set(map(id, get_lock_backend().try_acquire_locks([locks[_id] for _id in ids])))
+        except RedisError:
+            if not degrade_gracefully:
+                raise
+            locked_ids, locks, not_locked = ids, {}, []
+        else:
+            locked_ids = [_id for _id in ids if id(locks[_id]) in acquired]
+            not_locked = [_id for _id in ids if id(locks[_id]) not in acquired]
+            locks = dict((_id, locks[_id]) for _id in locked_ids)
+
+        batch = BatchLockManager([], locks, not_locked)
+        try:
+            objs = dict((cls.get_obj_id(obj), obj) for obj in cls.get_objs_by_ids(locked_ids))
+        except:
+            batch.release(degrade_gracefully)
+            raise
+        batch.objs = [objs[_id] for _id in locked_ids if _id in objs]
+        batch.missing = [_id for _id in locked_ids if _id not in objs]
+        missing_locks = dict((_id, locks.pop(_id)) for _id in batch.missing if _id in locks)
+        BatchLockManager([], missing_locks, []).release(degrade_gracefully)
+        return batch
+
+
 class CouchDocLockableMixIn(RedisLockableMixIn):
     """
     A mixin to prevent document update conflicts and race conditions.
@@ -297,6 +450,11 @@ class CouchDocLockableMixIn(RedisLockableMixIn):
     def get_obj_by_id(cls, _id):
         return cls.get(_id)
 
+    @classmethod
+    def get_objs_by_ids(cls, ids):
+        from dimagi.utils.couch.bulk import wrapped_docs
+        return list(wrapped_docs(cls, ids))
+
     @classmethod
     def create_obj(cls, *args, **kwargs):
         """
@@ -316,34 +474,67 @@ class CriticalSection(object):
         with CriticalSection(["my-update-key"]):
             ...do processing
 
-    keys - a list of strings representing the keys of the locks to acquire; when
-      using multiple keys, make sure to consider key order to prevent deadlock
-      and be mindful of the duration of the task(s) using these keys in relation
-      to the lock timeout
+    keys - a list of strings representing the keys of the locks to acquire; all
+      keys are acquired at once (see dimagi.utils.locks.MultiLock), so their
+      order doesn't matter, but be mindful of the duration of the task(s) using
+      these keys in relation to the lock timeout. Sections may be nested on
+      the same keys within a thread
     fail_hard - if True, exceptions are raised when locks can't be acquired
     timeout - the number of seconds before each lock times out
+    blocking_timeout - the number of seconds to wait for the locks, None to
+      wait for ever. When it runs out the section runs without the locks,
+      or raises if fail_hard
+    renew - if True, the locks are extended to timeout seconds for as long as
+      the section runs, so a short timeout frees the keys soon after a worker
+      dies without limiting how long the section may take
+    on_lock_lost - called as on_lock_lost(lock, error) if a renewal fails
     """
-    def __init__(self, keys, fail_hard=False, timeout=60):
+    def __init__(self, keys, fail_hard=False, timeout=60, blocking_timeout=None,
+                 renew=False, on_lock_lost=None):
         self.keys = keys
         self.locks = []
         self.fail_hard = fail_hard
         self.timeout = timeout
+        self.blocking_timeout = blocking_timeout
+        self.renew = renew
+        self.on_lock_lost = on_lock_lost
 
     def __enter__(self):
+        self.locks = []
+        # keys are locked in the process first, so threads of this process
+        # wait for each other locally and nested sections on a key held by
+        # this thread don't go to redis (see dimagi.utils.locks.local)
+        start = time.time()
+        # a renewed lock doesn't time out, others only expire with their timeout
+        lease = None if self.renew else self.timeout
+        self.local_keys = LOCAL_LOCKS.acquire(self.keys, timeout=self.blocking_timeout, lease=lease)
+        if self.local_keys is None:
+            if self.fail_hard:
+                raise RedisError("Unable to acquire lock")
+            return
+        if not self.local_keys:
+            return
+        blocking_timeout = self.blocking_timeout
+        if blocking_timeout is not None:
+            blocking_timeout = max(0, blocking_timeout - (time.time() - start))
         try:
-            client = get_redis_client()
-            for key in self.keys:
-                lock = client.lock(key, timeout=self.timeout)
-                self.locks.append(lock)
-            for lock in self.locks:
-                lock.acquire(blocking=True)
+            lock = get_lock_backend().multi_lock(self.local_keys, self.timeout)
+            if not _acquire(lock, blocking=True, blocking_timeout=blocking_timeout):
+                raise RedisError("Unable to acquire lock")
+            self.locks.append(lock)
+            if self.renew:
+                renew_lock(lock, self.timeout, self.on_lock_lost)
         except Exception:
             if self.fail_hard:
+                LOCAL_LOCKS.release(self.keys)
+                self.local_keys = None
                 raise
 
     def __exit__(self, exc_type, exc_value, traceback):
         for lock in self.locks:
             release_lock(lock, True)
+        if self.local_keys is not None:
+            LOCAL_LOCKS.release(self.keys)
 
 
 class LooselyEqualDocumentSchema(DocumentSchema):
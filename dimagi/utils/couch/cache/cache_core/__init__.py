@@ -2,6 +2,7 @@ import logging
 from django.conf import settings
 from django.core import cache
 from django.core.cache import InvalidCacheBackendError
+from django.core.exceptions import ImproperlyConfigured
 from django_redis.cache import RedisCache
 
 
@@ -20,6 +21,58 @@ DEBUG_TRACE = False
 CACHE_DOCS = getattr(settings, 'COUCH_CACHE_DOCS', False)
 CACHE_VIEWS = getattr(settings, 'COUCH_CACHE_VIEWS', False)
 
+# optional in-process LRU tier in front of redis for cached docs
+LOCAL_CACHE_DOCS = getattr(settings, 'COUCH_CACHE_LOCAL_DOCS', False)
+LOCAL_CACHE_MAX_ENTRIES = getattr(settings, 'COUCH_CACHE_LOCAL_MAX_ENTRIES', 1000)
+LOCAL_CACHE_MAX_BYTES = getattr(settings, 'COUCH_CACHE_LOCAL_MAX_BYTES', 16 * 1024 * 1024)
+LOCAL_CACHE_TIMEOUT = getattr(settings, 'COUCH_CACHE_LOCAL_TIMEOUT', 60)
+
+# seconds to remember that a doc doesn't exist (couch 404), 0 to not cache misses
+MISSING_DOC_TIMEOUT = getattr(settings, 'COUCH_CACHE_MISSING_DOC_TIMEOUT', 0)
+
+# seconds a GenerationCache generation may be served from process memory, 0 to always read redis
+LOCAL_GENERATION_TIMEOUT = getattr(settings, 'COUCH_CACHE_LOCAL_GENERATION_TIMEOUT', 0)
+GENERATION_CHANNEL = getattr(settings, 'COUCH_CACHE_GENERATION_CHANNEL', 'cache_core:generation_bumps')
+
+# payload codec for cached docs and views, see codec.py. None keeps the legacy simplejson format
+CODEC = getattr(settings, 'COUCH_CACHE_CODEC', None)
+COMPRESSION = getattr(settings, 'COUCH_CACHE_COMPRESSION', None)
+COMPRESS_MIN_LEN = getattr(settings, 'COUCH_CACHE_COMPRESS_MIN_LEN', 4096)
+
+# single flight fills of cached_view misses, see stampede.py
+STAMPEDE_PROTECTION = getattr(settings, 'COUCH_CACHE_STAMPEDE_PROTECTION', False)
+STAMPEDE_LOCK_TIMEOUT = getattr(settings, 'COUCH_CACHE_STAMPEDE_LOCK_TIMEOUT', 30)
+STAMPEDE_WAIT = getattr(settings, 'COUCH_CACHE_STAMPEDE_WAIT', 5)
+STAMPEDE_POLL_INTERVAL = getattr(settings, 'COUCH_CACHE_STAMPEDE_POLL_INTERVAL', 0.05)
+EARLY_RECOMPUTE_BETA = getattr(settings, 'COUCH_CACHE_EARLY_RECOMPUTE_BETA', 0)
+
+# cached_view payloads bigger than this aren't cached, 0 for no limit. Payloads bigger than
+# the chunk size are split over several keys, 0 to never split. See policy.py
+VIEW_MAX_PAYLOAD_SIZE = getattr(settings, 'COUCH_CACHE_VIEW_MAX_PAYLOAD_SIZE', 0)
+VIEW_CHUNK_SIZE = getattr(settings, 'COUCH_CACHE_VIEW_CHUNK_SIZE', 0)
+
+# adapt the ttl of GenerationCache views to how often their generation is bumped, see ttl.py
+ADAPTIVE_TTL = getattr(settings, 'COUCH_CACHE_ADAPTIVE_TTL', False)
+ADAPTIVE_TTL_MIN = getattr(settings, 'COUCH_CACHE_ADAPTIVE_TTL_MIN', 5 * 60)
+ADAPTIVE_TTL_MAX = getattr(settings, 'COUCH_CACHE_ADAPTIVE_TTL_MAX', 7 * 24 * 60 * 60)
+ADAPTIVE_TTL_FACTOR = getattr(settings, 'COUCH_CACHE_ADAPTIVE_TTL_FACTOR', 2)
+
+# write doc cache fills from a background thread in batches, see writebehind.py
+WRITE_BEHIND = getattr(settings, 'COUCH_CACHE_WRITE_BEHIND', False)
+WRITE_BEHIND_MAX_PENDING = getattr(settings, 'COUCH_CACHE_WRITE_BEHIND_MAX_PENDING', 10000)
+WRITE_BEHIND_BATCH_SIZE = getattr(settings, 'COUCH_CACHE_WRITE_BEHIND_BATCH_SIZE', 500)
+WRITE_BEHIND_INTERVAL = getattr(settings, 'COUCH_CACHE_WRITE_BEHIND_INTERVAL', 0.05)
+
+# CACHES aliases to shard cached docs and views over, the first one is the primary. See sharding.py
+SHARDS = getattr(settings, 'COUCH_CACHE_SHARDS', None)
+
+# fraction of cached_view calls recorded for warm_cached_views (0 to not record), see warming.py
+RECORD_VIEWS = getattr(settings, 'COUCH_CACHE_RECORD_VIEWS', 0)
+RECORD_VIEWS_MAX = getattr(settings, 'COUCH_CACHE_RECORD_VIEWS_MAX', 10000)
+
+# where cached_view hit/miss/latency metrics go, see metrics.py
+METRICS_SINK_CONFIG = getattr(settings, 'COUCH_CACHE_METRICS_SINK', None)
+
 
 CACHED_VIEW_PREFIX = '#cached_view_'
 
@@ -30,8 +83,28 @@ CACHED_DOC_PROP_PREFIX = '#cached_doc_helper_'
 class RedisClientError(Exception):
     pass
 
+_sharded_cache = None
+
+
 def rcache():
-    return MOCK_REDIS_CACHE or get_redis_default_cache()
+    return MOCK_REDIS_CACHE or get_sharded_cache() or get_redis_default_cache()
+
+
+def get_sharded_cache():
+    """
+    The ShardedCache over COUCH_CACHE_SHARDS, None if sharding isn't configured
+    """
+    global _sharded_cache
+    if not SHARDS:
+        return None
+    if _sharded_cache is None:
+        from .sharding import ShardedCache
+        if SHARDS[0] != 'redis':
+            # generation keys live on the primary, their broadcasts go through get_redis_client()
+            raise ImproperlyConfigured(
+                "COUCH_CACHE_SHARDS must start with 'redis', the primary shard, not %r" % SHARDS[0])
+        _sharded_cache = ShardedCache(dict((alias, cache.caches[alias]) for alias in SHARDS), SHARDS[0])
+    return _sharded_cache
 
 
 def get_redis_default_cache():
@@ -53,6 +126,19 @@ def get_redis_client():
     return rcache
 
 
+def get_redis_shards():
+    """
+    Every redis cache cache_core keeps docs and views in: the shards, or just the redis cache
+    """
+    if not SHARDS:
+        return [get_redis_client()]
+    shards = [cache.caches[alias] for alias in SHARDS]
+    for shard in shards:
+        if not isinstance(shard, RedisCache):
+            raise RedisClientError('Cache shard %r is not a redis cache' % shard)
+    return shards
+
+
 def key_doc_id(doc_id):
     """
     Redis cache key for a full couch document by doc_id
@@ -1,10 +1,13 @@
-from couchdbkit import MultipleResultsFound
+from couchdbkit import MultipleResultsFound, ResourceNotFound
 from django_redis.exceptions import ConnectionInterrupted
-import simplejson
-from . import COUCH_CACHE_TIMEOUT, CACHE_DOCS, rcache, key_doc_id
+from . import broadcast, codec, COUCH_CACHE_TIMEOUT, CACHE_DOCS, MISSING_DOC_TIMEOUT, rcache, key_doc_id
 from .const import INTERRUPTED
 from .gen import GenerationCache
-from .lib import invalidate_doc_generation, _get_cached_doc_only
+from .lib import invalidate_doc_generation, invalidate_doc_generations, _get_cached_doc_only, _get_cached_docs_only, \
+    is_not_found_payload, not_found_payload
+from .local import set_local_doc, delete_local_doc, copy_json, NOT_FOUND_DOC_STATS
+from .warming import record_view_request
+from .writebehind import queue_write, discard_writes, write_behind_enabled
 
 
 class FakeViewResults(list):
@@ -43,6 +46,7 @@ def cached_view(db, view_name, wrapper=None, cache_expire=COUCH_CACHE_TIMEOUT, f
     Entry point for caching views. See if it's in the generational view system, else juts call normal.
     """
     from dimagi.utils.couch.cache.cache_core.gen import GlobalCache, GenerationCache
+    record_view_request(db, view_name, params, cache_expire)
     generation_mgr = GenerationCache.view_generation_map()
     if view_name in generation_mgr:
         cache_method = generation_mgr[view_name].cached_view
@@ -55,10 +59,87 @@ def cached_view(db, view_name, wrapper=None, cache_expire=COUCH_CACHE_TIMEOUT, f
     )
 
 
+def _set_local_doc(doc_key, doc, size):
+    # not while the broadcast listener is reconnecting, see broadcast.py
+    if broadcast.LOCAL_GENERATIONS.local_docs_trusted():
+        set_local_doc(doc_key, doc, size)
+
+
+def _clear_not_found(doc_keys):
+    """
+    A queued fill only lands when its batch is written, or never if the queue
+    was full: don't leave a not found marker (see do_cache_not_found) answering
+    for the doc until then
+    """
+    if MISSING_DOC_TIMEOUT:
+        rcache().delete_many(doc_keys)
+
+
 def do_cache_doc(doc, cache_expire=COUCH_CACHE_TIMEOUT):
     """Cache an already opened doc instance"""
     if CACHE_DOCS:
-        rcache().set(key_doc_id(doc['_id']), simplejson.dumps(doc), timeout=cache_expire)
+        doc_key = key_doc_id(doc['_id'])
+        payload = codec.encode(doc)
+        if write_behind_enabled():
+            _clear_not_found([doc_key])
+            queue_write(doc_key, payload, cache_expire)
+        else:
+            rcache().set(doc_key, payload, timeout=cache_expire)
+        _set_local_doc(doc_key, doc, len(payload))
+
+
+def do_cache_docs(docs, cache_expire=COUCH_CACHE_TIMEOUT):
+    """Cache many already opened doc instances with one pipelined write"""
+    if CACHE_DOCS and docs:
+        payloads = {}
+        for doc in docs:
+            doc_key = key_doc_id(doc['_id'])
+            payloads[doc_key] = codec.encode(doc)
+            _set_local_doc(doc_key, doc, len(payloads[doc_key]))
+        if write_behind_enabled():
+            _clear_not_found(list(payloads))
+            for doc_key, payload in payloads.items():
+                queue_write(doc_key, payload, cache_expire)
+        else:
+            rcache().set_many(payloads, timeout=cache_expire)
+
+
+def do_cache_not_found(doc_id, reason=None):
+    """
+    Remember for MISSING_DOC_TIMEOUT seconds that couch doesn't have doc_id.
+    Uses add so a doc cached concurrently by a save is never clobbered.
+    """
+    if CACHE_DOCS and MISSING_DOC_TIMEOUT:
+        NOT_FOUND_DOC_STATS.misses += 1
+        rcache().add(key_doc_id(doc_id), not_found_payload(reason), timeout=MISSING_DOC_TIMEOUT)
+
+
+def cached_open_docs(db, doc_ids, cache_expire=COUCH_CACHE_TIMEOUT):
+    """
+    Bulk version of cached_open_doc: one MGET for the cache and one bulk couch
+    fetch for the misses.
+
+    return: dict of doc_id -> doc. Docs that don't exist (anymore) are left out.
+    """
+    from dimagi.utils.couch.bulk import get_docs
+
+    doc_ids = list(set(doc_ids))
+    try:
+        docs = _get_cached_docs_only(doc_ids)
+        interrupted = False
+    except ConnectionInterrupted:
+        docs = {}
+        interrupted = True
+
+    missing_ids = [doc_id for doc_id in doc_ids if doc_id not in docs]
+    docs = dict((doc_id, doc) for doc_id, doc in docs.items() if doc is not None)
+    if missing_ids:
+        fetched = get_docs(db, keys=missing_ids)
+        if not interrupted:
+            do_cache_docs(fetched, cache_expire=cache_expire)
+        for doc in fetched:
+            docs[doc['_id']] = doc
+    return docs
 
 
 def cached_open_doc(db, doc_id, cache_expire=COUCH_CACHE_TIMEOUT, **params):
@@ -70,7 +151,12 @@ def cached_open_doc(db, doc_id, cache_expire=COUCH_CACHE_TIMEOUT, **params):
     except ConnectionInterrupted:
         cached_doc = INTERRUPTED
     if cached_doc in (None, INTERRUPTED):
-        doc = db.open_doc(doc_id, **params)
+        try:
+            doc = db.open_doc(doc_id, **params)
+        except ResourceNotFound as e:
+            if cached_doc is not INTERRUPTED:
+                do_cache_not_found(doc_id, e.msg)
+            raise
         if cached_doc is not INTERRUPTED:
             do_cache_doc(doc, cache_expire=cache_expire)
         return doc
@@ -90,13 +176,19 @@ def invalidate_doc(doc, deleted=False):
 
     # regardless if it exist or not, send it to the generational lookup and invalidate_all.
     prior_ver = rcache().get(doc_key, None)
+    if is_not_found_payload(prior_ver):
+        prior_ver = None
     if prior_ver and not doc.get('doc_type', None):
-        invalidate_doc = simplejson.loads(prior_ver)
+        invalidate_doc = codec.decode(prior_ver)
     else:
         invalidate_doc = doc
 
     invalidate_doc_generation(invalidate_doc)
-    rcache().delete(key_doc_id(doc_id))
+    delete_local_doc(doc_key)
+    discard_writes([doc_key])
+    rcache().delete(doc_key)
+    # other processes drop their local copies
+    broadcast.LOCAL_GENERATIONS.publish_docs([doc_key])
 
     if not deleted and invalidate_doc.get('doc_id', None) in GenerationCache.doc_type_generation_map():
         do_cache_doc(doc)
@@ -105,3 +197,42 @@ def invalidate_doc(doc, deleted=False):
         return True
     else:
         return False
+
+
+def invalidate_docs(docs, deleted=False):
+    """
+    Bulk version of invalidate_doc, e.g. after a bulk_save: one MGET for the prior
+    versions, one generation bump per affected GenerationCache and one DEL.
+
+    return: dict of doc_id -> (true|false existed or not)
+    """
+    docs_by_key = dict((key_doc_id(doc['_id']), doc) for doc in docs)
+    if not docs_by_key:
+        return {}
+
+    prior_vers = dict(
+        (doc_key, payload) for doc_key, payload in rcache().get_many(list(docs_by_key)).items()
+        if not is_not_found_payload(payload)
+    )
+    to_invalidate = []
+    to_recache = []
+    doc_type_map = GenerationCache.doc_type_generation_map()
+    for doc_key, doc in docs_by_key.items():
+        prior_ver = prior_vers.get(doc_key)
+        if prior_ver and not doc.get('doc_type', None):
+            invalidate_doc = codec.decode(prior_ver)
+        else:
+            invalidate_doc = doc
+        to_invalidate.append(invalidate_doc)
+        if not deleted and invalidate_doc.get('doc_id', None) in doc_type_map:
+            to_recache.append(doc)
+
+    invalidate_doc_generations(to_invalidate)
+    for doc_key in docs_by_key:
+        delete_local_doc(doc_key)
+    discard_writes(list(docs_by_key))
+    rcache().delete_many(list(docs_by_key))
+    broadcast.LOCAL_GENERATIONS.publish_docs(list(docs_by_key))
+    do_cache_docs(to_recache)
+
+    return dict((doc['_id'], bool(prior_vers.get(doc_key))) for doc_key, doc in docs_by_key.items())
@@ -0,0 +1,247 @@
+"""
+In-process copies of GenerationCache generation values, and the broadcast that
+keeps them and the in-process doc tier (see local.py) up to date.
+
+Every cached_view lookup needs the current generation of its cache. With
+COUCH_CACHE_LOCAL_GENERATION_TIMEOUT > 0 the value is kept in-process for
+that many seconds instead of being read from redis each time.
+
+invalidate_all publishes the bumped generation_key on a redis pub/sub channel
+and a daemon thread in every process drops its local copy, and the local docs of
+the cache's doc_types, when the message arrives. With COUCH_CACHE_LOCAL_DOCS,
+invalidate_doc and invalidate_docs publish the keys of the docs they invalidate
+the same way. The staleness bound is:
+
+- while the listener is subscribed: pub/sub delivery latency (milliseconds).
+- while the listener is reconnecting: none, local copies (generations and
+  docs) are bypassed and every lookup reads redis again.
+- if the cache backend has no pub/sub (not redis): the timeout itself.
+
+The listener publishes a ping when the channel has been quiet for
+LISTENER_HEALTH_CHECK_INTERVAL seconds and reconnects if it doesn't hear it
+back, so a half-open subscription is noticed. A process forked from one with
+a listener (e.g. a prefork worker) starts its own, with empty local copies.
+"""
+import logging
+import os
+import threading
+import time
+import simplejson
+from . import LOCAL_GENERATION_TIMEOUT, GENERATION_CHANNEL, get_redis_client, RedisClientError
+from . import local
+
+log = logging.getLogger(__name__)
+
+LISTENER_RETRY_INTERVAL = 5
+LISTENER_HEALTH_CHECK_INTERVAL = 30
+
+PING = simplejson.dumps({'ping': True})
+
+
+class ListenerTimeout(Exception):
+    pass
+
+
+class LocalGenerations(object):
+
+    def __init__(self, timeout=LOCAL_GENERATION_TIMEOUT):
+        self.timeout = timeout
+        # False while the broadcast listener is not subscribed: we could be missing bumps
+        self.trusted = True
+        self.listener = None
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._generations = {}
+        # bumped on every invalidation, so a value read from redis before an
+        # invalidation arrived can't be stored after it
+        self._epoch = 0
+
+    @property
+    def enabled(self):
+        return self.timeout > 0
+
+    @property
+    def local_docs(self):
+        return local.LOCAL_DOC_CACHE is not None
+
+    @property
+    def broadcasting(self):
+        return self.enabled or self.local_docs
+
+    def local_docs_trusted(self):
+        """
+        Whether in-process doc copies may be served: not while the listener is
+        reconnecting, we could be missing invalidations
+        """
+        if not self.local_docs:
+            return False
+        self.ensure_listener()
+        return self.trusted
+
+    def set_local_doc(self, doc_key, doc, size, epoch):
+        """
+        Keep a doc read from redis in-process, unless an invalidation arrived since
+        """
+        with self._lock:
+            if epoch == self._epoch:
+                local.set_local_doc(doc_key, doc, size)
+
+    @property
+    def epoch(self):
+        return self._epoch
+
+    def get(self, generation_key):
+        if not self.enabled:
+            return None
+        self.ensure_listener()
+        if not self.trusted:
+            return None
+        entry = self._generations.get(generation_key)
+        if entry is None or entry[1] < time.time():
+            return None
+        return entry[0]
+
+    def set(self, generation_key, generation, epoch=None):
+        if not self.enabled:
+            return
+        with self._lock:
+            if epoch is None or epoch == self._epoch:
+                self._generations[generation_key] = (generation, time.time() + self.timeout)
+
+    def invalidate(self, generation_key):
+        with self._lock:
+            self._epoch += 1
+            self._generations.pop(generation_key, None)
+
+    def invalidate_docs(self, doc_keys):
+        with self._lock:
+            self._epoch += 1
+            for doc_key in doc_keys:
+                local.delete_local_doc(doc_key)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._generations.clear()
+            local.clear_local_docs()
+
+    def handle_message(self, data):
+        if data == PING:
+            return
+        try:
+            message = simplejson.loads(data)
+            generation_key = message.get('generation_key')
+            doc_keys = message.get('doc_keys')
+        except (ValueError, AttributeError):
+            generation_key = doc_keys = None
+        if generation_key is not None:
+            self.invalidate(generation_key)
+            local.delete_local_doc_types(_doc_types(generation_key))
+        elif isinstance(doc_keys, list):
+            self.invalidate_docs(doc_keys)
+        else:
+            log.warning("Ignoring malformed generation broadcast: %r", data)
+
+    def _publish(self, message):
+        try:
+            client = get_redis_client().client.get_client()
+        except RedisClientError:
+            return
+        client.publish(GENERATION_CHANNEL, simplejson.dumps(message))
+
+    def publish(self, generation_key):
+        if self.broadcasting:
+            self._publish({'generation_key': generation_key})
+
+    def publish_docs(self, doc_keys):
+        if self.local_docs and doc_keys:
+            self._publish({'doc_keys': list(doc_keys)})
+
+    def _after_fork(self):
+        """
+        A forked child inherits the listener attribute but not its thread, so
+        nothing would keep its local copies up to date
+        """
+        self._pid = os.getpid()
+        # the parent's lock may have been held by one of its other threads
+        self._lock = threading.Lock()
+        self._epoch += 1
+        self._generations = {}
+        self.listener = None
+
+    def ensure_listener(self):
+        if self.listener is not None and self._pid == os.getpid():
+            return
+        if self._pid != os.getpid():
+            self._after_fork()
+        with self._lock:
+            if self.listener is not None:
+                return
+            try:
+                get_redis_client()
+            except RedisClientError:
+                # no pub/sub to listen on, local copies are only bounded by the timeout
+                self.listener = False
+                return
+            self.trusted = False
+            self.listener = GenerationListener(self)
+            self.listener.start()
+
+
+def _doc_types(generation_key):
+    from .gen import GenerationCache
+    return [
+        doc_type
+        for gen_model in GenerationCache._get_generational_caches() if gen_model.generation_key == generation_key
+        for doc_type in gen_model.doc_types
+    ]
+
+
+class GenerationListener(threading.Thread):
+    """
+    Drops local generation and doc copies as invalidation broadcasts come in.
+    """
+
+    def __init__(self, generations):
+        super(GenerationListener, self).__init__(name='cache-core-generation-listener')
+        self.daemon = True
+        self.generations = generations
+
+    def listen(self, client, pubsub, interval=LISTENER_HEALTH_CHECK_INTERVAL):
+        """
+        Handle messages until the subscription stops responding
+        """
+        pinged = False
+        last_heard = time.time()
+        while True:
+            message = pubsub.get_message(ignore_subscribe_messages=True, timeout=interval)
+            if message is not None:
+                last_heard = time.time()
+                pinged = False
+                if message.get('type') == 'message':
+                    self.generations.handle_message(message['data'])
+            elif time.time() - last_heard >= interval:
+                if pinged:
+                    raise ListenerTimeout("No reply to the generation listener ping")
+                client.publish(GENERATION_CHANNEL, PING)
+                pinged = True
+                last_heard = time.time()
+
+    def run(self):
+        while True:
+            try:
+                client = get_redis_client().client.get_client()
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(GENERATION_CHANNEL)
+                # anything cached before subscribing may have missed a bump
+                self.generations.clear()
+                self.generations.trusted = True
+                self.listen(client, pubsub)
+            except Exception:
+                log.exception("Generation broadcast listener disconnected, retrying")
+            self.generations.trusted = False
+            self.generations.clear()
+            time.sleep(LISTENER_RETRY_INTERVAL)
+
+
+LOCAL_GENERATIONS = LocalGenerations()
@@ -0,0 +1,180 @@
+"""
+Serialization of the payloads cache_core keeps in redis (cached docs and views).
+
+New style payloads start with a versioned header:
+
+    MAGIC + FORMAT_VERSION + <serializer id> + <compressor id> + body
+
+Anything without the header is a legacy simplejson payload, so entries written
+before a codec was configured keep being readable during a rollout.
+
+Rollout: deploy this code everywhere first (it reads both formats), then set
+COUCH_CACHE_CODEC. Processes running older code can't read new style payloads.
+"""
+import zlib
+import simplejson
+from . import CODEC, COMPRESSION, COMPRESS_MIN_LEN
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+
+MAGIC = '\x00cc'
+FORMAT_VERSION = '1'
+HEADER_LENGTH = len(MAGIC) + 3
+
+
+class CodecError(Exception):
+    pass
+
+
+class JsonSerializer(object):
+    id = 'j'
+    name = 'json'
+
+    @staticmethod
+    def dumps(obj):
+        return simplejson.dumps(obj, separators=(',', ':'))
+
+    @staticmethod
+    def loads(data):
+        return simplejson.loads(data)
+
+
+class MsgpackSerializer(object):
+    id = 'm'
+    name = 'msgpack'
+
+    @staticmethod
+    def dumps(obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    @staticmethod
+    def loads(data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class NoCompressor(object):
+    id = '-'
+    name = None
+
+    @staticmethod
+    def compress(data):
+        return data
+
+    @staticmethod
+    def decompress(data):
+        return data
+
+
+class ZlibCompressor(object):
+    id = 'z'
+    name = 'zlib'
+
+    @staticmethod
+    def compress(data):
+        return zlib.compress(data, 1)
+
+    @staticmethod
+    def decompress(data):
+        return zlib.decompress(data)
+
+
+class Lz4Compressor(object):
+    id = 'l'
+    name = 'lz4'
+
+    @staticmethod
+    def compress(data):
+        return lz4_frame.compress(data)
+
+    @staticmethod
+    def decompress(data):
+        return lz4_frame.decompress(data)
+
+
+SERIALIZERS = {}
+COMPRESSORS = {}
+
+
+def register_serializer(serializer):
+    SERIALIZERS[serializer.id] = serializer
+
+
+def register_compressor(compressor):
+    COMPRESSORS[compressor.id] = compressor
+
+
+register_serializer(JsonSerializer)
+if msgpack is not None:
+    register_serializer(MsgpackSerializer)
+register_compressor(NoCompressor)
+register_compressor(ZlibCompressor)
+if lz4_frame is not None:
+    register_compressor(Lz4Compressor)
+
+
+def _by_name(registry, name, kind):
+    for codec in registry.values():
+        if codec.name == name:
+            return codec
+    raise CodecError("%s %r is not available" % (kind, name))
+
+
+class PayloadCodec(object):
+    """
+    serializer: None for the legacy format (plain simplejson, no header)
+    compressor: compress bodies of at least compress_min_len bytes with this
+    """
+
+    def __init__(self, serializer=None, compressor=None, compress_min_len=COMPRESS_MIN_LEN):
+        self.serializer = _by_name(SERIALIZERS, serializer, 'serializer') if serializer else None
+        self.compressor = _by_name(COMPRESSORS, compressor, 'compressor') if compressor else NoCompressor
+        self.compress_min_len = compress_min_len
+
+    def encode(self, obj):
+        if self.serializer is None:
+            return simplejson.dumps(obj)
+        body = self.serializer.dumps(obj)
+        compressor = NoCompressor
+        if self.compressor is not NoCompressor and len(body) >= self.compress_min_len:
+            compressed = self.compressor.compress(body)
+            if len(compressed) < len(body):
+                body = compressed
+                compressor = self.compressor
+        return ''.join([MAGIC, FORMAT_VERSION, self.serializer.id, compressor.id]) + body
+
+    def decode(self, payload):
+        return decode(payload)
+
+
+def decode(payload):
+    """
+    Decode a payload written by any codec, including legacy simplejson payloads.
+    """
+    if not payload.startswith(MAGIC):
+        return simplejson.loads(payload)
+    header = payload[:HEADER_LENGTH]
+    version, serializer_id, compressor_id = header[len(MAGIC):]
+    if version != FORMAT_VERSION:
+        raise CodecError("Unknown cache payload format version %r" % version)
+    try:
+        serializer = SERIALIZERS[serializer_id]
+        compressor = COMPRESSORS[compressor_id]
+    except KeyError:
+        raise CodecError("Cache payload codec %r is not available" % header[len(MAGIC):])
+    return serializer.loads(compressor.decompress(payload[HEADER_LENGTH:]))
+
+
+PAYLOAD_CODEC = PayloadCodec(CODEC, COMPRESSION)
+
+
+def encode(obj):
+    return PAYLOAD_CODEC.encode(obj)
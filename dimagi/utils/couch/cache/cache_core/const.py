@@ -1,2 +1,8 @@
 MISSING = object()
 INTERRUPTED = object()
+
+# payload stored under a doc key when couch says the doc doesn't exist, followed by couch's reason
+NOT_FOUND_PREFIX = '\x00nf:'
+
+# payload stored under a cached view key whose payload was split into chunk keys, followed by the chunk count
+CHUNKED_PREFIX = '\x00chunks:'
@@ -1,11 +1,70 @@
+import hashlib
 import importlib
+import logging
+import simplejson
 from django.utils import http
-from . import CACHED_VIEW_PREFIX, rcache, COUCH_CACHE_TIMEOUT, CACHE_VIEWS
+from django.utils.encoding import force_text
+from . import CACHED_VIEW_PREFIX, rcache, COUCH_CACHE_TIMEOUT, CACHE_VIEWS, STAMPEDE_PROTECTION, ADAPTIVE_TTL
 from django.conf import settings
 from django_redis.exceptions import ConnectionInterrupted
-import simplejson
+from dimagi.utils.couch.cache.cache_core import codec
 from dimagi.utils.couch.cache.cache_core.const import INTERRUPTED, MISSING
-from couchdbkit import ResourceNotFound
+from dimagi.utils.couch.cache.cache_core.local import delete_local_doc_types, copy_json
+from dimagi.utils.couch.cache.cache_core import broadcast, metrics, ttl
+from dimagi.utils.couch.cache.cache_core.stampede import get_view_payload, single_flight
+from dimagi.utils.couch.cache.cache_core.policy import ViewCachePolicy, is_chunked, join_chunks
+
+log = logging.getLogger(__name__)
+
+# bump when the way view cache keys are built changes, so old entries aren't served under new keys
+VIEW_KEY_VERSION = 'v2'
+# param strings longer than this are hashed
+VIEW_KEY_HASH_MIN_LEN = 128
+
+# last generation value this process saw for each generation_key
+_seen_generations = {}
+
+
+class GenerationIndex(dict):
+    """
+    Read only view/doc_type -> GenerationCache lookup, built once from COUCH_CACHE_BACKENDS
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("GenerationCache indexes are read only, use GenerationCache.reload_generational_caches()")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+
+def canonical_param_string(params):
+    """
+    The same view params always give the same string, whatever the dict order.
+    Long ones are replaced by a fixed length digest.
+    """
+    param_string = http.urlquote(simplejson.dumps(params, sort_keys=True, separators=(',', ':'), default=force_text))
+    if len(param_string) > VIEW_KEY_HASH_MIN_LEN:
+        param_string = '#' + hashlib.sha1(param_string.encode('utf-8')).hexdigest()
+    return param_string
+
+
+def validate_generational_caches(generational_caches):
+    """
+    Report views and doc_types claimed by more than one GenerationCache. Only the last one
+    in COUCH_CACHE_BACKENDS is used for those, so the others silently go stale.
+
+    return: {'views': {view_name: [cache class names]}, 'doc_types': {doc_type: [cache class names]}}
+    """
+    conflicts = {}
+    for attr in ('views', 'doc_types'):
+        claims = {}
+        for gen_model in generational_caches:
+            for name in getattr(gen_model, attr):
+                claims.setdefault(name, []).append(gen_model.__class__.__name__)
+        conflicts[attr] = dict((name, owners) for name, owners in claims.items() if len(owners) > 1)
+        for name, owners in sorted(conflicts[attr].items()):
+            log.warning("%s %r is claimed by more than one GenerationCache: %s",
+                        attr, name, ', '.join(owners))
+    return conflicts
 
 
 class GenerationCache(object):
@@ -13,27 +72,29 @@ class GenerationCache(object):
     doc_types = []
     views = []
 
+    # ttl and payload size overrides for the views of this cache, see policy.py
+    cache_expire = None
+    max_payload_size = None
+    chunk_size = None
+    view_policies = {}
+
     @staticmethod
     def _get_generational_caches():
-        if not getattr(GenerationCache, '_generational_caches', None):
+        if getattr(GenerationCache, '_generational_caches', None) is None:
             GenerationCache._generate_caches()
         return getattr(GenerationCache, '_generational_caches')
 
     @staticmethod
     def view_generation_map():
-        view_map = {}
-        for gen_model in GenerationCache._get_generational_caches():
-            for view_name in gen_model.views:
-                view_map[view_name] = gen_model
-        return view_map
+        if getattr(GenerationCache, '_view_index', None) is None:
+            GenerationCache._generate_caches()
+        return GenerationCache._view_index
 
     @staticmethod
     def doc_type_generation_map():
-        doc_type_map = {}
-        for gen_model in GenerationCache._get_generational_caches():
-            for doc_type in gen_model.doc_types:
-                doc_type_map[doc_type] = gen_model
-        return doc_type_map
+        if getattr(GenerationCache, '_doc_type_index', None) is None:
+            GenerationCache._generate_caches()
+        return GenerationCache._doc_type_index
 
     @staticmethod
     def _generate_caches():
@@ -44,26 +105,86 @@ class GenerationCache(object):
             mod = importlib.import_module(mod_path)
             gen_model = getattr(mod, cache_class_name)
             generational_caches.append(gen_model())
+
+        view_map = {}
+        doc_type_map = {}
+        for gen_model in generational_caches:
+            for view_name in gen_model.views:
+                view_map[view_name] = gen_model
+            for doc_type in gen_model.doc_types:
+                doc_type_map[doc_type] = gen_model
+        validate_generational_caches(generational_caches)
+
         setattr(GenerationCache, '_generational_caches', generational_caches)
+        setattr(GenerationCache, '_view_index', GenerationIndex(view_map))
+        setattr(GenerationCache, '_doc_type_index', GenerationIndex(doc_type_map))
+
+    @staticmethod
+    def reload_generational_caches():
+        """
+        Rebuild the caches and their indexes from COUCH_CACHE_BACKENDS, e.g. after overriding settings in a test.
+        """
+        GenerationCache._generate_caches()
 
     def _get_generation(self):
-        genret = rcache().get(self.generation_key, None)
-        if not genret:
-            # never seen key before, start from zero
-            rcache().set(self.generation_key, 0, timeout=None)
-            return str(0)
-        else:
-            return str(genret)
+        local_generations = broadcast.LOCAL_GENERATIONS
+        generation = local_generations.get(self.generation_key)
+        if generation is None:
+            epoch = local_generations.epoch
+            genret = rcache().get(self.generation_key, None)
+            if not genret:
+                # never seen key before, start from zero
+                rcache().set(self.generation_key, 0, timeout=None)
+                generation = str(0)
+            else:
+                generation = str(genret)
+            local_generations.set(self.generation_key, generation, epoch=epoch)
+        self._observe_generation(generation)
+        return generation
+
+    def _observe_generation(self, generation):
+        """
+        Another process bumped the generation: docs of our doc_types held in
+        the in-process doc tier may be stale, so drop them.
+        """
+        seen = _seen_generations.get(self.generation_key)
+        if seen != generation:
+            _seen_generations[self.generation_key] = generation
+            if seen is not None:
+                delete_local_doc_types(self.doc_types)
+                ttl.observe_bump(self.generation_key)
 
     def invalidate_all(self):
         """
         Invalidate this cache by incrementing the generation
         """
+        delete_local_doc_types(self.doc_types)
+        broadcast.LOCAL_GENERATIONS.invalidate(self.generation_key)
         try:
-            return rcache().incr(self.generation_key)
+            generation = rcache().incr(self.generation_key)
         except ValueError:
             # there was likely no cached data to start with. that's fine.
-            pass
+            return None
+        # count our own bump here, rather than again when we next read the generation
+        _seen_generations[self.generation_key] = str(generation)
+        ttl.observe_bump(self.generation_key)
+        broadcast.LOCAL_GENERATIONS.publish(self.generation_key)
+        return generation
+
+    def view_policy(self, view_name):
+        return ViewCachePolicy.for_view(self, view_name)
+
+    def view_cache_expire(self, view_name, cache_expire):
+        """
+        The ttl to cache view_name with: the view policy's if it sets one, else
+        the default ttl adapted to how often the generation changes if
+        COUCH_CACHE_ADAPTIVE_TTL is set, else cache_expire.
+        """
+        policy = self.view_policy(view_name)
+        if (policy.cache_expire is None and ADAPTIVE_TTL and self.generation_key is not None
+                and cache_expire == COUCH_CACHE_TIMEOUT):
+            return ttl.adaptive_ttl(self.generation_key, cache_expire)
+        return policy.expire(cache_expire)
 
     def _mk_view_cache_key(self, view_name, params=None):
         """
@@ -73,13 +194,14 @@ class GenerationCache(object):
         """
         param_string = ""
         if isinstance(params, dict):
-            param_string = http.urlquote('|'.join(["%s::%s" % (k, v) for k, v in params.items()]))
+            param_string = canonical_param_string(params)
         elif params == '*':
             param_string = params
 
         cache_view_key = ':'.join([
             self._get_generation(),
             CACHED_VIEW_PREFIX,
+            VIEW_KEY_VERSION,
             view_name,
             param_string,
         ])
@@ -105,25 +227,62 @@ class GenerationCache(object):
 
         Note, a view call with include_docs=True will not be wrapped, you must wrap it on your own.
         """
-        from .api import cached_open_doc
-
-        include_docs = params.get('include_docs', False)
-
+        fill = None
         try:
             if force_invalidate:
                 self.invalidate_all()
             cache_view_key = self._mk_view_cache_key(view_name, params)
-            cached_view = rcache().get(cache_view_key, MISSING)
+            with metrics.time_view(metrics.VIEW_REDIS_LATENCY, self, view_name):
+                cached_view, fill_meta = get_view_payload(cache_view_key)
+            if CACHE_VIEWS and STAMPEDE_PROTECTION:
+                cached_view, fill = single_flight(cache_view_key, cached_view, fill_meta)
+            if is_chunked(cached_view):
+                with metrics.time_view(metrics.VIEW_REDIS_LATENCY, self, view_name):
+                    cached_view = join_chunks(cache_view_key, cached_view)
         except ConnectionInterrupted:
             cache_view_key = INTERRUPTED
             cached_view = INTERRUPTED
 
+        if cached_view is INTERRUPTED:
+            metrics.record_view(metrics.VIEW_INTERRUPTED, self, view_name)
+        elif cached_view is MISSING or not CACHE_VIEWS:
+            metrics.record_view(metrics.VIEW_MISSES, self, view_name)
+        else:
+            metrics.record_view(metrics.VIEW_HITS, self, view_name)
+            metrics.record_view(metrics.VIEW_SERVED_BYTES, self, view_name, len(cached_view))
+
+        try:
+            return self._view_results(db, view_name, wrapper, cache_expire, cache_view_key, cached_view, fill,
+                                      **params)
+        finally:
+            if fill is not None:
+                fill.release()
+
+    def _fill_view_cache(self, view_name, cache_view_key, results, cache_expire, fill):
+        policy = self.view_policy(view_name)
+        cache_expire = self.view_cache_expire(view_name, cache_expire)
+        payload = codec.encode(results)
+        if policy.too_big(payload):
+            metrics.record_view(metrics.VIEW_OVERSIZE_SKIPS, self, view_name)
+            return
+        metrics.record_view(metrics.VIEW_STORED_BYTES, self, view_name, len(payload))
+        values = policy.payload_values(cache_view_key, payload)
+        if len(values) > 1:
+            metrics.record_view(metrics.VIEW_CHUNKED_FILLS, self, view_name)
+        if fill is not None:
+            values.update(fill.fill_meta(cache_expire))
+        rcache().set_many(values, timeout=cache_expire)
+
+    def _view_results(self, db, view_name, wrapper, cache_expire, cache_view_key, cached_view, fill, **params):
+        from .api import cached_open_docs
+
+        include_docs = params.get('include_docs', False)
         is_cache_hit = cached_view not in (MISSING, INTERRUPTED) and CACHE_VIEWS
         if include_docs:
             # include_docs=True results in couchdbkit remove the 'rows' result
             # and returns just the actual rows in an array
             if is_cache_hit:
-                results = simplejson.loads(cached_view)
+                results = codec.decode(cached_view)
                 final_results = {}
 
                 if include_docs:
@@ -132,23 +291,26 @@ class GenerationCache(object):
                     final_results['total_rows'] = results['total_rows']
                     final_results['offset'] = results['offset']
 
+                    # resolve all docs at once: one redis MGET and one bulk couch fetch for the misses.
+                    # docs deleted just after we cached the view are simply left out of the results
+                    # rather than failing hard
+                    docs = cached_open_docs(db, [stub['id'] for stub in row_stubs])
+                    seen_ids = set()
                     rows = []
                     for stub in row_stubs:
-                        try:
-                            row = {
-                                "id": stub['id'],
-                                "value": None,
-                                "key": stub["key"],
-                                # this feels hacky, but for some reason other views are squashing the master cached doc.
-                                # a more true invalidation scheme should have this more readily address this, but for now
-                                # do a db call here and cache it. Should be a _cached_doc_only call here
-                                "doc": cached_open_doc(db, stub['id'])
-                            }
-                            rows.append(row)
-                        except ResourceNotFound:
-                            # maybe the doc was deleted just after we cached the view.
-                            # in that scenario, just don't add it to the results rather than failing hard
-                            pass
+                        doc = docs.get(stub['id'])
+                        if doc is None:
+                            continue
+                        if stub['id'] in seen_ids:
+                            # a doc emitted by several rows gets its own copy per row
+                            doc = copy_json(doc)
+                        seen_ids.add(stub['id'])
+                        rows.append({
+                            "id": stub['id'],
+                            "value": None,
+                            "key": stub["key"],
+                            "doc": doc,
+                        })
                     if wrapper:
                         final_results = [wrapper(x['doc']) for x in rows]
                     else:
@@ -159,7 +321,8 @@ class GenerationCache(object):
                 view_obj = db.view(view_name, **params)
                 # todo: we should try and decouple this from the "protected" methods of
                 # couchdbkit's ViewResults
-                view_obj._fetch_if_needed()
+                with metrics.time_view(metrics.VIEW_COUCH_LATENCY, self, view_name):
+                    view_obj._fetch_if_needed()
                 view_results = view_obj._result_cache
                 row_stubs = []
 
@@ -183,18 +346,19 @@ class GenerationCache(object):
                 else:
                     retval = view_results['rows']
                 if cached_view is not INTERRUPTED:
-                    rcache().set(cache_view_key, simplejson.dumps(cached_results), timeout=cache_expire)
+                    self._fill_view_cache(view_name, cache_view_key, cached_results, cache_expire, fill)
                 return retval
 
         else:
             # include_docs=False just returns the entire view verbatim
             if is_cache_hit:
-                results = simplejson.loads(cached_view)
+                results = codec.decode(cached_view)
                 return results
             else:
-                view_results = db.view(view_name, **params).all()
+                with metrics.time_view(metrics.VIEW_COUCH_LATENCY, self, view_name):
+                    view_results = db.view(view_name, **params).all()
                 if cached_view is not INTERRUPTED:
-                    rcache().set(cache_view_key, simplejson.dumps(view_results), timeout=cache_expire)
+                    self._fill_view_cache(view_name, cache_view_key, view_results, cache_expire, fill)
                     for row in view_results:
                         doc_id = row.get('id', None)
                         if doc_id:
@@ -0,0 +1,321 @@
+"""
+The redis key space used by cache_core and its neighbours, and helpers to walk
+it without blocking redis: incremental SCAN in small batches, UNLINK (with a DEL
+fallback for redis < 4) and MEMORY USAGE, pipelined per batch.
+
+Key patterns are globs on the cache key, before django's KEY_PREFIX/version are
+added by make_key, except for the few keys written with the raw redis client.
+"""
+import fnmatch
+import random
+import time
+from redis.exceptions import ResponseError
+from . import CACHED_DOC_PREFIX, CACHED_DOC_PROP_PREFIX, CACHED_VIEW_PREFIX
+
+
+class KeyPrefix(object):
+    """
+    name: what the keys are
+    patterns: globs on the cache key
+    exclude: globs on the cache key of keys the patterns match but that aren't
+    of this prefix (SCAN can't exclude, so they're filtered out client side)
+    keys: callable returning exact cache keys, for key families without a common prefix
+    flushable: safe to drop for flush_caches --prefix. Locks, rate limits and
+    not yet saved attachments are not.
+    raw: written with the raw redis client, so not passed through make_key
+    """
+
+    def __init__(self, name, patterns=(), exclude=(), keys=None, flushable=True, raw=False):
+        self.name = name
+        self.patterns = list(patterns)
+        self.exclude = list(exclude)
+        self.keys = keys
+        self.flushable = flushable
+        self.raw = raw
+
+    def redis_patterns(self, cache):
+        return [pattern if self.raw else cache.make_key(pattern) for pattern in self.patterns]
+
+    def redis_exclude(self, cache):
+        return [pattern if self.raw else cache.make_key(pattern) for pattern in self.exclude]
+
+    def redis_keys(self, cache):
+        if self.keys is None:
+            return []
+        return [key if self.raw else cache.make_key(key) for key in self.keys()]
+
+
+def _generation_keys():
+    from .gen import GenerationCache
+    return [gen_model.generation_key for gen_model in GenerationCache._get_generational_caches()]
+
+
+def _ocache_patterns():
+    from dimagi.utils.django.cached_object import CACHE_PREFIX
+    return [CACHE_PREFIX + '*']
+
+
+# order matters for classification: the first match wins
+KEY_PREFIXES = [
+    KeyPrefix('cached_doc_helper', [CACHED_DOC_PROP_PREFIX + '*']),
+    # the helper prefix starts with the doc prefix
+    KeyPrefix('cached_doc', [CACHED_DOC_PREFIX + '*'], exclude=[CACHED_DOC_PROP_PREFIX + '*']),
+    # view keys start with their generation, fill locks and chunks share the view key
+    KeyPrefix('cached_view', ['*:' + CACHED_VIEW_PREFIX + '*']),
+    KeyPrefix('generation', keys=_generation_keys),
+    KeyPrefix('cached_object', _ocache_patterns()),
+    KeyPrefix('lazy_attachment', ['lazy_attachment/*'], flushable=False),
+    KeyPrefix('lock', ['redis-object-lock-*', 'redis-class-lock-*', 'redis-lookup-lock-*'], flushable=False),
+    KeyPrefix('recorded_views', ['cache_core:recorded_views'], flushable=False, raw=True),
+]
+
+
+def get_key_prefix(name):
+    for prefix in KEY_PREFIXES:
+        if prefix.name == name:
+            return prefix
+    raise KeyError("Unknown key prefix %r, expected one of %s" % (
+        name, ', '.join(prefix.name for prefix in KEY_PREFIXES)))
+
+
+class KeyClassifier(object):
+    """
+    Names the KeyPrefix of redis keys, with the patterns of one cache worked out once
+    """
+
+    def __init__(self, cache):
+        self.prefixes = [
+            (prefix.name, prefix.redis_patterns(cache), prefix.redis_exclude(cache), set(prefix.redis_keys(cache)))
+            for prefix in KEY_PREFIXES
+        ]
+
+    def classify(self, redis_key):
+        """
+        return: the name of the first KeyPrefix redis_key belongs to, 'other' if none
+        """
+        for name, patterns, exclude, keys in self.prefixes:
+            if redis_key in keys or (_matches_any(redis_key, patterns) and not _matches_any(redis_key, exclude)):
+                return name
+        return 'other'
+
+
+def _matches_any(redis_key, patterns):
+    return any(fnmatch.fnmatchcase(redis_key, pattern) for pattern in patterns)
+
+
+def classify_key(cache, redis_key):
+    return KeyClassifier(cache).classify(redis_key)
+
+
+def raw_client(cache):
+    return cache.client.get_client()
+
+
+def scan_batches(client, pattern='*', batch_size=500):
+    """
+    Yield lists of keys matching pattern, one SCAN call per list. Lists may be
+    empty, and keys may show up more than once, as SCAN allows.
+    """
+    cursor = '0'
+    while True:
+        cursor, keys = client.scan(cursor=cursor, match=pattern, count=batch_size)
+        yield keys
+        if int(cursor) == 0:
+            break
+
+
+def unlink(client, keys):
+    """
+    Drop keys without blocking redis on freeing big values. DEL on redis < 4.
+    """
+    if not keys:
+        return 0
+    try:
+        return client.execute_command('UNLINK', *keys)
+    except ResponseError:
+        return client.delete(*keys)
+
+
+def memory_usage(client, keys, samples=0):
+    """
+    return: bytes used by each key (MEMORY USAGE, redis >= 4), None where unknown
+    """
+    pipeline = client.pipeline(transaction=False)
+    for key in keys:
+        pipeline.execute_command('MEMORY', 'USAGE', key, 'SAMPLES', samples)
+    return [
+        usage if isinstance(usage, (int, long)) else None
+        for usage in pipeline.execute(raise_on_error=False)
+    ]
+
+
+class Throttle(object):
+    """
+    Sleep at least `sleep` seconds between batches, and at least as long as
+    the last batch took, so redis is never kept busy more than half the time.
+    """
+
+    def __init__(self, sleep=0.01):
+        self.sleep = sleep
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        time.sleep(max(self.sleep, time.time() - self._started))
+
+
+class PrefixReport(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.bytes = 0
+        self.bytes_unknown = 0
+
+    def add(self, keys, usages=None):
+        self.count += len(keys)
+        for usage in usages or []:
+            if usage is None:
+                self.bytes_unknown += 1
+            else:
+                self.bytes += usage
+
+    def merge(self, other):
+        self.count += other.count
+        self.bytes += other.bytes
+        self.bytes_unknown += other.bytes_unknown
+
+
+def flush_prefix(cache, prefix, batch_size=500, sleep=0.01, dry_run=False):
+    """
+    Drop (or with dry_run, count and measure) all keys of a KeyPrefix.
+
+    return: PrefixReport
+    """
+    client = raw_client(cache)
+    report = PrefixReport(prefix.name)
+    throttle = Throttle(sleep)
+
+    def handle(keys):
+        keys = list(set(keys))
+        if dry_run:
+            report.add(keys, memory_usage(client, keys))
+        else:
+            report.add(keys)
+            unlink(client, keys)
+
+    exact_keys = prefix.redis_keys(cache)
+    for i in range(0, len(exact_keys), batch_size):
+        with throttle:
+            batch = exact_keys[i:i + batch_size]
+            pipeline = client.pipeline(transaction=False)
+            for key in batch:
+                pipeline.exists(key)
+            handle([key for key, exists in zip(batch, pipeline.execute()) if exists])
+
+    exclude = prefix.redis_exclude(cache)
+    for pattern in prefix.redis_patterns(cache):
+        for keys in scan_batches(client, pattern, batch_size):
+            with throttle:
+                keys = [key for key in keys if not _matches_any(key, exclude)]
+                if keys:
+                    handle(keys)
+    return report
+
+
+def key_ttls(client, keys):
+    """
+    return: seconds to live of each key, None for keys without expiry or already gone
+    """
+    pipeline = client.pipeline(transaction=False)
+    for key in keys:
+        pipeline.pttl(key)
+    # redis-py 2.x already turns -1/-2 into None
+    return [ttl / 1000.0 if ttl is not None and ttl >= 0 else None for ttl in pipeline.execute()]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+# upper bounds in seconds of the ttl buckets in census reports
+TTL_BUCKETS = [
+    ('<1m', 60),
+    ('<1h', 60 * 60),
+    ('<1d', 24 * 60 * 60),
+    ('>=1d', None),
+]
+
+
+class PrefixCensus(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.sizes = []
+        self.ttls = dict((bucket, 0) for bucket, _ in TTL_BUCKETS)
+        self.ttls['none'] = 0
+
+    def add_sample(self, size, ttl):
+        if size is not None:
+            self.sizes.append(size)
+        if ttl is None:
+            self.ttls['none'] += 1
+        else:
+            for bucket, bound in TTL_BUCKETS:
+                if bound is None or ttl < bound:
+                    self.ttls[bucket] += 1
+                    break
+
+    def summary(self):
+        sizes = sorted(self.sizes)
+        mean = float(sum(sizes)) / len(sizes) if sizes else 0
+        return {
+            'count': self.count,
+            'sampled': len(sizes),
+            'estimated_bytes': int(mean * self.count),
+            'p50_bytes': percentile(sizes, 0.5),
+            'p99_bytes': percentile(sizes, 0.99),
+            'max_bytes': sizes[-1] if sizes else None,
+            'ttls': dict(self.ttls),
+        }
+
+
+def key_census(cache, sample_rate=0.01, batch_size=500, sleep=0.01, max_keys=None):
+    """
+    Count all keys by KeyPrefix, and measure size and ttl of a random sample of them.
+    With max_keys the scan stops early and counts only cover the keys seen.
+
+    return: {prefix name: PrefixCensus}, number of keys scanned
+    """
+    client = raw_client(cache)
+    classifier = KeyClassifier(cache)
+    census = {}
+    throttle = Throttle(sleep)
+    scanned = 0
+    for keys in scan_batches(client, '*', batch_size):
+        with throttle:
+            sampled = []
+            for key in keys:
+                name = classifier.classify(key)
+                if name not in census:
+                    census[name] = PrefixCensus(name)
+                census[name].count += 1
+                if random.random() < sample_rate:
+                    sampled.append((name, key))
+            if sampled:
+                sample_keys = [key for _, key in sampled]
+                sizes = memory_usage(client, sample_keys)
+                ttls = key_ttls(client, sample_keys)
+                for (name, _), size, ttl in zip(sampled, sizes, ttls):
+                    census[name].add_sample(size, ttl)
+        scanned += len(keys)
+        if max_keys and scanned >= max_keys:
+            break
+    return census, scanned
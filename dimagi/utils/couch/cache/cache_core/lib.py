@@ -1,5 +1,8 @@
-import simplejson
-from . import CACHE_DOCS, key_doc_id, rcache
+from couchdbkit import ResourceNotFound
+from . import codec, CACHE_DOCS, key_doc_id, rcache
+from .const import MISSING, NOT_FOUND_PREFIX
+from . import broadcast
+from .local import get_local_doc, REDIS_DOC_STATS, NOT_FOUND_DOC_STATS
 
 
 def invalidate_doc_generation(doc):
@@ -10,12 +13,101 @@ def invalidate_doc_generation(doc):
         generation_mgr[doc_type].invalidate_all()
 
 
+def invalidate_doc_generations(docs):
+    """
+    Bump each GenerationCache affected by any of the docs exactly once
+    """
+    from .gen import GenerationCache
+    generation_mgr = GenerationCache.doc_type_generation_map()
+    affected = {}
+    for doc in docs:
+        doc_type = doc.get('doc_type', None)
+        if doc_type in generation_mgr:
+            gen_model = generation_mgr[doc_type]
+            affected[gen_model.generation_key] = gen_model
+    for gen_model in affected.values():
+        gen_model.invalidate_all()
+
+
+def is_not_found_payload(payload):
+    return isinstance(payload, basestring) and payload.startswith(NOT_FOUND_PREFIX)
+
+
+def not_found_payload(reason):
+    return NOT_FOUND_PREFIX + (reason or '')
+
+
+def raise_cached_not_found(payload):
+    NOT_FOUND_DOC_STATS.hits += 1
+    raise ResourceNotFound(payload[len(NOT_FOUND_PREFIX):], http_code=404)
+
+
 def _get_cached_doc_only(doc_id):
     """
     helper cache retrieval method for open_doc - for use by views in retrieving their docs.
+
+    raises ResourceNotFound if couch recently said the doc doesn't exist.
     """
-    doc = rcache().get(key_doc_id(doc_id), None)
+    doc_key = key_doc_id(doc_id)
+    local_generations = broadcast.LOCAL_GENERATIONS
+    use_local = CACHE_DOCS and local_generations.local_docs_trusted()
+    if use_local:
+        doc = get_local_doc(doc_key)
+        if doc is not MISSING:
+            return doc
+        epoch = local_generations.epoch
+
+    doc = rcache().get(doc_key, None)
     if doc and CACHE_DOCS:
-        return simplejson.loads(doc)
+        if is_not_found_payload(doc):
+            raise_cached_not_found(doc)
+        REDIS_DOC_STATS.hits += 1
+        payload = doc
+        doc = codec.decode(payload)
+        if use_local:
+            local_generations.set_local_doc(doc_key, doc, len(payload), epoch)
+        return doc
     else:
+        if CACHE_DOCS:
+            REDIS_DOC_STATS.misses += 1
         return None
+
+
+def _get_cached_docs_only(doc_ids):
+    """
+    Bulk version of _get_cached_doc_only: a single MGET for everything not in
+    the in-process tier. Returns a dict of doc_id -> doc for the cache hits,
+    with None for docs couch recently said don't exist.
+    """
+    if not CACHE_DOCS:
+        return {}
+
+    local_generations = broadcast.LOCAL_GENERATIONS
+    use_local = local_generations.local_docs_trusted()
+    found = {}
+    remote_keys = {}
+    for doc_id in doc_ids:
+        doc_key = key_doc_id(doc_id)
+        doc = get_local_doc(doc_key) if use_local else MISSING
+        if doc is not MISSING:
+            found[doc_id] = doc
+        else:
+            remote_keys[doc_key] = doc_id
+
+    if remote_keys:
+        epoch = local_generations.epoch
+        payloads = rcache().get_many(list(remote_keys))
+        for doc_key, doc_id in remote_keys.items():
+            payload = payloads.get(doc_key)
+            if is_not_found_payload(payload):
+                NOT_FOUND_DOC_STATS.hits += 1
+                found[doc_id] = None
+            elif payload:
+                REDIS_DOC_STATS.hits += 1
+                doc = codec.decode(payload)
+                if use_local:
+                    local_generations.set_local_doc(doc_key, doc, len(payload), epoch)
+                found[doc_id] = doc
+            else:
+                REDIS_DOC_STATS.misses += 1
+    return found
@@ -0,0 +1,178 @@
+"""
+Optional in-process LRU tier that sits in front of redis for cached docs.
+
+Entries are bounded by count, by the size of their redis payload and by a ttl.
+invalidate_doc and generation bumps in other processes reach this tier through
+the generation broadcast (see broadcast.py): entries are dropped as the
+messages arrive, and none are served while the listener is not subscribed.
+"""
+import threading
+import time
+from collections import OrderedDict
+from . import LOCAL_CACHE_DOCS, LOCAL_CACHE_MAX_ENTRIES, LOCAL_CACHE_MAX_BYTES, LOCAL_CACHE_TIMEOUT
+from .const import MISSING
+
+
+class CacheStats(object):
+    """
+    Hit/miss counters for one cache tier.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def as_dict(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+def copy_json(obj):
+    """
+    Copy a json-like structure. Much cheaper than copy.deepcopy and enough to
+    keep callers from mutating the copy that lives in the local tier.
+    """
+    if isinstance(obj, dict):
+        return dict((k, copy_json(v)) for k, v in obj.items())
+    elif isinstance(obj, list):
+        return [copy_json(v) for v in obj]
+    return obj
+
+
+class LocalLRUCache(object):
+    """
+    Thread safe LRU cache bounded by max_entries and max_bytes where every
+    entry lives at most timeout seconds.
+
+    Each entry can carry a tag (the doc_type for cached docs) so that all
+    entries of a tag can be dropped at once when its generation is bumped.
+    """
+
+    def __init__(self, max_entries=LOCAL_CACHE_MAX_ENTRIES, max_bytes=LOCAL_CACHE_MAX_BYTES,
+                 timeout=LOCAL_CACHE_TIMEOUT):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size_bytes(self):
+        return self._bytes
+
+    def get(self, key):
+        """
+        Return a copy of the cached value, or MISSING
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.stats.misses += 1
+                return MISSING
+            value, size, tag, expires = entry
+            if expires < time.time():
+                self._bytes -= size
+                self.stats.expirations += 1
+                self.stats.misses += 1
+                return MISSING
+            # re-insert to mark as most recently used
+            self._entries[key] = entry
+            self.stats.hits += 1
+        return copy_json(value)
+
+    def set(self, key, value, size, tag=None):
+        if size > self.max_bytes:
+            self.delete(key)
+            return
+        value = copy_json(value)
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (value, size, tag, time.time() + self.timeout)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size, _, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.stats.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def delete_tags(self, tags):
+        tags = set(tags)
+        if not tags:
+            return
+        with self._lock:
+            for key in [k for k, entry in self._entries.items() if entry[2] in tags]:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+
+# None unless COUCH_CACHE_LOCAL_DOCS is set; tests may swap in their own instance
+LOCAL_DOC_CACHE = LocalLRUCache() if LOCAL_CACHE_DOCS else None
+
+# counters for the redis tier of the doc cache
+REDIS_DOC_STATS = CacheStats()
+
+# counters for cached 404s: hits are 404s served from redis, misses are 404s from couch
+NOT_FOUND_DOC_STATS = CacheStats()
+
+
+def get_local_doc(key):
+    if LOCAL_DOC_CACHE is None:
+        return MISSING
+    return LOCAL_DOC_CACHE.get(key)
+
+
+def set_local_doc(key, doc, size):
+    if LOCAL_DOC_CACHE is not None and isinstance(doc, dict):
+        LOCAL_DOC_CACHE.set(key, doc, size, tag=doc.get('doc_type', None))
+
+
+def delete_local_doc(key):
+    if LOCAL_DOC_CACHE is not None:
+        LOCAL_DOC_CACHE.delete(key)
+
+
+def clear_local_docs():
+    if LOCAL_DOC_CACHE is not None:
+        LOCAL_DOC_CACHE.clear()
+
+
+def delete_local_doc_types(doc_types):
+    if LOCAL_DOC_CACHE is not None:
+        LOCAL_DOC_CACHE.delete_tags(doc_types)
+
+
+def doc_cache_stats():
+    """
+    Hit/miss counters of the local and redis tiers of the doc cache.
+    """
+    return {
+        'local': LOCAL_DOC_CACHE.stats.as_dict() if LOCAL_DOC_CACHE is not None else None,
+        'redis': REDIS_DOC_STATS.as_dict(),
+        'not_found': NOT_FOUND_DOC_STATS.as_dict(),
+    }
@@ -0,0 +1,39 @@
+"""
+Per view and per GenerationCache instrumentation of cached_view.
+
+Counters: cache_core.view.hits, .misses, .interrupted, .served_bytes (payloads of
+hits), .stored_bytes (payloads of fills), .oversize_skips, .chunked_fills
+Timings: cache_core.view.couch_latency, cache_core.view.redis_latency
+
+All are tagged with the view name and the GenerationCache class and go to the
+sink configured by COUCH_CACHE_METRICS_SINK (see dimagi.utils.metrics). The
+default in-memory sink is only visible to its own process; use
+RedisMetricsSink to read the counters of all processes with
+./manage.py cache_core_metrics.
+"""
+from dimagi.utils.metrics import load_metrics_sink
+from . import METRICS_SINK_CONFIG
+
+METRICS_SINK = load_metrics_sink(METRICS_SINK_CONFIG)
+
+VIEW_HITS = 'cache_core.view.hits'
+VIEW_MISSES = 'cache_core.view.misses'
+VIEW_INTERRUPTED = 'cache_core.view.interrupted'
+VIEW_SERVED_BYTES = 'cache_core.view.served_bytes'
+VIEW_STORED_BYTES = 'cache_core.view.stored_bytes'
+VIEW_OVERSIZE_SKIPS = 'cache_core.view.oversize_skips'
+VIEW_CHUNKED_FILLS = 'cache_core.view.chunked_fills'
+VIEW_COUCH_LATENCY = 'cache_core.view.couch_latency'
+VIEW_REDIS_LATENCY = 'cache_core.view.redis_latency'
+
+
+def view_tags(generation_cache, view_name):
+    return {'cache': generation_cache.__class__.__name__, 'view': view_name}
+
+
+def record_view(name, generation_cache, view_name, value=1):
+    METRICS_SINK.incr(name, value, view_tags(generation_cache, view_name))
+
+
+def time_view(name, generation_cache, view_name):
+    return METRICS_SINK.timer(name, view_tags(generation_cache, view_name))
@@ -0,0 +1,82 @@
+"""
+Size and ttl policy for cached_view payloads.
+
+A payload bigger than max_payload_size isn't cached at all: one huge value blocks
+redis while it's written and read, and evicts lots of small useful keys. A
+payload bigger than chunk_size is split over several keys, with a small
+manifest under the view key, and read back with one MGET.
+
+Defaults come from COUCH_CACHE_VIEW_MAX_PAYLOAD_SIZE and COUCH_CACHE_VIEW_CHUNK_SIZE.
+A GenerationCache subclass can override them, and the ttl, for all its views
+or per view:
+
+    class ReportCache(GenerationCache):
+        ...
+        max_payload_size = 4 * 1024 * 1024
+        view_policies = {
+            'reports/big_one': {'cache_expire': 600, 'chunk_size': 512 * 1024},
+        }
+
+A ttl set there wins over the cache_expire passed to cached_view.
+"""
+from . import rcache, VIEW_MAX_PAYLOAD_SIZE, VIEW_CHUNK_SIZE
+from .const import MISSING, CHUNKED_PREFIX
+
+CHUNK_SUFFIX = ':chunk:'
+POLICY_ATTRS = ('cache_expire', 'max_payload_size', 'chunk_size')
+
+
+class ViewCachePolicy(object):
+
+    def __init__(self, cache_expire=None, max_payload_size=VIEW_MAX_PAYLOAD_SIZE, chunk_size=VIEW_CHUNK_SIZE):
+        self.cache_expire = cache_expire
+        self.max_payload_size = max_payload_size
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def for_view(cls, generation_cache, view_name):
+        overrides = generation_cache.view_policies.get(view_name, {})
+        kwargs = {}
+        for attr in POLICY_ATTRS:
+            if attr in overrides:
+                kwargs[attr] = overrides[attr]
+            elif getattr(generation_cache, attr, None) is not None:
+                kwargs[attr] = getattr(generation_cache, attr)
+        return cls(**kwargs)
+
+    def expire(self, cache_expire):
+        return cache_expire if self.cache_expire is None else self.cache_expire
+
+    def too_big(self, payload):
+        return bool(self.max_payload_size) and len(payload) > self.max_payload_size
+
+    def payload_values(self, cache_view_key, payload):
+        """
+        return: the cache entries to write for payload, chunked if it's bigger than chunk_size
+        """
+        if not self.chunk_size or len(payload) <= self.chunk_size:
+            return {cache_view_key: payload}
+        chunks = [payload[i:i + self.chunk_size] for i in range(0, len(payload), self.chunk_size)]
+        values = dict((chunk_key(cache_view_key, i), chunk) for i, chunk in enumerate(chunks))
+        values[cache_view_key] = CHUNKED_PREFIX + str(len(chunks))
+        return values
+
+
+def chunk_key(cache_view_key, index):
+    return '%s%s%d' % (cache_view_key, CHUNK_SUFFIX, index)
+
+
+def is_chunked(payload):
+    return isinstance(payload, basestring) and payload.startswith(CHUNKED_PREFIX)
+
+
+def join_chunks(cache_view_key, manifest):
+    """
+    return: the full payload of a chunk manifest, MISSING if any chunk is gone
+    """
+    count = int(manifest[len(CHUNKED_PREFIX):])
+    keys = [chunk_key(cache_view_key, i) for i in range(count)]
+    chunks = rcache().get_many(keys)
+    if len(chunks) < count:
+        return MISSING
+    return ''.join(chunks[key] for key in keys)
@@ -0,0 +1,161 @@
+"""
+Client side sharding of the doc and view cache over several redis caches.
+
+    COUCH_CACHE_SHARDS = ['redis', 'redis_shard_1', 'redis_shard_2']
+
+lists the CACHES aliases to spread cached docs (#cached_doc_...) and cached
+views (<generation>:#cached_view_:...) over with a consistent hash ring, so
+adding or removing a shard only moves about 1/n of the keys. The first alias
+is the primary and must be 'redis', the cache get_redis_client() returns.
+Every other key the ShardedCache gets stays on the primary, in particular
+generation keys: a generation key moving to a shard that doesn't have it would
+restart from 0 and bring back old view entries. Locks, rate limits and the
+generation bump broadcasts don't go through the ShardedCache but use
+get_redis_client(), so with 'redis' as the primary they live on the same server
+as the generations they announce.
+
+Deletes of sharded keys go to every shard, so a doc key that moves to another
+shard and back never brings back a copy that was invalidated in between.
+
+Anything else taking a key must be routed with get_shard: other cache methods,
+like keys() or delete_pattern(), and the raw client aren't available on the
+ShardedCache.
+"""
+import bisect
+import hashlib
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from . import CACHED_DOC_PREFIX, CACHED_VIEW_PREFIX
+
+# points per shard on the ring, more points even out the key distribution
+RING_REPLICAS = 160
+
+# attributes that don't depend on the key, read from the primary
+PRIMARY_ATTRIBUTES = frozenset(['key_prefix', 'version', 'default_timeout'])
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode('utf-8') if isinstance(value, unicode) else value).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """
+    Maps keys to nodes, moving as few keys as possible when nodes are added or removed
+    """
+
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        self.nodes = list(nodes)
+        ring = sorted(
+            (_hash('%s-%s' % (node, i)), node)
+            for node in self.nodes
+            for i in range(replicas)
+        )
+        self._hashes = [point for point, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    def get_node(self, key):
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+def is_sharded_key(key):
+    return key.startswith(CACHED_DOC_PREFIX) or (':%s' % CACHED_VIEW_PREFIX) in key
+
+
+class ShardedCache(object):
+    """
+    The parts of the django cache api cache_core uses, spread over several caches.
+
+    shards: {name: django cache}
+    primary: name of the shard for everything that isn't a cached doc or view
+    """
+
+    def __init__(self, shards, primary):
+        self.shards = shards
+        self.primary = shards[primary]
+        self.ring = HashRing(sorted(shards))
+
+    def get_shard(self, key):
+        if is_sharded_key(key):
+            return self.shards[self.ring.get_node(key)]
+        return self.primary
+
+    def _group(self, keys):
+        groups = {}
+        for key in keys:
+            shard = self.get_shard(key)
+            groups.setdefault(id(shard), (shard, []))[1].append(key)
+        return groups.values()
+
+    def get(self, key, default=None, **kwargs):
+        return self.get_shard(key).get(key, default, **kwargs)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, **kwargs):
+        return self.get_shard(key).set(key, value, timeout=timeout, **kwargs)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, **kwargs):
+        return self.get_shard(key).add(key, value, timeout=timeout, **kwargs)
+
+    def incr(self, key, delta=1, **kwargs):
+        return self.get_shard(key).incr(key, delta, **kwargs)
+
+    def decr(self, key, delta=1, **kwargs):
+        return self.get_shard(key).decr(key, delta, **kwargs)
+
+    def has_key(self, key, **kwargs):
+        return self.get_shard(key).has_key(key, **kwargs)
+
+    def make_key(self, key, version=None):
+        return self.get_shard(key).make_key(key, version=version)
+
+    def ttl(self, key, **kwargs):
+        return self.get_shard(key).ttl(key, **kwargs)
+
+    def expire(self, key, timeout, **kwargs):
+        return self.get_shard(key).expire(key, timeout, **kwargs)
+
+    def persist(self, key, **kwargs):
+        return self.get_shard(key).persist(key, **kwargs)
+
+    def lock(self, key, **kwargs):
+        return self.get_shard(key).lock(key, **kwargs)
+
+    def get_many(self, keys, **kwargs):
+        values = {}
+        for shard, shard_keys in self._group(keys):
+            values.update(shard.get_many(shard_keys, **kwargs))
+        return values
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, **kwargs):
+        for shard, shard_keys in self._group(data):
+            shard.set_many(dict((key, data[key]) for key in shard_keys), timeout=timeout, **kwargs)
+
+    def delete(self, key, **kwargs):
+        if is_sharded_key(key):
+            for shard in self.shards.values():
+                shard.delete(key, **kwargs)
+        else:
+            self.primary.delete(key, **kwargs)
+
+    def delete_many(self, keys, **kwargs):
+        keys = list(keys)
+        sharded = [key for key in keys if is_sharded_key(key)]
+        unsharded = [key for key in keys if not is_sharded_key(key)]
+        if sharded:
+            for shard in self.shards.values():
+                shard.delete_many(sharded, **kwargs)
+        if unsharded:
+            self.primary.delete_many(unsharded, **kwargs)
+
+    def clear(self):
+        for shard in self.shards.values():
+            shard.clear()
+
+    def close(self, **kwargs):
+        for shard in self.shards.values():
+            shard.close(**kwargs)
+
+    def __getattr__(self, name):
+        if name in PRIMARY_ATTRIBUTES:
+            return getattr(self.primary, name)
+        # rather than quietly using the primary for keys that may live on another shard
+        raise AttributeError("%r is not supported by ShardedCache, use get_shard(key).%s" % (name, name))
@@ -0,0 +1,140 @@
+"""
+Stampede protection for cached_view.
+
+Single flight: on a miss only the worker that gets the short fill lock runs the
+view; the others poll for the key to be filled and run the view themselves
+if the lock holder gives up without filling it (it failed, or the payload was
+too big to cache) or if it doesn't show up within STAMPEDE_WAIT seconds.
+
+Early recomputation: with COUCH_CACHE_EARLY_RECOMPUTE_BETA > 0, a hit is
+occasionally treated as a miss shortly before the entry expires ("XFetch"),
+the closer to expiry and the slower the view, the likelier. Only the worker
+that gets the fill lock recomputes, everyone else keeps serving the old value.
+
+Both degrade to the plain behaviour when redis connections are interrupted.
+"""
+import math
+import random
+import time
+import uuid
+from django_redis.exceptions import ConnectionInterrupted
+from dimagi.utils.locks.multi import get_script
+from . import rcache, STAMPEDE_LOCK_TIMEOUT, STAMPEDE_WAIT, STAMPEDE_POLL_INTERVAL, EARLY_RECOMPUTE_BETA
+from .const import MISSING
+
+FILL_LOCK_SUFFIX = ':fill_lock'
+FILL_META_SUFFIX = ':fill_meta'
+
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class ViewFill(object):
+    """
+    The fill lock for one cached view key
+    """
+
+    def __init__(self, cache_view_key):
+        self.cache_view_key = cache_view_key
+        self.lock_key = cache_view_key + FILL_LOCK_SUFFIX
+        self.token = uuid.uuid4().hex
+        self.started = None
+
+    def acquire(self):
+        if rcache().add(self.lock_key, self.token, timeout=STAMPEDE_LOCK_TIMEOUT):
+            self.started = time.time()
+            return True
+        return False
+
+    def release(self):
+        """
+        Delete the lock if it's still ours, it may have timed out and been
+        taken by the next holder
+        """
+        cache = rcache()
+        if hasattr(cache, 'get_shard'):
+            cache = cache.get_shard(self.lock_key)
+        try:
+            if hasattr(cache, 'client') and hasattr(cache.client, 'get_client'):
+                # compare and delete in one step
+                get_script(cache.client.get_client(), RELEASE_SCRIPT)(
+                    keys=[cache.make_key(self.lock_key)], args=[cache.client.encode(self.token)])
+            elif cache.get(self.lock_key) == self.token:
+                cache.delete(self.lock_key)
+        except ConnectionInterrupted:
+            # it will time out on its own
+            pass
+
+    def wait(self):
+        """
+        Poll for the lock holder to fill the key, return its payload or MISSING
+        """
+        deadline = time.time() + STAMPEDE_WAIT
+        while time.time() < deadline:
+            time.sleep(STAMPEDE_POLL_INTERVAL)
+            values = rcache().get_many([self.cache_view_key, self.lock_key])
+            if self.cache_view_key in values:
+                return values[self.cache_view_key]
+            if self.lock_key not in values:
+                # the holder is done; it may have filled the key just after we read it
+                return rcache().get(self.cache_view_key, MISSING)
+        return MISSING
+
+    def fill_meta(self, cache_expire):
+        """
+        The extra cache entries to write along with the filled key
+        """
+        if EARLY_RECOMPUTE_BETA <= 0 or not cache_expire:
+            return {}
+        now = time.time()
+        return {
+            self.cache_view_key + FILL_META_SUFFIX: {
+                'delta': now - self.started,
+                'expires': now + cache_expire,
+            }
+        }
+
+
+def get_view_payload(cache_view_key):
+    """
+    Look up a cached view, along with its fill meta when early recomputation is on.
+
+    return: (payload or MISSING, meta or None)
+    """
+    if EARLY_RECOMPUTE_BETA <= 0:
+        return rcache().get(cache_view_key, MISSING), None
+    meta_key = cache_view_key + FILL_META_SUFFIX
+    values = rcache().get_many([cache_view_key, meta_key])
+    return values.get(cache_view_key, MISSING), values.get(meta_key)
+
+
+def should_recompute_early(meta, now=None):
+    if not meta or EARLY_RECOMPUTE_BETA <= 0:
+        return False
+    now = now or time.time()
+    # 1 - random() is in (0, 1], so log() is defined
+    return now - meta['delta'] * EARLY_RECOMPUTE_BETA * math.log(1 - random.random()) >= meta['expires']
+
+
+def single_flight(cache_view_key, payload, meta):
+    """
+    return: (payload, fill). payload is MISSING when the caller has to run the view,
+    fill is the ViewFill the caller holds (and has to release) if any.
+    """
+    if payload is not MISSING and not should_recompute_early(meta):
+        return payload, None
+    fill = ViewFill(cache_view_key)
+    try:
+        if payload is not MISSING:
+            if fill.acquire():
+                return MISSING, fill
+            return payload, None
+        if fill.acquire():
+            return MISSING, fill
+        return fill.wait(), None
+    except ConnectionInterrupted:
+        return payload, None
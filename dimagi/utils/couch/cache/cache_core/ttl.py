@@ -0,0 +1,101 @@
+"""
+Adaptive ttls for the views of GenerationCaches.
+
+A cached view is unreachable once its generation is bumped, so keeping it much
+longer than the time between bumps only wastes memory, while views of caches
+that hardly ever change could live much longer than COUCH_CACHE_TIMEOUT.
+
+With COUCH_CACHE_ADAPTIVE_TTL set, each process keeps track of how often the
+generation of each GenerationCache changes (bumps it does itself, and bumps by
+other processes it notices when reading the generation), and views are cached for
+
+    COUCH_CACHE_ADAPTIVE_TTL_FACTOR * max(average time between bumps, time since the last bump)
+
+clamped to COUCH_CACHE_ADAPTIVE_TTL_MIN and COUCH_CACHE_ADAPTIVE_TTL_MAX. Until
+this process has seen a cache bumped, its views keep the default ttl.
+
+Only views cached with the default COUCH_CACHE_TIMEOUT are adapted: views of
+GlobalCache, which are never invalidated, views cached_view was called with an
+explicit cache_expire for, and views with a ttl set through the GenerationCache
+view policy keep their ttl.
+"""
+import threading
+import time
+from . import ADAPTIVE_TTL_MIN, ADAPTIVE_TTL_MAX, ADAPTIVE_TTL_FACTOR
+
+# weight of the newest interval in the moving average
+SMOOTHING = 0.3
+
+
+class InvalidationTracker(object):
+    """
+    Moving average of the time between generation bumps of one GenerationCache
+    """
+
+    def __init__(self):
+        self.bumps = 0
+        self.last_bump = None
+        self.mean_interval = None
+        self._lock = threading.Lock()
+
+    def observe_bump(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            if self.last_bump is not None:
+                interval = now - self.last_bump
+                if self.mean_interval is None:
+                    self.mean_interval = interval
+                else:
+                    self.mean_interval = SMOOTHING * interval + (1 - SMOOTHING) * self.mean_interval
+            self.last_bump = now
+            self.bumps += 1
+
+    def ttl(self, default, now=None):
+        now = time.time() if now is None else now
+        if self.last_bump is None:
+            return default
+        ttl = ADAPTIVE_TTL_FACTOR * max(self.mean_interval or 0, now - self.last_bump)
+        return int(min(ADAPTIVE_TTL_MAX, max(ADAPTIVE_TTL_MIN, ttl)))
+
+
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+
+def get_tracker(generation_key):
+    if generation_key not in _trackers:
+        with _trackers_lock:
+            if generation_key not in _trackers:
+                _trackers[generation_key] = InvalidationTracker()
+    return _trackers[generation_key]
+
+
+def observe_bump(generation_key):
+    get_tracker(generation_key).observe_bump()
+
+
+def adaptive_ttl(generation_key, default):
+    return get_tracker(generation_key).ttl(default)
+
+
+def adaptive_ttls(default):
+    """
+    What this process currently knows, for inspection:
+
+    return: {generation_key: {'ttl', 'bumps', 'mean_interval', 'since_last_bump'}}
+    """
+    now = time.time()
+    report = {}
+    for generation_key, tracker in _trackers.items():
+        report[generation_key] = {
+            'ttl': tracker.ttl(default, now=now),
+            'bumps': tracker.bumps,
+            'mean_interval': tracker.mean_interval,
+            'since_last_bump': now - tracker.last_bump if tracker.last_bump is not None else None,
+        }
+    return report
+
+
+def reset():
+    with _trackers_lock:
+        _trackers.clear()
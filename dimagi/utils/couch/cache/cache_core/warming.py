@@ -0,0 +1,182 @@
+"""
+Pre-populating cached views, e.g. after a deploy or flush_caches.
+
+What to warm comes from a json config:
+
+    [
+        {"db": null, "view": "app/by_domain", "params": [{"key": "a"}, {"key": "b"}]},
+        {"db": "commcarehq__users", "view": "users/by_username", "params": {"reduce": false}}
+    ]
+
+where db is a couch database name (null for settings.COUCH_DATABASE), or from
+a recording: with COUCH_CACHE_RECORD_VIEWS set to a sample rate, cached_view
+counts requests in a redis sorted set, and the most requested ones are replayed.
+"""
+import logging
+import random
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+import simplejson
+from django.conf import settings
+from . import get_redis_client, COUCH_CACHE_TIMEOUT, RECORD_VIEWS, RECORD_VIEWS_MAX
+
+log = logging.getLogger(__name__)
+
+RECORDED_VIEWS_KEY = 'cache_core:recorded_views'
+# trim the recording to RECORD_VIEWS_MAX members on about one in this many writes
+TRIM_EVERY = 100
+
+# set while a ViewWarmer thread runs cached_view, so warming doesn't record itself
+_warming = threading.local()
+
+
+def _redis_client():
+    return get_redis_client().client.get_client()
+
+
+def compact_json(spec):
+    return simplejson.dumps(spec, sort_keys=True, separators=(',', ':'))
+
+
+def record_view_request(db, view_name, params, cache_expire=COUCH_CACHE_TIMEOUT):
+    if RECORD_VIEWS <= 0 or getattr(_warming, 'active', False) or random.random() >= RECORD_VIEWS:
+        return
+    try:
+        # params that don't serialize (datetimes, ...) can't be replayed anyway
+        member = compact_json({
+            'db': db.dbname,
+            'view': view_name,
+            'params': params,
+            'cache_expire': cache_expire,
+        })
+        pipeline = _redis_client().pipeline(transaction=False)
+        pipeline.zincrby(name=RECORDED_VIEWS_KEY, value=member, amount=1)
+        if random.randint(1, TRIM_EVERY) == 1:
+            pipeline.zremrangebyrank(RECORDED_VIEWS_KEY, 0, -RECORD_VIEWS_MAX - 1)
+        pipeline.execute()
+    except Exception:
+        # recording is best effort, never fail the view call over it
+        log.warning("Could not record cached view request", exc_info=True)
+
+
+def load_recorded_views(top):
+    """
+    return: view specs of the top most requested recorded views, most requested first
+    """
+    recorded = _redis_client().zrevrange(RECORDED_VIEWS_KEY, 0, top - 1)
+    return [simplejson.loads(member) for member in recorded]
+
+
+def clear_recorded_views():
+    _redis_client().delete(RECORDED_VIEWS_KEY)
+
+
+def load_view_config(path):
+    """
+    return: one view spec per param set in the json config at path
+    """
+    with open(path) as f:
+        config = simplejson.load(f)
+    specs = []
+    for entry in config:
+        param_sets = entry.get('params') or {}
+        if isinstance(param_sets, dict):
+            param_sets = [param_sets]
+        for params in param_sets:
+            specs.append({
+                'db': entry.get('db'),
+                'view': entry['view'],
+                'params': params,
+                'cache_expire': entry.get('cache_expire', COUCH_CACHE_TIMEOUT),
+            })
+    return specs
+
+
+def _db_postfixes():
+    """
+    couch database name -> get_db postfix
+    """
+    def db_name(url):
+        return url.rstrip('/').rsplit('/', 1)[1]
+
+    postfixes = {db_name(settings.COUCH_DATABASE): None}
+    for postfix, url in getattr(settings, 'EXTRA_COUCHDB_DATABASES', {}).items():
+        postfixes[db_name(url)] = postfix
+    return postfixes
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls to wait() across threads to at most rate per second, 0 for no limit
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class ViewWarmer(object):
+    """
+    Runs cached_view for view specs with at most concurrency calls in flight
+    and at most rate calls started per second.
+    """
+
+    def __init__(self, concurrency=4, rate=0):
+        self.concurrency = concurrency
+        self.rate_limiter = RateLimiter(rate)
+        self._dbs = {}
+        self._postfixes = None
+
+    def get_db(self, db_name):
+        from dimagi.utils.couch.database import get_db
+        if db_name not in self._dbs:
+            if db_name is None:
+                postfix = None
+            else:
+                if self._postfixes is None:
+                    self._postfixes = _db_postfixes()
+                postfix = self._postfixes[db_name]
+            self._dbs[db_name] = get_db(postfix)
+        return self._dbs[db_name]
+
+    def warm_one(self, spec):
+        """
+        return: (spec, seconds, error or None)
+        """
+        from .api import cached_view
+        self.rate_limiter.wait()
+        start = time.time()
+        _warming.active = True
+        try:
+            params = dict((str(k), v) for k, v in (spec.get('params') or {}).items())
+            cached_view(self.get_db(spec.get('db')), spec['view'],
+                        cache_expire=spec.get('cache_expire', COUCH_CACHE_TIMEOUT), **params)
+            error = None
+        except Exception as e:
+            error = e
+        finally:
+            _warming.active = False
+        return spec, time.time() - start, error
+
+    def warm(self, specs):
+        """
+        return: list of (spec, seconds, error or None) in the order the calls finished
+        """
+        pool = ThreadPool(self.concurrency)
+        try:
+            return list(pool.imap_unordered(self.warm_one, specs))
+        finally:
+            pool.close()
+            pool.join()
@@ -0,0 +1,185 @@
+"""
+Optional write-behind for doc cache fills.
+
+With COUCH_CACHE_WRITE_BEHIND set, do_cache_doc/do_cache_docs hand their
+payloads to a background thread which writes them in pipelined set_many batches,
+instead of doing one redis SET per doc inside the request.
+
+- the queue holds at most COUCH_CACHE_WRITE_BEHIND_MAX_PENDING keys; fills that
+  don't fit are dropped (counted, and logged now and then), it's only a cache
+- a key queued again before it's written only keeps its newest payload
+- invalidate_doc discards pending writes of its keys and waits for a batch in
+  flight, so a stale fill never lands after the invalidation
+- pending writes are flushed at interpreter exit
+- do_cache_doc/do_cache_docs delete the keys before queueing them, so a
+  not found marker can't keep answering for a doc that was just cached
+- a forked child starts with an empty queue and its own thread, the parent
+  writes what was pending at the fork
+"""
+from __future__ import absolute_import
+import atexit
+import logging
+import os
+import threading
+from collections import OrderedDict
+from . import rcache, WRITE_BEHIND, WRITE_BEHIND_MAX_PENDING, WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_INTERVAL
+
+log = logging.getLogger(__name__)
+
+
+class WriteBehindQueue(object):
+
+    def __init__(self, max_pending=WRITE_BEHIND_MAX_PENDING, batch_size=WRITE_BEHIND_BATCH_SIZE,
+                 interval=WRITE_BEHIND_INTERVAL):
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queued = 0
+        self.dropped = 0
+        self.written = 0
+        self.errors = 0
+        self._pid = os.getpid()
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+        # held while a batch is being written
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+
+    def _check_fork(self):
+        """
+        A forked child inherits the pending writes and the locks but not the
+        thread: the locks may be held by the parent's writer for good
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pending = OrderedDict()
+            self._condition = threading.Condition()
+            self._write_lock = threading.Lock()
+            self._thread = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, key, payload, timeout):
+        """
+        return: False if the write was dropped because the queue is full
+        """
+        self._check_fork()
+        with self._condition:
+            if key not in self._pending and len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return False
+            self._pending.pop(key, None)
+            self._pending[key] = (payload, timeout)
+            self.queued += 1
+            self._ensure_thread()
+            self._condition.notify()
+        return True
+
+    def discard(self, keys):
+        """
+        Forget pending writes of keys, and wait for the batch being written, if any.
+        """
+        self._check_fork()
+        with self._condition:
+            for key in keys:
+                self._pending.pop(key, None)
+        with self._write_lock:
+            pass
+
+    def flush(self):
+        """
+        Write everything pending in the calling thread.
+        """
+        self._check_fork()
+        while self._write_batch():
+            pass
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self.flush()
+
+    def stats(self):
+        return {
+            'pending': len(self._pending),
+            'queued': self.queued,
+            'dropped': self.dropped,
+            'written': self.written,
+            'errors': self.errors,
+        }
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='cache_core-write-behind')
+            self._thread.daemon = True
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+            # let a few more fills pile up so they share a round trip
+            self._condition_sleep()
+            self._write_batch()
+
+    def _condition_sleep(self):
+        with self._condition:
+            if len(self._pending) < self.batch_size and not self._stopped:
+                self._condition.wait(self.interval)
+
+    def _write_batch(self):
+        """
+        return: whether there was anything to write
+        """
+        with self._write_lock:
+            with self._condition:
+                if not self._pending:
+                    return False
+                batch = []
+                while self._pending and len(batch) < self.batch_size:
+                    batch.append(self._pending.popitem(last=False))
+            by_timeout = {}
+            for key, (payload, timeout) in batch:
+                by_timeout.setdefault(timeout, {})[key] = payload
+            try:
+                for timeout, values in by_timeout.items():
+                    rcache().set_many(values, timeout=timeout)
+                self.written += len(batch)
+            except Exception:
+                self.errors += 1
+                log.warning("Could not write %d cached docs", len(batch), exc_info=True)
+            return True
+
+
+# None unless COUCH_CACHE_WRITE_BEHIND is set; tests may swap in their own instance
+WRITE_BEHIND_QUEUE = WriteBehindQueue() if WRITE_BEHIND else None
+
+
+def write_behind_enabled():
+    return WRITE_BEHIND_QUEUE is not None
+
+
+def queue_write(key, payload, timeout):
+    """
+    return: False if write-behind is off, so the caller has to write itself
+    """
+    if WRITE_BEHIND_QUEUE is None:
+        return False
+    if not WRITE_BEHIND_QUEUE.put(key, payload, timeout):
+        dropped = WRITE_BEHIND_QUEUE.dropped
+        if dropped == 1 or dropped % 1000 == 0:
+            log.warning("Write-behind queue full (%d pending), %d cached doc writes dropped so far",
+                        len(WRITE_BEHIND_QUEUE), dropped)
+    return True
+
+
+def discard_writes(keys):
+    if WRITE_BEHIND_QUEUE is not None:
+        WRITE_BEHIND_QUEUE.discard(keys)
@@ -0,0 +1,8 @@
+"""
+Lock primitives on top of the redis cache, see multi.py, batch.py and watchdog.py.
+The lock helpers most code uses (CriticalSection, RedisLockableMixIn,
+acquire_lock/release_lock) live in dimagi.utils.couch.
+"""
+from .multi import MultiLock
+from .watchdog import keep_alive, stop_keep_alive
+from .batch import try_acquire_locks, release_locks
@@ -0,0 +1,546 @@
+"""
+Pluggable backends for locks and counters.
+
+CriticalSection, RedisLockableMixIn, rate_limit and load_balance take their
+locks and counters from the backend configured by LOCK_BACKEND, given like a
+metrics sink (see dimagi.utils.metrics) as a dotted path or a dict with a
+BACKEND path and OPTIONS:
+
+    LOCK_BACKEND = {
+        'BACKEND': 'dimagi.utils.locks.backends.FileLockBackend',
+        'OPTIONS': {'directory': '/var/run/myproject/locks'},
+    }
+
+RedisLockBackend, the default, is the only one that works across hosts.
+The others are for single node batch jobs, benchmarks and CI without redis:
+
+- MemoryLockBackend: locks and counters in process memory, so they only
+  exclude threads of one process
+- FileLockBackend: flock()ed files in a directory, so they exclude processes
+  on one host. A file lock is held until it's released or its holder dies,
+  lock timeouts are not enforced
+
+Backends also implement the rate limiter of dimagi.utils.rate_limit, in one of
+two modes:
+
+- FIXED_WINDOW: at most actions_allowed actions per how_often seconds window,
+  the window starting with its first action
+- GCRA: the generic cell rate algorithm, a sliding window that lets one action
+  through every how_often / actions_allowed seconds, with bursts of up to
+  actions_allowed actions after a quiet period
+"""
+from __future__ import absolute_import
+import errno
+import hashlib
+import importlib
+import os
+import random
+import threading
+import time
+import uuid
+from collections import namedtuple
+from django.conf import settings
+from redis.exceptions import LockError
+from .batch import try_acquire_locks, release_locks
+from .multi import MultiLock, get_script
+
+FIXED_WINDOW = 'fixed-window'
+GCRA = 'gcra'
+
+# retry_after is in seconds
+RateLimitResult = namedtuple('RateLimitResult', 'allowed remaining retry_after')
+
+FIXED_WINDOW_SCRIPT = """
+local count = redis.call('incr', KEYS[1])
+local ttl = redis.call('pttl', KEYS[1])
+if ttl < 0 then
+    redis.call('pexpire', KEYS[1], ARGV[2])
+    ttl = tonumber(ARGV[2])
+end
+local limit = tonumber(ARGV[1])
+if count <= limit then
+    return {1, limit - count, 0}
+end
+return {0, 0, ttl}
+"""
+
+# the key holds the theoretical arrival time (tat) of the next action, in ms
+# of the redis server's clock, so clients with skewed clocks share the limit.
+# Writing after TIME needs effects replication (redis >= 3.2, the default from 5)
+GCRA_SCRIPT = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local limit = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+local server_time = redis.call('time')
+local now = tonumber(server_time[1]) * 1000 + math.floor(tonumber(server_time[2]) / 1000)
+local interval = period / limit
+local tat = math.max(tonumber(redis.call('get', KEYS[1]) or now), now)
+local new_tat = tat + interval
+local allow_at = new_tat - period
+if now < allow_at then
+    return {0, 0, math.ceil(allow_at - now)}
+end
+redis.call('set', KEYS[1], new_tat, 'px', math.ceil(new_tat - now))
+return {1, math.floor((now - allow_at) / interval), 0}
+"""
+
+
+def gcra(tat, now, actions_allowed, how_often):
+    """
+    One GCRA step, like GCRA_SCRIPT, with times in seconds.
+
+    tat: the stored theoretical arrival time, None if there is none
+    return: RateLimitResult, the tat to store (None to leave it)
+    """
+    interval = float(how_often) / actions_allowed
+    new_tat = max(tat or now, now) + interval
+    allow_at = new_tat - how_often
+    if now < allow_at:
+        return RateLimitResult(False, 0, allow_at - now), None
+    return RateLimitResult(True, int((now - allow_at) / interval), 0), new_tat
+
+
+class LockBackend(object):
+
+    def lock(self, key, timeout):
+        """
+        return: an unacquired lock on key, expiring timeout seconds after it's
+        acquired, with the redis-py Lock methods acquire(blocking, blocking_timeout),
+        release() and extend()
+        """
+        raise NotImplementedError()
+
+    def multi_lock(self, keys, timeout):
+        """
+        return: an unacquired lock on all of keys at once, like a MultiLock
+        """
+        raise NotImplementedError()
+
+    def try_acquire_locks(self, locks):
+        """
+        Try to take each lock once without blocking.
+
+        return: the locks that were acquired, in order
+        """
+        return [lock for lock in locks if lock.acquire(blocking=False)]
+
+    def release_locks(self, locks):
+        """
+        Release every lock, raising LockError afterwards if any was no longer held
+        """
+        lost = 0
+        for lock in locks:
+            try:
+                lock.release()
+            except LockError:
+                lost += 1
+        if lost:
+            raise LockError("%d of %d locks were no longer owned when released" % (lost, len(locks)))
+
+    def incr(self, key, timeout=None):
+        """
+        Increment the counter at key, starting from 0. If timeout is given and
+        the counter doesn't expire yet, it expires timeout seconds from now.
+
+        return: the new value
+        """
+        raise NotImplementedError()
+
+    def ttl(self, key):
+        """
+        return: seconds until the counter at key expires, -1 if it doesn't
+        expire and -2 if it doesn't exist
+        """
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def rate_limit(self, key, actions_allowed, how_often, mode=FIXED_WINDOW):
+        """
+        Count an action against the rate limit at key.
+
+        return: RateLimitResult
+        """
+        if mode == GCRA:
+            return self._gcra(key, actions_allowed, how_often)
+        if mode != FIXED_WINDOW:
+            raise ValueError("Unknown rate limit mode %r" % mode)
+        value = self.incr(key, timeout=how_often)
+        if value <= actions_allowed:
+            return RateLimitResult(True, actions_allowed - value, 0)
+        return RateLimitResult(False, 0, max(0, self.ttl(key)))
+
+    def _gcra(self, key, actions_allowed, how_often):
+        raise NotImplementedError()
+
+
+class RedisLockBackend(LockBackend):
+
+    def _cache(self):
+        from dimagi.utils.couch.cache.cache_core import get_redis_client
+        return get_redis_client()
+
+    def _client(self):
+        # We need access to the raw redis client because calling incr on
+        # a django_redis RedisCache object raises an error if the key
+        # doesn't exist.
+        return self._cache().client.get_client()
+
+    def lock(self, key, timeout):
+        lock = self._cache().lock(key, timeout=timeout)
+        # lock.name is the made key, keep the key for the lock metrics
+        lock.lock_key = key
+        return lock
+
+    def multi_lock(self, keys, timeout):
+        return MultiLock(self._cache(), keys, timeout=timeout)
+
+    def try_acquire_locks(self, locks):
+        return try_acquire_locks(locks)
+
+    def release_locks(self, locks):
+        release_locks(locks)
+
+    def incr(self, key, timeout=None):
+        client = self._client()
+
+        # If they key doesn't exist (or already expired), redis sets the value
+        # to 0 before incrementing.
+        value = client.incr(key)
+
+        if timeout is not None and (value == 1 or client.ttl(key) == -1):
+            # Set the key's expiration if it's the first increment. As a
+            # precaution, we also check to make sure that the key actually has
+            # an expiration set in case an error occurred the first time we tried
+            # to set the expiration. If it doesn't have an expiration (ttl == -1),
+            # then we'll set it here again.
+            client.expire(key, timeout)
+        return value
+
+    def ttl(self, key):
+        return self._client().ttl(key)
+
+    def delete(self, key):
+        self._client().delete(key)
+
+    def rate_limit(self, key, actions_allowed, how_often, mode=FIXED_WINDOW):
+        """
+        One script call, so one round trip, whatever the mode
+        """
+        client = self._client()
+        if mode == FIXED_WINDOW:
+            script = get_script(client, FIXED_WINDOW_SCRIPT)
+        elif mode == GCRA:
+            script = get_script(client, GCRA_SCRIPT)
+        else:
+            raise ValueError("Unknown rate limit mode %r" % mode)
+        allowed, remaining, retry_after = script(keys=[key], args=[actions_allowed, int(how_often * 1000)])
+        return RateLimitResult(bool(allowed), remaining, retry_after / 1000.0)
+
+
+class MemoryLock(object):
+    """
+    A lock on one or more keys of a MemoryLockBackend
+    """
+
+    def __init__(self, backend, keys, timeout):
+        self.backend = backend
+        self.keys = sorted(set(keys))
+        self.name = self.keys[0] if len(self.keys) == 1 else None
+        self.timeout = timeout
+        self.token = None
+
+    def _free(self, now):
+        locks = self.backend._locks
+        return all(key not in locks or locks[key][1] <= now for key in self.keys)
+
+    def acquire(self, blocking=True, blocking_timeout=None):
+        deadline = None if blocking_timeout is None else time.time() + blocking_timeout
+        with self.backend._condition:
+            while True:
+                now = time.time()
+                if self._free(now):
+                    self.token = uuid.uuid4().hex
+                    expires = now + self.timeout if self.timeout else float('inf')
+                    for key in self.keys:
+                        self.backend._locks[key] = (self.token, expires)
+                    return True
+                if not blocking or (deadline is not None and now >= deadline):
+                    return False
+                # wake up when the first of the blocking locks expires, at the latest
+                wait = min(self.backend._locks[key][1] for key in self.keys if key in self.backend._locks) - now
+                if deadline is not None:
+                    wait = min(wait, deadline - now)
+                self.backend._condition.wait(max(0.001, min(wait, 1)))
+
+    def _owned(self, now):
+        locks = self.backend._locks
+        return [key for key in self.keys
+                if key in locks and locks[key][0] == self.token and locks[key][1] > now]
+
+    def release(self):
+        if self.token is None:
+            raise LockError("Cannot release an unlocked lock")
+        with self.backend._condition:
+            owned = self._owned(time.time())
+            for key in owned:
+                del self.backend._locks[key]
+            self.token = None
+            self.backend._condition.notify_all()
+        if len(owned) != len(self.keys):
+            raise LockError("%d of %d lock keys were no longer owned when released" % (
+                len(self.keys) - len(owned), len(self.keys)))
+
+    def extend(self, timeout=None):
+        """
+        return: whether all keys were still held
+        """
+        if self.token is None:
+            raise LockError("Cannot extend an unlocked lock")
+        timeout = self.timeout if timeout is None else timeout
+        with self.backend._condition:
+            now = time.time()
+            owned = self._owned(now)
+            for key in owned:
+                self.backend._locks[key] = (self.token, now + timeout)
+        return len(owned) == len(self.keys)
+
+
+class MemoryLockBackend(LockBackend):
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        # {key: (token, expires)}
+        self._locks = {}
+        # {key: (value, expires or None)}
+        self._counters = {}
+        # {key: GCRA theoretical arrival time}
+        self._tats = {}
+
+    def lock(self, key, timeout):
+        return MemoryLock(self, [key], timeout)
+
+    def multi_lock(self, keys, timeout):
+        return MemoryLock(self, keys, timeout)
+
+    def _counter(self, key, now):
+        value, expires = self._counters.get(key, (0, None))
+        if expires is not None and expires <= now:
+            return 0, None
+        return value, expires
+
+    def incr(self, key, timeout=None):
+        with self._condition:
+            now = time.time()
+            value, expires = self._counter(key, now)
+            if timeout is not None and expires is None:
+                expires = now + timeout
+            self._counters[key] = (value + 1, expires)
+            return value + 1
+
+    def ttl(self, key):
+        with self._condition:
+            now = time.time()
+            value, expires = self._counter(key, now)
+            if not value:
+                return -2
+            return -1 if expires is None else int(round(expires - now))
+
+    def delete(self, key):
+        with self._condition:
+            self._counters.pop(key, None)
+            self._tats.pop(key, None)
+
+    def _gcra(self, key, actions_allowed, how_often):
+        with self._condition:
+            result, tat = gcra(self._tats.get(key), time.time(), actions_allowed, how_often)
+            if tat is not None:
+                self._tats[key] = tat
+            return result
+
+
+class FileLock(object):
+    """
+    A lock on one or more keys of a FileLockBackend
+    """
+
+    def __init__(self, backend, keys, timeout, sleep=0.01, max_sleep=0.1):
+        self.backend = backend
+        self.keys = sorted(set(keys))
+        self.name = self.keys[0] if len(self.keys) == 1 else None
+        self.timeout = timeout
+        self.sleep = sleep
+        self.max_sleep = max_sleep
+        self._files = None
+
+    def _attempt(self):
+        files = []
+        for key in self.keys:
+            f = self.backend._open(key, 'lock')
+            if not self.backend._flock(f, blocking=False):
+                f.close()
+                for taken in files:
+                    taken.close()
+                return False
+            files.append(f)
+        self._files = files
+        return True
+
+    def acquire(self, blocking=True, blocking_timeout=None):
+        deadline = None if blocking_timeout is None else time.time() + blocking_timeout
+        attempt = 0
+        while not self._attempt():
+            if not blocking:
+                return False
+            sleep = min(self.max_sleep, self.sleep * 2 ** attempt) * random.uniform(0.5, 1)
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                sleep = min(sleep, remaining)
+            time.sleep(sleep)
+            attempt += 1
+        return True
+
+    def release(self):
+        if self._files is None:
+            raise LockError("Cannot release an unlocked lock")
+        files, self._files = self._files, None
+        for f in files:
+            # closing the file drops the flock
+            f.close()
+
+    def extend(self, timeout=None):
+        if self._files is None:
+            raise LockError("Cannot extend an unlocked lock")
+        return True
+
+
+class FileLockBackend(LockBackend):
+    """
+    directory: where to keep the lock and counter files, created if needed
+    """
+
+    def __init__(self, directory):
+        import fcntl
+        self._fcntl = fcntl
+        self.directory = directory
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _open(self, key, kind):
+        name = '%s.%s' % (hashlib.sha1(key.encode('utf-8') if isinstance(key, unicode) else key).hexdigest(), kind)
+        return open(os.path.join(self.directory, name), 'a+')
+
+    def _flock(self, f, blocking=True):
+        flags = self._fcntl.LOCK_EX if blocking else self._fcntl.LOCK_EX | self._fcntl.LOCK_NB
+        try:
+            self._fcntl.flock(f.fileno(), flags)
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        return True
+
+    def lock(self, key, timeout):
+        return FileLock(self, [key], timeout)
+
+    def multi_lock(self, keys, timeout):
+        return FileLock(self, keys, timeout)
+
+    def _read_counter(self, f, now):
+        f.seek(0)
+        try:
+            value, expires = f.read().split()
+            value, expires = int(value), float(expires)
+        except ValueError:
+            return 0, None
+        if expires >= 0 and expires <= now:
+            return 0, None
+        return value, expires if expires >= 0 else None
+
+    def _write_counter(self, f, value, expires):
+        f.seek(0)
+        f.truncate()
+        f.write('%d %r' % (value, -1.0 if expires is None else expires))
+        f.flush()
+
+    def incr(self, key, timeout=None):
+        with self._open(key, 'counter') as f:
+            self._flock(f)
+            now = time.time()
+            value, expires = self._read_counter(f, now)
+            if timeout is not None and expires is None:
+                expires = now + timeout
+            self._write_counter(f, value + 1, expires)
+            return value + 1
+
+    def ttl(self, key):
+        with self._open(key, 'counter') as f:
+            self._flock(f)
+            now = time.time()
+            value, expires = self._read_counter(f, now)
+            if not value:
+                return -2
+            return -1 if expires is None else int(round(expires - now))
+
+    def delete(self, key):
+        for kind in ('counter', 'gcra'):
+            with self._open(key, kind) as f:
+                self._flock(f)
+                f.truncate(0)
+
+    def _gcra(self, key, actions_allowed, how_often):
+        with self._open(key, 'gcra') as f:
+            self._flock(f)
+            f.seek(0)
+            try:
+                tat = float(f.read())
+            except ValueError:
+                tat = None
+            result, tat = gcra(tat, time.time(), actions_allowed, how_often)
+            if tat is not None:
+                f.seek(0)
+                f.truncate()
+                f.write(repr(tat))
+                f.flush()
+            return result
+
+
+_backend = None
+_backend_config = None
+_backend_lock = threading.Lock()
+
+
+def load_lock_backend(config):
+    """
+    config: None, a dotted path to a LockBackend class or {'BACKEND': path, 'OPTIONS': {...}}
+    """
+    if not config:
+        return RedisLockBackend()
+    if isinstance(config, dict):
+        path, options = config['BACKEND'], config.get('OPTIONS', {})
+    else:
+        path, options = config, {}
+    mod_path, class_name = path.rsplit('.', 1)
+    return getattr(importlib.import_module(mod_path), class_name)(**options)
+
+
+def get_lock_backend():
+    """
+    The backend configured by LOCK_BACKEND, shared by the whole process
+    """
+    global _backend, _backend_config
+    config = getattr(settings, 'LOCK_BACKEND', None)
+    if _backend is None or config != _backend_config:
+        with _backend_lock:
+            if _backend is None or config != _backend_config:
+                _backend = load_lock_backend(config)
+                _backend_config = config
+    return _backend
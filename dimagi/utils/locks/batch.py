@@ -0,0 +1,61 @@
+"""
+Taking and releasing many independent redis-py locks in one round trip.
+
+Unlike a MultiLock, which locks all of its keys or none, try_acquire_locks
+takes whichever of the locks are free: it's meant for batch jobs that
+process what they could lock and leave the rest for later. The locks stay
+ordinary redis-py Lock objects (the ones client.lock() returns), so each can
+also be released on its own.
+"""
+import uuid
+from redis.exceptions import LockError
+from .multi import RELEASE_SCRIPT, get_script
+
+
+def _by_client(locks):
+    groups = {}
+    for lock in locks:
+        groups.setdefault(id(lock.redis), (lock.redis, []))[1].append(lock)
+    return groups.values()
+
+
+def try_acquire_locks(locks):
+    """
+    Try to take each lock once, without blocking, with one pipelined SET NX
+    per redis client.
+
+    return: the locks that were acquired, in order
+    """
+    token = uuid.uuid1().hex
+    acquired = set()
+    for client, group in _by_client(locks):
+        pipe = client.pipeline(transaction=False)
+        for lock in group:
+            pipe.set(lock.name, token, nx=True,
+                     px=int(lock.timeout * 1000) if lock.timeout else None)
+        for lock, ok in zip(group, pipe.execute()):
+            if ok:
+                lock.local.token = token
+                acquired.add(id(lock))
+    return [lock for lock in locks if id(lock) in acquired]
+
+
+def release_locks(locks):
+    """
+    Release acquired locks with one script call per redis client and token.
+    Raises LockError if any of them was no longer held, e.g. because it timed
+    out; the others are released all the same.
+    """
+    if any(lock.local.token is None for lock in locks):
+        raise LockError("Cannot release an unlocked lock")
+    lost = 0
+    for client, group in _by_client(locks):
+        by_token = {}
+        for lock in group:
+            token, lock.local.token = lock.local.token, None
+            by_token.setdefault(token, []).append(lock.name)
+        release = get_script(client, RELEASE_SCRIPT)
+        for token, names in by_token.items():
+            lost += len(names) - release(keys=names, args=[token])
+    if lost:
+        raise LockError("%d of %d locks were no longer owned when released" % (lost, len(locks)))
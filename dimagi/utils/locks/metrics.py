@@ -0,0 +1,92 @@
+"""
+Lock contention instrumentation.
+
+acquire_lock, release_lock, CriticalSection and get_locked_obj (through
+acquire_lock and release_lock) report, tagged with the lock key prefix:
+
+Counters: locks.acquired, locks.contended (the lock was held by someone else
+at the first attempt), locks.not_acquired, locks.expired_before_release (the
+lock timed out before it was released, so its timeout is too small)
+Timings: locks.wait (time spent acquiring), locks.hold (time from acquire to release)
+
+The key prefix is the lock key up to its first part that looks like an id
+(see lock_key_prefix), e.g. redis-object-lock-CommCareCase for
+redis-object-lock-CommCareCase-<case id>. Metrics go to the sink configured by
+REDIS_LOCK_METRICS_SINK (see dimagi.utils.metrics), in memory by default;
+with a RedisMetricsSink, ./manage.py lock_metrics dumps those of all processes.
+"""
+import re
+import time
+from django.conf import settings
+from dimagi.utils.metrics import load_metrics_sink
+
+METRICS_SINK = load_metrics_sink(getattr(settings, 'REDIS_LOCK_METRICS_SINK', None))
+
+LOCKS_ACQUIRED = 'locks.acquired'
+LOCKS_CONTENDED = 'locks.contended'
+LOCKS_NOT_ACQUIRED = 'locks.not_acquired'
+LOCKS_EXPIRED = 'locks.expired_before_release'
+LOCKS_WAIT = 'locks.wait'
+LOCKS_HOLD = 'locks.hold'
+
+_separator = re.compile(r'([-:_/.])')
+_id_like = re.compile(r'\d|^[0-9a-f]{16,}$', re.I)
+# the <key prefix>:<version>: the django cache's make_key puts in front of keys
+_cache_key_prefix = re.compile(r'^[^:]*:\d+:')
+
+
+def lock_key_prefix(key):
+    """
+    >>> lock_key_prefix('redis-object-lock-Patient-fa98e2c1')
+    'redis-object-lock-Patient'
+    >>> lock_key_prefix('sync-user-lock')
+    'sync-user-lock'
+    """
+    parts = _separator.split(key)
+    for i in range(0, len(parts), 2):
+        if _id_like.search(parts[i]):
+            return ''.join(parts[:max(0, i - 1)]) or '*'
+    return key
+
+
+def lock_keys(lock):
+    """
+    return: the keys of a redis-py Lock, MultiLock or anything with a name
+    """
+    keys = getattr(lock, 'keys', None)
+    if isinstance(keys, list):
+        return keys
+    key = getattr(lock, 'lock_key', None)
+    if isinstance(key, basestring):
+        return [key]
+    name = getattr(lock, 'name', None)
+    if not isinstance(name, basestring):
+        return ['unknown']
+    # the name of a lock from cache.lock() is the made key
+    return [_cache_key_prefix.sub('', name)]
+
+
+def _prefixes(lock):
+    return sorted(set(lock_key_prefix(key) for key in lock_keys(lock)))
+
+
+def record_acquire(lock, acquired, wait, contended):
+    for prefix in _prefixes(lock):
+        tags = {'prefix': prefix}
+        METRICS_SINK.timing(LOCKS_WAIT, wait, tags)
+        if contended:
+            METRICS_SINK.incr(LOCKS_CONTENDED, tags=tags)
+        METRICS_SINK.incr(LOCKS_ACQUIRED if acquired else LOCKS_NOT_ACQUIRED, tags=tags)
+    if acquired:
+        lock._lock_acquired_at = time.time()
+
+
+def record_release(lock, expired):
+    acquired_at = getattr(lock, '_lock_acquired_at', None)
+    lock._lock_acquired_at = None
+    for prefix in _prefixes(lock):
+        tags = {'prefix': prefix}
+        if acquired_at is not None:
+            METRICS_SINK.timing(LOCKS_HOLD, time.time() - acquired_at, tags)
+        if expired:
+            METRICS_SINK.incr(LOCKS_EXPIRED, tags=tags)
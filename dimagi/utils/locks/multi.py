@@ -0,0 +1,164 @@
+"""
+Locks on several redis keys at once.
+
+All keys are taken in one Lua script, so either every key is locked or none
+is: there is no partial acquisition that can deadlock with another caller
+taking the same keys in a different order, and one attempt is one round trip.
+Keys are stored the way redis-py's Lock stores them (a token with a PX
+expiry, under the django-redis key), so a MultiLock and a single key
+client.lock() on the same key exclude each other.
+"""
+import random
+import threading
+import time
+import uuid
+import weakref
+from redis.exceptions import LockError
+
+ACQUIRE_SCRIPT = """
+for i, key in ipairs(KEYS) do
+    if redis.call('exists', key) == 1 then
+        return 0
+    end
+end
+for i, key in ipairs(KEYS) do
+    redis.call('set', key, ARGV[1], 'px', ARGV[2])
+end
+return 1
+"""
+
+RELEASE_SCRIPT = """
+local released = 0
+for i, key in ipairs(KEYS) do
+    if redis.call('get', key) == ARGV[1] then
+        redis.call('del', key)
+        released = released + 1
+    end
+end
+return released
+"""
+
+EXTEND_SCRIPT = """
+local extended = 0
+for i, key in ipairs(KEYS) do
+    if redis.call('get', key) == ARGV[1] then
+        redis.call('pexpire', key, ARGV[2])
+        extended = extended + 1
+    end
+end
+return extended
+"""
+
+_scripts = weakref.WeakKeyDictionary()
+_scripts_lock = threading.Lock()
+
+
+def get_script(client, source):
+    """
+    The Script for source registered with a raw redis client, registered once
+    per client (hashing the source on every call isn't free)
+    """
+    try:
+        return _scripts[client][source]
+    except KeyError:
+        with _scripts_lock:
+            scripts = _scripts.setdefault(client, {})
+            if source not in scripts:
+                scripts[source] = client.register_script(source)
+            return scripts[source]
+
+
+class MultiLock(object):
+    """
+    cache: the django-redis cache, e.g. get_redis_client()
+    keys: lock keys, in any order
+    timeout: seconds until the keys expire on their own
+    sleep, max_sleep: seconds between attempts start at sleep and double up to
+    max_sleep, each randomly shortened by up to half so waiters spread out
+    """
+
+    def __init__(self, cache, keys, timeout=60, sleep=0.1, max_sleep=1.0):
+        self.cache = cache
+        self.keys = sorted(set(keys))
+        self.redis_keys = [cache.make_key(key) for key in self.keys]
+        self.timeout = timeout
+        self.sleep = sleep
+        self.max_sleep = max_sleep
+        self.token = None
+        self._client = cache.client.get_client()
+
+    def _script(self, script):
+        return get_script(self._client, script)
+
+    def _attempt(self):
+        token = uuid.uuid4().hex
+        acquired = self._script(ACQUIRE_SCRIPT)(
+            keys=self.redis_keys, args=[token, int(self.timeout * 1000)])
+        if acquired:
+            self.token = token
+        return bool(acquired)
+
+    def backoff(self, attempt):
+        return min(self.max_sleep, self.sleep * 2 ** attempt) * random.uniform(0.5, 1)
+
+    def acquire(self, blocking=True, blocking_timeout=None):
+        """
+        return: whether all keys were locked. With blocking, keep trying for at
+        most blocking_timeout seconds (None to wait for ever).
+        """
+        if not self.keys:
+            self.token = uuid.uuid4().hex
+            return True
+        deadline = time.time() + blocking_timeout if blocking_timeout is not None else None
+        attempt = 0
+        while True:
+            if self._attempt():
+                return True
+            if not blocking:
+                return False
+            sleep = self.backoff(attempt)
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                sleep = min(sleep, remaining)
+            time.sleep(sleep)
+            attempt += 1
+
+    def release(self):
+        """
+        Release every key in one round trip. Raises LockError if any of them
+        was no longer ours, e.g. because the lock timed out.
+        """
+        if self.token is None:
+            raise LockError("Cannot release an unlocked lock")
+        token, self.token = self.token, None
+        if not self.redis_keys:
+            return
+        released = self._script(RELEASE_SCRIPT)(keys=self.redis_keys, args=[token])
+        if released != len(self.redis_keys):
+            raise LockError("%d of %d lock keys were no longer owned when released" % (
+                len(self.redis_keys) - released, len(self.redis_keys)))
+
+    def extend(self, timeout=None):
+        """
+        Reset the expiry of every key still held to timeout (default: the lock's timeout).
+
+        return: whether all keys were still held
+        """
+        if self.token is None:
+            raise LockError("Cannot extend an unlocked lock")
+        if not self.redis_keys:
+            return True
+        timeout = self.timeout if timeout is None else timeout
+        extended = self._script(EXTEND_SCRIPT)(
+            keys=self.redis_keys, args=[self.token, int(timeout * 1000)])
+        return extended == len(self.redis_keys)
+
+    def __enter__(self):
+        if not self.acquire():
+            raise LockError("Unable to acquire lock")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
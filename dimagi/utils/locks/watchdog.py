@@ -0,0 +1,164 @@
+"""
+Lease renewal for long critical sections.
+
+Instead of a lock timeout long enough for the slowest task (which keeps the
+lock blocked for that long when a worker dies), take the lock with a short
+ttl and let the watchdog thread keep extending it while the holder is alive:
+
+    lock = acquire_lock(client.lock(key, timeout=30), degrade_gracefully)
+    keep_alive(lock, 30, on_lost=log_lost_lock)
+    ...
+    release_lock(lock, degrade_gracefully)  # also stops the renewals
+
+The lock is extended to its full ttl every ttl / 3 seconds. If the holder dies
+the lock frees within ttl seconds. If a renewal fails (the key expired or is
+someone else's by now, or redis is unreachable) the lease is dropped and its
+on_lost callback is called with the lock and the error, if any.
+"""
+from __future__ import absolute_import
+import logging
+import os
+import threading
+import time
+from redis.exceptions import RedisError
+from .multi import MultiLock, EXTEND_SCRIPT, get_script
+
+log = logging.getLogger(__name__)
+
+# never renew more often than this, whatever the ttl
+MIN_RENEW_INTERVAL = 0.5
+
+
+def _renewer(lock, ttl):
+    """
+    return: callable extending lock to ttl, returning whether it was still held
+    """
+    if isinstance(lock, MultiLock) or getattr(lock, 'redis', None) is None:
+        # MultiLock and the locks of the other lock backends extend to a ttl
+        return lambda: lock.extend(ttl)
+    # a redis-py Lock, whose extend adds to the ttl instead. Its token is
+    # thread local by default, so grab it now, in the holder's thread
+    token = lock.local.token
+    script = get_script(lock.redis, EXTEND_SCRIPT)
+    return lambda: script(keys=[lock.name], args=[token, int(ttl * 1000)]) == 1
+
+
+class Lease(object):
+
+    def __init__(self, lock, ttl, on_lost=None):
+        self.lock = lock
+        self.ttl = ttl
+        self.interval = max(MIN_RENEW_INTERVAL, ttl / 3.0)
+        self.on_lost = on_lost
+        self.renewals = 0
+        self.lost = False
+        self.next_renewal = time.time() + self.interval
+        self._renew = _renewer(lock, ttl)
+
+    def renew(self):
+        """
+        return: (whether the lock is still held, the RedisError if renewing failed)
+        """
+        try:
+            held = self._renew()
+        except RedisError as e:
+            return False, e
+        if held:
+            self.renewals += 1
+            self.next_renewal = time.time() + self.interval
+        return held, None
+
+    def mark_lost(self, error=None):
+        self.lost = True
+        log.warning("Lost lock %r, it could not be renewed", getattr(self.lock, 'name', self.lock), exc_info=error)
+        if self.on_lost is not None:
+            try:
+                self.on_lost(self.lock, error)
+            except Exception:
+                log.exception("lock lost callback failed")
+
+
+class LockWatchdog(object):
+
+    def __init__(self):
+        self._pid = os.getpid()
+        self._leases = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def _check_fork(self):
+        """
+        A forked child inherits the parent's leases, which the parent keeps
+        renewing, but not the thread renewing them
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._leases = {}
+            self._condition = threading.Condition()
+            self._thread = None
+
+    def keep_alive(self, lock, ttl, on_lost=None):
+        self._check_fork()
+        lease = Lease(lock, ttl, on_lost)
+        with self._condition:
+            self._leases[id(lock)] = lease
+            self._ensure_thread()
+            self._condition.notify()
+        return lease
+
+    def forget(self, lock):
+        self._check_fork()
+        with self._condition:
+            return self._leases.pop(id(lock), None)
+
+    def renew_due(self, now=None):
+        """
+        Renew every lease that is due, drop the ones that were lost.
+        """
+        now = time.time() if now is None else now
+        with self._condition:
+            due = [lease for lease in self._leases.values() if lease.next_renewal <= now]
+        for lease in due:
+            held, error = lease.renew()
+            if held:
+                continue
+            with self._condition:
+                # a lock released while it was being renewed isn't lost
+                if self._leases.get(id(lease.lock)) is not lease:
+                    continue
+                del self._leases[id(lease.lock)]
+            lease.mark_lost(error)
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='lock-watchdog')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._leases:
+                    wait = min(lease.next_renewal for lease in self._leases.values()) - time.time()
+                else:
+                    wait = None
+                if wait is None or wait > 0:
+                    self._condition.wait(wait)
+            self.renew_due()
+
+
+WATCHDOG = LockWatchdog()
+
+
+def keep_alive(lock, ttl, on_lost=None):
+    """
+    Keep extending an acquired lock to ttl seconds until it's released with
+    release_lock (or stop_keep_alive is called).
+
+    return: the Lease
+    """
+    return WATCHDOG.keep_alive(lock, ttl, on_lost)
+
+
+def stop_keep_alive(lock):
+    return WATCHDOG.forget(lock)
@@ -0,0 +1,76 @@
+from __future__ import print_function
+import cPickle as pickle
+import random
+import string
+import timeit
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from dimagi.utils.couch.cache.cache_core import codec
+
+
+def _random_text(length):
+    return ''.join(random.choice(string.ascii_letters + ' ') for _ in range(length))
+
+
+def make_sample_doc(n_properties, n_actions):
+    """
+    Something shaped like a case doc: flat properties plus a list of similar nested actions
+    """
+    doc = {
+        '_id': _random_text(32),
+        '_rev': '1-' + _random_text(32),
+        'doc_type': 'CommCareCase',
+        'domain': 'benchmark',
+        'closed': False,
+        'actions': [
+            {
+                'action_type': 'update',
+                'date': '2015-06-01T12:00:00.000000Z',
+                'server_date': '2015-06-01T12:00:01.000000Z',
+                'xform_id': _random_text(32),
+                'updated_unknown_properties': {'prop_%s' % j: _random_text(12) for j in range(5)},
+            }
+            for _ in range(n_actions)
+        ],
+    }
+    for i in range(n_properties):
+        doc['property_%s' % i] = random.choice([_random_text(20), random.randint(0, 10000), None])
+    return doc
+
+
+class Command(BaseCommand):
+    help = "Compare payload size and cpu cost of the cache_core payload codecs"
+    option_list = BaseCommand.option_list + (
+        make_option('--properties', type='int', default=50,
+                    help='number of flat properties per sample doc'),
+        make_option('--actions', type='int', default=20,
+                    help='number of nested actions per sample doc'),
+        make_option('--iterations', type='int', default=200,
+                    help='encode/decode iterations per codec'),
+        make_option('--compress-min-len', type='int', default=codec.COMPRESS_MIN_LEN),
+    )
+
+    def handle(self, **options):
+        doc = make_sample_doc(options['properties'], options['actions'])
+        iterations = options['iterations']
+
+        codecs = [('legacy', codec.PayloadCodec())]
+        for serializer in sorted(s.name for s in codec.SERIALIZERS.values()):
+            for compressor in [None] + sorted(c.name for c in codec.COMPRESSORS.values() if c.name):
+                name = '+'.join(filter(None, [serializer, compressor]))
+                codecs.append((name, codec.PayloadCodec(serializer, compressor, options['compress_min_len'])))
+
+        print("%-16s %10s %10s %12s %12s" % ('codec', 'bytes', 'pickled', 'encode (us)', 'decode (us)'))
+        for name, payload_codec in codecs:
+            payload = payload_codec.encode(doc)
+            assert codec.decode(payload) == payload_codec.decode(payload)
+            encode_time = timeit.timeit(lambda: payload_codec.encode(doc), number=iterations)
+            decode_time = timeit.timeit(lambda: codec.decode(payload), number=iterations)
+            print("%-16s %10d %10d %12.1f %12.1f" % (
+                name,
+                len(payload),
+                # django-redis pickles whatever we hand it
+                len(pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)),
+                encode_time / iterations * 1e6,
+                decode_time / iterations * 1e6,
+            ))
@@ -0,0 +1,57 @@
+from __future__ import print_function
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from dimagi.utils.couch.cache.cache_core import get_redis_shards, RedisClientError
+from dimagi.utils.couch.cache.cache_core import keyspace
+
+
+class Command(BaseCommand):
+    help = ("Count the keys of the redis cache by cache_core key prefix and estimate their memory use "
+            "and ttls from a random sample. Scans incrementally and throttled, so it is safe to run "
+            "against production.")
+    option_list = BaseCommand.option_list + (
+        make_option('--sample-rate', type='float', default=0.01,
+                    help='fraction of keys to measure with MEMORY USAGE and PTTL'),
+        make_option('--batch-size', type='int', default=500,
+                    help='keys per SCAN batch'),
+        make_option('--sleep', type='float', default=0.01,
+                    help='minimum seconds to sleep between batches'),
+        make_option('--max-keys', type='int', default=None,
+                    help='stop after scanning this many keys'),
+    )
+
+    def handle(self, **options):
+        try:
+            redis_caches = get_redis_shards()
+        except RedisClientError as e:
+            raise CommandError(unicode(e))
+
+        for i, redis_cache in enumerate(redis_caches):
+            if len(redis_caches) > 1:
+                print("shard %d of %d:" % (i + 1, len(redis_caches)))
+            self.census(redis_cache, options)
+
+    def census(self, redis_cache, options):
+        start = time.time()
+        census, scanned = keyspace.key_census(
+            redis_cache,
+            sample_rate=options['sample_rate'],
+            batch_size=options['batch_size'],
+            sleep=options['sleep'],
+            max_keys=options['max_keys'],
+        )
+        print("scanned %d keys in %.1fs%s" % (
+            scanned, time.time() - start,
+            ' (stopped early, counts are partial)' if options['max_keys'] and scanned >= options['max_keys'] else ''))
+
+        buckets = [bucket for bucket, _ in keyspace.TTL_BUCKETS] + ['none']
+        print("%-18s %10s %8s %14s %10s %10s  %s" % (
+            'prefix', 'keys', 'sampled', 'est. bytes', 'p50', 'p99', ' '.join('%6s' % b for b in buckets)))
+        summaries = [(name, prefix_census.summary()) for name, prefix_census in census.items()]
+        for name, summary in sorted(summaries, key=lambda item: item[1]['estimated_bytes'], reverse=True):
+            print("%-18s %10d %8d %14d %10s %10s  %s" % (
+                name, summary['count'], summary['sampled'], summary['estimated_bytes'],
+                summary['p50_bytes'], summary['p99_bytes'],
+                ' '.join('%6d' % summary['ttls'][b] for b in buckets),
+            ))
@@ -0,0 +1,21 @@
+from __future__ import print_function
+from dimagi.utils.couch.cache.cache_core import metrics, ttl, ADAPTIVE_TTL, COUCH_CACHE_TIMEOUT
+from dimagi.utils.management.metrics import MetricsSinkCommand
+
+
+class Command(MetricsSinkCommand):
+    help = ("Dump the cached_view hit/miss/latency counters of all processes. "
+            "Needs COUCH_CACHE_METRICS_SINK to be a RedisMetricsSink.")
+    sink_setting = 'COUCH_CACHE_METRICS_SINK'
+
+    def get_sink(self):
+        return metrics.METRICS_SINK
+
+    def handle_extra(self, **options):
+        if ADAPTIVE_TTL:
+            print("Adaptive view ttls (this process):")
+            for generation_key, info in sorted(ttl.adaptive_ttls(COUCH_CACHE_TIMEOUT).items()):
+                print("\t%s ttl=%ds bumps=%d mean_interval=%s" % (
+                    generation_key, info['ttl'], info['bumps'],
+                    '%.1fs' % info['mean_interval'] if info['mean_interval'] is not None else '-',
+                ))
@@ -1,13 +1,33 @@
 from __future__ import print_function
-from django.core.management.base import BaseCommand
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
 from django.core import cache
 from django.conf import settings
+from dimagi.utils.couch.cache.cache_core import get_redis_shards, RedisClientError
+from dimagi.utils.couch.cache.cache_core import keyspace
 
 
 class Command(BaseCommand):
-    help = "flush all caches"
+    help = ("flush all caches. With --prefix only drop the keys of the given cache_core key prefixes "
+            "from the redis cache, incrementally and without touching locks or rate limits")
+    option_list = BaseCommand.option_list + (
+        make_option('--prefix', action='append', dest='prefixes', default=[],
+                    help='key prefix to flush, may be repeated: %s' % ', '.join(
+                        prefix.name for prefix in keyspace.KEY_PREFIXES if prefix.flushable)),
+        make_option('--dry-run', action='store_true', default=False,
+                    help='only report key counts and memory per prefix'),
+        make_option('--batch-size', type='int', default=500,
+                    help='keys per SCAN/UNLINK batch'),
+        make_option('--sleep', type='float', default=0.01,
+                    help='minimum seconds to sleep between batches'),
+    )
 
     def handle(self, **options):
+        if options['prefixes']:
+            return self.flush_prefixes(options)
+        if options['dry_run']:
+            raise CommandError("--dry-run only works with --prefix")
+
         print("Clearing caches...")
         for k in settings.CACHES:
             cache_backend = cache.caches[k]
@@ -15,3 +35,38 @@ class Command(BaseCommand):
             print("\tclearing %s..." % k)
         print("all caches are cleared")
 
+    def flush_prefixes(self, options):
+        try:
+            redis_caches = get_redis_shards()
+        except RedisClientError as e:
+            raise CommandError(unicode(e))
+
+        try:
+            prefixes = [keyspace.get_key_prefix(name) for name in options['prefixes']]
+        except KeyError as e:
+            raise CommandError(e.args[0])
+        for prefix in prefixes:
+            if not prefix.flushable:
+                raise CommandError("Keys with prefix %r are not safe to flush" % prefix.name)
+
+        names = [prefix.name for prefix in prefixes]
+        if 'generation' in names and 'cached_view' not in names:
+            # generations restart from 0, which would bring back old view entries still in redis
+            print("flushing generation keys also flushes cached_view")
+            prefixes.insert(0, keyspace.get_key_prefix('cached_view'))
+        elif 'generation' in names:
+            prefixes.sort(key=lambda prefix: prefix.name == 'generation')
+
+        verb = 'found' if options['dry_run'] else 'flushed'
+        for prefix in prefixes:
+            report = keyspace.PrefixReport(prefix.name)
+            for redis_cache in redis_caches:
+                report.merge(keyspace.flush_prefix(redis_cache, prefix, batch_size=options['batch_size'],
+                                                   sleep=options['sleep'], dry_run=options['dry_run']))
+            if options['dry_run']:
+                print("\t%s: %s %d keys, %d bytes%s" % (
+                    prefix.name, verb, report.count, report.bytes,
+                    ' (%d keys of unknown size)' % report.bytes_unknown if report.bytes_unknown else '',
+                ))
+            else:
+                print("\t%s: %s %d keys" % (prefix.name, verb, report.count))
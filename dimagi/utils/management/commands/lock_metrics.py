@@ -0,0 +1,11 @@
+from dimagi.utils.locks import metrics
+from dimagi.utils.management.metrics import MetricsSinkCommand
+
+
+class Command(MetricsSinkCommand):
+    help = ("Dump lock wait/hold times and contention per lock key prefix of all processes. "
+            "Needs REDIS_LOCK_METRICS_SINK to be a RedisMetricsSink.")
+    sink_setting = 'REDIS_LOCK_METRICS_SINK'
+
+    def get_sink(self):
+        return metrics.METRICS_SINK
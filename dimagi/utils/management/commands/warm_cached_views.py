@@ -0,0 +1,54 @@
+from __future__ import print_function
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from dimagi.utils.couch.cache.cache_core import warming
+
+
+class Command(BaseCommand):
+    help = ("Pre-populate cached views, from a json config of views and param sets (see "
+            "cache_core/warming.py) or from the most requested views recorded by cached_view")
+    option_list = BaseCommand.option_list + (
+        make_option('--config', dest='config', default=None,
+                    help='json file of views and param sets to warm'),
+        make_option('--recorded', action='store_true', default=False,
+                    help='warm the most requested views recorded with COUCH_CACHE_RECORD_VIEWS'),
+        make_option('--top', type='int', default=500,
+                    help='number of recorded views to warm'),
+        make_option('--concurrency', type='int', default=4,
+                    help='view calls in flight at once'),
+        make_option('--rate', type='float', default=10,
+                    help='view calls started per second, 0 for no limit'),
+        make_option('--dry-run', action='store_true', default=False,
+                    help='only list what would be warmed'),
+    )
+
+    def handle(self, **options):
+        specs = []
+        if options['config']:
+            specs.extend(warming.load_view_config(options['config']))
+        if options['recorded']:
+            specs.extend(warming.load_recorded_views(options['top']))
+        if not (options['config'] or options['recorded']):
+            raise CommandError("Pass --config and/or --recorded")
+
+        if options['dry_run']:
+            for spec in specs:
+                print("%s %s %s" % (spec.get('db') or '-', spec['view'], warming.compact_json(spec.get('params'))))
+            print("%d views would be warmed" % len(specs))
+            return
+
+        print("Warming %d views (concurrency %d, rate %s/s)..." % (
+            len(specs), options['concurrency'], options['rate'] or 'unlimited'))
+        start = time.time()
+        results = warming.ViewWarmer(options['concurrency'], options['rate']).warm(specs)
+        elapsed = time.time() - start
+
+        failed = [(spec, error) for spec, _, error in results if error is not None]
+        for spec, error in failed:
+            print("\tfailed %s %s: %s" % (spec['view'], warming.compact_json(spec.get('params')), error))
+        slowest = sorted(results, key=lambda result: result[1], reverse=True)[:5]
+        print("slowest:")
+        for spec, seconds, _ in slowest:
+            print("\t%.2fs %s %s" % (seconds, spec['view'], warming.compact_json(spec.get('params'))))
+        print("warmed %d views in %.2fs, %d failed" % (len(results) - len(failed), elapsed, len(failed)))
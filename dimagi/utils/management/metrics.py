@@ -0,0 +1,55 @@
+from __future__ import print_function
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from dimagi.utils.metrics import RedisMetricsSink
+
+
+class MetricsSinkCommand(BaseCommand):
+    """
+    Dumps the counters and timings of a metrics sink. The command runs in its
+    own process, so only a RedisMetricsSink has anything to show.
+
+    Subclasses set sink_setting, the name of the setting configuring the sink,
+    and implement get_sink.
+    """
+    sink_setting = None
+    option_list = BaseCommand.option_list + (
+        make_option('--reset', action='store_true', default=False,
+                    help='reset the counters after dumping them'),
+    )
+
+    def get_sink(self):
+        raise NotImplementedError()
+
+    def handle_extra(self, **options):
+        """
+        Print anything else after the counters and timings
+        """
+        pass
+
+    def handle(self, **options):
+        sink = self.get_sink()
+        if not isinstance(sink, RedisMetricsSink):
+            # the other sinks keep nothing this process could read back
+            raise CommandError(
+                "%s is a %s, whose metrics can't be read from this command. "
+                "Configure a RedisMetricsSink to dump them here." % (self.sink_setting, sink.__class__.__name__))
+        snapshot = sink.snapshot()
+
+        print("Counters:")
+        for key, value in sorted(snapshot['counters'].items()):
+            print("\t%s %s" % (key, value))
+
+        print("Timings:")
+        for key, timing in sorted(snapshot['timings'].items()):
+            average = timing['total'] / timing['count'] if timing['count'] else 0
+            print("\t%s count=%d avg=%.2fms%s" % (
+                key, timing['count'], average * 1000,
+                ' max=%.2fms' % (timing['max'] * 1000) if timing.get('max') is not None else '',
+            ))
+
+        self.handle_extra(**options)
+
+        if options['reset']:
+            sink.reset()
+            print("counters reset")
@@ -0,0 +1,241 @@
+"""
+Pluggable sinks for simple counters and timings.
+
+A sink is configured with either a dotted path to its class or, like CACHES,
+a dict with a BACKEND path and OPTIONS passed to the constructor:
+
+    COUCH_CACHE_METRICS_SINK = {
+        'BACKEND': 'dimagi.utils.metrics.StatsdMetricsSink',
+        'OPTIONS': {'host': 'localhost', 'port': 8125, 'prefix': 'hq'},
+    }
+"""
+from __future__ import absolute_import
+import importlib
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+
+def metric_key(name, tags=None):
+    """
+    >>> metric_key('cache.hit', {'view': 'a/b', 'cache': 'Foo'})
+    'cache.hit{cache=Foo,view=a/b}'
+    """
+    if not tags:
+        return name
+    return '%s{%s}' % (name, ','.join('%s=%s' % (k, tags[k]) for k in sorted(tags)))
+
+
+class MetricsSink(object):
+
+    def incr(self, name, value=1, tags=None):
+        raise NotImplementedError()
+
+    def timing(self, name, seconds, tags=None):
+        raise NotImplementedError()
+
+    def snapshot(self):
+        """
+        return: {'counters': {metric_key: value}, 'timings': {metric_key: {'count', 'total', 'max'}}}
+        """
+        return {'counters': {}, 'timings': {}}
+
+    def reset(self):
+        pass
+
+    @contextmanager
+    def timer(self, name, tags=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timing(name, time.time() - start, tags)
+
+
+class NullMetricsSink(MetricsSink):
+
+    def incr(self, name, value=1, tags=None):
+        pass
+
+    def timing(self, name, seconds, tags=None):
+        pass
+
+
+class InMemoryMetricsSink(MetricsSink):
+    """
+    Aggregates in process memory. Cheap, but only visible to this process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timings = {}
+
+    def incr(self, name, value=1, tags=None):
+        key = metric_key(name, tags)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def timing(self, name, seconds, tags=None):
+        key = metric_key(name, tags)
+        with self._lock:
+            count, total, max_ = self._timings.get(key, (0, 0, 0))
+            self._timings[key] = (count + 1, total + seconds, max(max_, seconds))
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'timings': dict(
+                    (key, {'count': count, 'total': total, 'max': max_})
+                    for key, (count, total, max_) in self._timings.items()
+                ),
+            }
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
+
+    def _take(self):
+        """
+        Swap out what was aggregated so far, so nothing recorded meanwhile is lost.
+
+        return: (counters, timings)
+        """
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            timings, self._timings = self._timings, {}
+        return counters, timings
+
+    def _put_back(self, counters, timings):
+        with self._lock:
+            for key, value in counters.items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, (count, total, max_) in timings.items():
+                newer = self._timings.get(key, (0, 0, 0))
+                self._timings[key] = (count + newer[0], total + newer[1], max(max_, newer[2]))
+
+
+class LoggingMetricsSink(MetricsSink):
+
+    def __init__(self, logger='dimagi.utils.metrics', level=logging.DEBUG):
+        self.logger = logging.getLogger(logger)
+        self.level = level
+
+    def incr(self, name, value=1, tags=None):
+        self.logger.log(self.level, "%s +%s", metric_key(name, tags), value)
+
+    def timing(self, name, seconds, tags=None):
+        self.logger.log(self.level, "%s %.2fms", metric_key(name, tags), seconds * 1000)
+
+
+class StatsdMetricsSink(MetricsSink):
+    """
+    Fire and forget statsd packets over udp. statsd has no tags, so tag values
+    are appended to the metric name.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix=None):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _name(self, name, tags):
+        parts = [self.prefix, name] if self.prefix else [name]
+        parts.extend(str(tags[k]) for k in sorted(tags or {}))
+        return '.'.join(parts).replace('/', '_').replace(':', '_').replace('|', '_').replace('@', '_')
+
+    def _send(self, data):
+        try:
+            self._socket.sendto(data, self.address)
+        except socket.error:
+            pass
+
+    def incr(self, name, value=1, tags=None):
+        self._send('%s:%s|c' % (self._name(name, tags), value))
+
+    def timing(self, name, seconds, tags=None):
+        self._send('%s:%d|ms' % (self._name(name, tags), seconds * 1000))
+
+
+class RedisMetricsSink(InMemoryMetricsSink):
+    """
+    Aggregates in memory and adds the deltas to a redis hash at most every
+    flush_interval seconds, so counters of all processes can be read back
+    from anywhere, e.g. from a management command.
+    """
+
+    def __init__(self, key='dimagi-metrics', flush_interval=10):
+        super(RedisMetricsSink, self).__init__()
+        self.key = key
+        self.flush_interval = flush_interval
+        self._last_flush = time.time()
+
+    def incr(self, name, value=1, tags=None):
+        super(RedisMetricsSink, self).incr(name, value, tags)
+        self._maybe_flush()
+
+    def timing(self, name, seconds, tags=None):
+        super(RedisMetricsSink, self).timing(name, seconds, tags)
+        self._maybe_flush()
+
+    def _client(self):
+        from dimagi.utils.couch.cache.cache_core import get_redis_client
+        return get_redis_client().client.get_client()
+
+    def _maybe_flush(self):
+        if time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.time()
+        counters, timings = self._take()
+        if not counters and not timings:
+            return
+        try:
+            pipeline = self._client().pipeline(transaction=False)
+            for key, value in counters.items():
+                pipeline.hincrbyfloat(self.key, 'c|' + key, value)
+            for key, (count, total, _) in timings.items():
+                pipeline.hincrbyfloat(self.key, 'tc|' + key, count)
+                pipeline.hincrbyfloat(self.key, 'tt|' + key, total)
+            pipeline.execute()
+        except Exception:
+            # keep the deltas for the next flush
+            self._put_back(counters, timings)
+            logging.getLogger(__name__).exception("Could not flush metrics to redis")
+
+    def snapshot(self):
+        self.flush()
+        counters = {}
+        timings = {}
+        for field, value in self._client().hgetall(self.key).items():
+            kind, key = field.split('|', 1)
+            value = float(value)
+            if kind == 'c':
+                counters[key] = value
+            else:
+                timing = timings.setdefault(key, {'count': 0, 'total': 0, 'max': None})
+                timing['count' if kind == 'tc' else 'total'] = value
+        return {'counters': counters, 'timings': timings}
+
+    def reset(self):
+        super(RedisMetricsSink, self).reset()
+        self._client().delete(self.key)
+
+
+def load_metrics_sink(config, default=InMemoryMetricsSink):
+    """
+    config: None, a dotted path to a MetricsSink class or {'BACKEND': path, 'OPTIONS': {...}}
+    """
+    if not config:
+        return default()
+    if isinstance(config, dict):
+        path, options = config['BACKEND'], config.get('OPTIONS', {})
+    else:
+        path, options = config, {}
+    mod_path, class_name = path.rsplit('.', 1)
+    return getattr(importlib.import_module(mod_path), class_name)(**options)
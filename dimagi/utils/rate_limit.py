@@ -1,17 +1,23 @@
 from datetime import datetime, timedelta
-from dimagi.utils.couch.cache.cache_core import get_redis_client
+from dimagi.utils.locks.backends import get_lock_backend, FIXED_WINDOW
 
 
-def rate_limit(key, actions_allowed=60, how_often=60):
+def rate_limit(key, actions_allowed=60, how_often=60, mode=FIXED_WINDOW):
     """
-    A simple util to be used for rate limiting, using redis as a backend.
+    A simple util to be used for rate limiting, using redis (or the configured
+    LOCK_BACKEND, see dimagi.utils.locks.backends) as a backend.
 
     key - a unique key which describes the action you are rate limiting
 
     actions_allowed - the number of actions to allow for key every how_often
     seconds before returning False
 
-    returns True to proceed with the action, or False to not proceed
+    mode - FIXED_WINDOW, or GCRA for a sliding window that spreads the
+    actions out instead of allowing them all at the start of each window
+    (see dimagi.utils.locks.backends)
+
+    returns True to proceed with the action, or False to not proceed; use
+    check_rate_limit to also find out the remaining actions and when to retry
 
     For example, to only allow a single project space to send 100 SMS max every
     30 seconds:
@@ -21,25 +27,16 @@ def rate_limit(key, actions_allowed=60, how_often=60):
     else:
         <delay action>
     """
+    return check_rate_limit(key, actions_allowed, how_often, mode).allowed
 
-    # We need access to the raw redis client because calling incr on
-    # a django_redis RedisCache object raises an error if the key
-    # doesn't exist.
-    client = get_redis_client().client.get_client()
-
-    # Increment the key. If they key doesn't exist (or already expired),
-    # redis sets the value to 0 before incrementing.
-    value = client.incr(key)
-
-    if value == 1 or client.ttl(key) == -1:
-        # Set the key's expiration if it's the first action we're granting.
-        # As a precauation, we also check to make sure that the key actually has
-        # an expiration set in case an error occurred the first time we tried to
-        # set the expiration. If it doesn't have an expiration (ttl == -1), then
-        # we'll set it here again.
-        client.expire(key, how_often)
 
-    return value <= actions_allowed
+def check_rate_limit(key, actions_allowed=60, how_often=60, mode=FIXED_WINDOW):
+    """
+    Like rate_limit, but returns a RateLimitResult (allowed, remaining,
+    retry_after), retry_after being the seconds to wait if not allowed.
+    With redis this is a single script call.
+    """
+    return get_lock_backend().rate_limit(key, actions_allowed, how_often, mode)
 
 
 class DomainRateLimiter(object):
@@ -54,7 +51,7 @@ class DomainRateLimiter(object):
     else:
         <delay action>
     """
-    def __init__(self, key, actions_allowed, how_often):
+    def __init__(self, key, actions_allowed, how_often, mode=FIXED_WINDOW):
         """
         key - the beginning of the redis key that will be used to rate limit on;
         the actual key that is used will be key + domain
@@ -62,10 +59,13 @@ class DomainRateLimiter(object):
         actions_allowed - see rate_limit()
 
         how_often - see rate_limit()
+
+        mode - see rate_limit()
         """
         self.key = key
         self.actions_allowed = actions_allowed
         self.how_often = how_often
+        self.mode = mode
 
         """
         Dictionary of {domain: datetime}
@@ -91,17 +91,13 @@ class DomainRateLimiter(object):
             return False
 
         key = self.key + domain
-        if rate_limit(key, actions_allowed=self.actions_allowed, how_often=self.how_often):
+        result = check_rate_limit(key, actions_allowed=self.actions_allowed,
+                                  how_often=self.how_often, mode=self.mode)
+        if result.allowed:
             return True
         else:
             # Add an entry to self.cooldown so that next time we don't have to
-            # make a call to redis
-            client = get_redis_client().client.get_client()
-            time_remaining = client.ttl(key)
-            if time_remaining < 0:
-                # If we just happened to time it so that the key just expired or
-                # a key was just created but doesn't have a timeout yet, then use a
-                # value of 0 here and the cool down will be ignored.
-                time_remaining = 0
-            self.cooldown[domain] = datetime.utcnow() + timedelta(seconds=time_remaining)
+            # make a call to redis. If retry_after is 0, the cool down will be
+            # ignored.
+            self.cooldown[domain] = datetime.utcnow() + timedelta(seconds=result.retry_after)
             return False
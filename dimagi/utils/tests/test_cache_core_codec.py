@@ -0,0 +1,39 @@
+import simplejson
+from django.test import SimpleTestCase
+
+from dimagi.utils.couch.cache.cache_core import codec
+from dimagi.utils.couch.cache.cache_core.codec import PayloadCodec, CodecError
+
+
+DOC = {'_id': 'abc', 'doc_type': 'Foo', 'name': u'f\xf6\xf6', 'values': [1, 2.5, None, True], 'nested': {'a': 'b'}}
+
+
+class PayloadCodecTest(SimpleTestCase):
+
+    def test_reads_legacy_payloads(self):
+        self.assertEqual(codec.decode(simplejson.dumps(DOC)), DOC)
+
+    def test_legacy_codec_writes_legacy_payloads(self):
+        self.assertEqual(PayloadCodec().encode(DOC), simplejson.dumps(DOC))
+
+    def test_round_trips(self):
+        for serializer in [s.name for s in codec.SERIALIZERS.values()]:
+            for compressor in [None] + [c.name for c in codec.COMPRESSORS.values() if c.name]:
+                payload = PayloadCodec(serializer, compressor, compress_min_len=0).encode(DOC)
+                self.assertTrue(payload.startswith(codec.MAGIC))
+                self.assertEqual(codec.decode(payload), DOC)
+
+    def test_compresses_above_threshold_only(self):
+        big = dict(DOC, padding='x' * 1000)
+        payload_codec = PayloadCodec('json', 'zlib', compress_min_len=500)
+        self.assertEqual(payload_codec.encode(DOC)[:codec.HEADER_LENGTH], codec.MAGIC + '1j-')
+        self.assertEqual(payload_codec.encode(big)[:codec.HEADER_LENGTH], codec.MAGIC + '1jz')
+        self.assertEqual(codec.decode(payload_codec.encode(big)), big)
+
+    def test_unknown_version(self):
+        with self.assertRaises(CodecError):
+            codec.decode(codec.MAGIC + '9j-{}')
+
+    def test_unavailable_codec(self):
+        with self.assertRaises(CodecError):
+            PayloadCodec('bson')
@@ -0,0 +1,60 @@
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import SimpleTestCase
+from mock import patch, MagicMock
+from redis.exceptions import ResponseError
+
+from dimagi.utils.couch.cache.cache_core import keyspace
+
+
+class KeyspaceTest(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = LocMemCache('keyspace-test', {})
+        self.cache.client = MagicMock()
+        self.client = self.cache.client.get_client.return_value
+
+    def test_classify_key(self):
+        make_key = self.cache.make_key
+        self.assertEqual(keyspace.classify_key(self.cache, make_key('#cached_doc_abc')), 'cached_doc')
+        self.assertEqual(keyspace.classify_key(self.cache, make_key('#cached_doc_helper_abc_prop')),
+                         'cached_doc_helper')
+        self.assertEqual(keyspace.classify_key(self.cache, make_key('3:#cached_view_:v2:a/b:')), 'cached_view')
+        self.assertEqual(keyspace.classify_key(self.cache, make_key('redis-object-lock-Foo-1')), 'lock')
+        self.assertEqual(keyspace.classify_key(self.cache, 'send-sms-for-x'), 'other')
+
+    @patch('dimagi.utils.couch.cache.cache_core.keyspace.time')
+    def test_flush_prefix_unlinks_scanned_batches(self, _):
+        self.client.scan.side_effect = [('7', ['a', 'b']), ('0', ['c'])]
+        report = keyspace.flush_prefix(self.cache, keyspace.get_key_prefix('cached_doc'), batch_size=2)
+        self.assertEqual(report.count, 3)
+        self.assertEqual(self.client.scan.call_args_list[0][1]['match'], self.cache.make_key('#cached_doc_*'))
+        self.assertEqual(self.client.execute_command.call_count, 2)
+
+    @patch('dimagi.utils.couch.cache.cache_core.keyspace.time')
+    def test_flush_cached_docs_keeps_helpers(self, _):
+        make_key = self.cache.make_key
+        self.client.scan.side_effect = [('0', [make_key('#cached_doc_abc'), make_key('#cached_doc_helper_abc_prop')])]
+        report = keyspace.flush_prefix(self.cache, keyspace.get_key_prefix('cached_doc'))
+        self.assertEqual(report.count, 1)
+        self.client.execute_command.assert_called_once_with('UNLINK', make_key('#cached_doc_abc'))
+
+    def test_unlink_falls_back_to_del(self):
+        self.client.execute_command.side_effect = ResponseError('unknown command')
+        keyspace.unlink(self.client, ['a', 'b'])
+        self.client.delete.assert_called_with('a', 'b')
+
+    @patch('dimagi.utils.couch.cache.cache_core.keyspace.time')
+    def test_key_census(self, _):
+        make_key = self.cache.make_key
+        self.client.scan.side_effect = [
+            ('5', [make_key('#cached_doc_a'), make_key('#cached_doc_b')]),
+            ('0', [make_key('redis-class-lock-Foo')]),
+        ]
+        pipeline = self.client.pipeline.return_value
+        pipeline.execute.side_effect = [[100, 300], [None, 7200000], [50], [30000]]
+        census, scanned = keyspace.key_census(self.cache, sample_rate=1)
+        self.assertEqual(scanned, 3)
+        docs = census['cached_doc'].summary()
+        self.assertEqual((docs['count'], docs['estimated_bytes'], docs['p99_bytes']), (2, 400, 300))
+        self.assertEqual((docs['ttls']['none'], docs['ttls']['<1d']), (1, 1))
+        self.assertEqual(census['lock'].summary()['ttls']['<1m'], 1)
@@ -0,0 +1,210 @@
+from couchdbkit import ResourceNotFound
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+from mock import patch, MagicMock
+
+from dimagi.utils.couch.cache import cache_core
+from dimagi.utils.couch.cache.cache_core import broadcast, local
+from dimagi.utils.couch.cache.cache_core.broadcast import LocalGenerations
+from dimagi.utils.couch.cache.cache_core.api import cached_open_doc, cached_open_docs, do_cache_doc, invalidate_doc, \
+    invalidate_docs
+from dimagi.utils.couch.cache.cache_core.const import MISSING
+from dimagi.utils.couch.cache.cache_core.gen import GenerationCache
+from dimagi.utils.couch.cache.cache_core.lib import _get_cached_doc_only
+from dimagi.utils.couch.cache.cache_core.local import LocalLRUCache
+
+
+class LocalLRUCacheTest(SimpleTestCase):
+
+    def test_lru_eviction_by_entries(self):
+        lru = LocalLRUCache(max_entries=2, max_bytes=1000, timeout=60)
+        lru.set('a', {'n': 1}, 1)
+        lru.set('b', {'n': 2}, 1)
+        lru.get('a')
+        lru.set('c', {'n': 3}, 1)
+        self.assertEqual(lru.get('b'), MISSING)
+        self.assertEqual(lru.get('a'), {'n': 1})
+        self.assertEqual(lru.stats.evictions, 1)
+
+    def test_eviction_by_bytes(self):
+        lru = LocalLRUCache(max_entries=100, max_bytes=10, timeout=60)
+        lru.set('a', {}, 6)
+        lru.set('b', {}, 6)
+        self.assertEqual(len(lru), 1)
+        self.assertEqual(lru.size_bytes, 6)
+        lru.set('huge', {}, 11)
+        self.assertEqual(lru.get('huge'), MISSING)
+
+    def test_ttl(self):
+        lru = LocalLRUCache(max_entries=10, max_bytes=1000, timeout=-1)
+        lru.set('a', {}, 1)
+        self.assertEqual(lru.get('a'), MISSING)
+        self.assertEqual(lru.stats.expirations, 1)
+        self.assertEqual(lru.size_bytes, 0)
+
+    def test_returns_copies(self):
+        lru = LocalLRUCache(max_entries=10, max_bytes=1000, timeout=60)
+        doc = {'list': [1]}
+        lru.set('a', doc, 1)
+        doc['list'].append(2)
+        lru.get('a')['list'].append(3)
+        self.assertEqual(lru.get('a'), {'list': [1]})
+
+    def test_delete_tags(self):
+        lru = LocalLRUCache(max_entries=10, max_bytes=1000, timeout=60)
+        lru.set('a', {}, 1, tag='Foo')
+        lru.set('b', {}, 1, tag='Bar')
+        lru.delete_tags(['Foo'])
+        self.assertEqual(lru.get('a'), MISSING)
+        self.assertEqual(lru.get('b'), {})
+
+
+class FooCache(GenerationCache):
+    generation_key = '#gen_foo'
+    doc_types = ['Foo']
+    views = []
+
+
+@patch('dimagi.utils.couch.cache.cache_core.api.CACHE_DOCS', True)
+@patch('dimagi.utils.couch.cache.cache_core.lib.CACHE_DOCS', True)
+class TwoTierDocCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        cache_core.MOCK_REDIS_CACHE = LocMemCache('two-tier-test', {})
+        cache_core.MOCK_REDIS_CACHE.clear()
+        local.LOCAL_DOC_CACHE = LocalLRUCache(max_entries=10, max_bytes=10000, timeout=60)
+        local.REDIS_DOC_STATS.reset()
+        self.generations = broadcast.LOCAL_GENERATIONS = LocalGenerations(timeout=0)
+        # as if subscribed, the broadcasts are checked on the mock client
+        self.generations.listener = False
+        patcher = patch('dimagi.utils.couch.cache.cache_core.broadcast.get_redis_client')
+        self.client = patcher.start().return_value.client.get_client.return_value
+        self.addCleanup(patcher.stop)
+        self.doc = {'_id': 'abc', 'doc_type': 'Foo', 'name': 'foo'}
+        self.db = MagicMock()
+        self.db.open_doc.return_value = self.doc
+
+    def tearDown(self):
+        cache_core.MOCK_REDIS_CACHE = None
+        local.LOCAL_DOC_CACHE = None
+        broadcast.LOCAL_GENERATIONS = LocalGenerations()
+
+    def test_local_tier_serves_repeat_reads(self):
+        self.assertEqual(cached_open_doc(self.db, 'abc'), self.doc)
+        local.LOCAL_DOC_CACHE.clear()
+
+        self.assertEqual(cached_open_doc(self.db, 'abc'), self.doc)
+        self.assertEqual(cached_open_doc(self.db, 'abc'), self.doc)
+        self.assertEqual(self.db.open_doc.call_count, 1)
+        stats = local.doc_cache_stats()
+        self.assertEqual(stats['redis'], {'hits': 1, 'misses': 1, 'evictions': 0, 'expirations': 0})
+        self.assertEqual(stats['local']['hits'], 1)
+
+    def test_invalidate_doc_drops_local_copy(self):
+        do_cache_doc(self.doc)
+        invalidate_doc(self.doc)
+        self.assertEqual(local.get_local_doc(cache_core.key_doc_id('abc')), MISSING)
+
+    def test_invalidate_doc_is_broadcast(self):
+        do_cache_doc(self.doc)
+        invalidate_doc(self.doc, deleted=True)
+        self.client.publish.assert_called_with(
+            cache_core.GENERATION_CHANNEL, '{"doc_keys": ["%s"]}' % cache_core.key_doc_id('abc'))
+
+    def test_doc_broadcast_drops_local_copy(self):
+        do_cache_doc(self.doc)
+        # another process invalidates the doc
+        self.generations.handle_message('{"doc_keys": ["%s"]}' % cache_core.key_doc_id('abc'))
+        self.assertEqual(local.get_local_doc(cache_core.key_doc_id('abc')), MISSING)
+
+    @override_settings(COUCH_CACHE_BACKENDS=['dimagi.utils.tests.test_cache_core_local.FooCache'])
+    def test_generation_broadcast_drops_local_doc_types(self):
+        GenerationCache.reload_generational_caches()
+        self.addCleanup(GenerationCache.reload_generational_caches)
+        do_cache_doc(self.doc)
+        self.generations.handle_message('{"generation_key": "%s"}' % FooCache.generation_key)
+        self.assertEqual(local.get_local_doc(cache_core.key_doc_id('abc')), MISSING)
+
+    def test_no_local_copies_while_listener_reconnects(self):
+        do_cache_doc(self.doc)
+        self.generations.trusted = False
+        with patch.object(cache_core.rcache(), 'get', return_value=None) as get:
+            self.assertIsNone(_get_cached_doc_only('abc'))
+        self.assertEqual(get.call_count, 1)
+
+    def test_read_before_invalidation_not_kept(self):
+        do_cache_doc(self.doc)
+        local.LOCAL_DOC_CACHE.clear()
+        payload = cache_core.rcache().get(cache_core.key_doc_id('abc'))
+
+        def invalidated_meanwhile(key, default=None):
+            self.generations.handle_message('{"doc_keys": ["%s"]}' % key)
+            return payload
+        with patch.object(cache_core.rcache(), 'get', side_effect=invalidated_meanwhile):
+            self.assertEqual(_get_cached_doc_only('abc'), self.doc)
+        self.assertEqual(local.get_local_doc(cache_core.key_doc_id('abc')), MISSING)
+
+    def test_generation_bump_drops_local_doc_types(self):
+        do_cache_doc(self.doc)
+        FooCache()._get_generation()
+        cache_core.rcache().incr(FooCache.generation_key)
+        FooCache()._get_generation()
+        self.assertEqual(local.get_local_doc(cache_core.key_doc_id('abc')), MISSING)
+
+    @override_settings(COUCH_CACHE_BACKENDS=['dimagi.utils.tests.test_cache_core_local.FooCache'])
+    def test_invalidate_docs_bumps_each_generation_once(self):
+        GenerationCache.reload_generational_caches()
+        self.addCleanup(GenerationCache.reload_generational_caches)
+        other = {'_id': 'def', 'doc_type': 'Foo', 'name': 'other'}
+        do_cache_doc(self.doc)
+        cache_core.rcache().set(FooCache.generation_key, 5)
+        self.assertEqual(invalidate_docs([self.doc, other]), {'abc': True, 'def': False})
+        self.assertEqual(cache_core.rcache().get(FooCache.generation_key), 6)
+        self.assertIsNone(cache_core.rcache().get(cache_core.key_doc_id('abc')))
+        self.assertEqual(local.get_local_doc(cache_core.key_doc_id('abc')), MISSING)
+
+
+@patch('dimagi.utils.couch.cache.cache_core.api.CACHE_DOCS', True)
+@patch('dimagi.utils.couch.cache.cache_core.lib.CACHE_DOCS', True)
+@patch('dimagi.utils.couch.cache.cache_core.api.MISSING_DOC_TIMEOUT', 30)
+class NotFoundDocCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        cache_core.MOCK_REDIS_CACHE = LocMemCache('not-found-test', {})
+        cache_core.MOCK_REDIS_CACHE.clear()
+        local.NOT_FOUND_DOC_STATS.reset()
+        self.db = MagicMock()
+        self.db.open_doc.side_effect = ResourceNotFound('deleted', http_code=404)
+
+    def tearDown(self):
+        cache_core.MOCK_REDIS_CACHE = None
+
+    def test_not_found_is_cached(self):
+        for _ in range(2):
+            with self.assertRaises(ResourceNotFound) as cm:
+                cached_open_doc(self.db, 'abc')
+            self.assertEqual(str(cm.exception), 'deleted')
+        self.assertEqual(self.db.open_doc.call_count, 1)
+        self.assertEqual(local.NOT_FOUND_DOC_STATS.as_dict()['hits'], 1)
+        self.assertEqual(local.NOT_FOUND_DOC_STATS.as_dict()['misses'], 1)
+
+    def test_cached_not_found_skips_bulk_fetch(self):
+        with self.assertRaises(ResourceNotFound):
+            cached_open_doc(self.db, 'abc')
+        with patch('dimagi.utils.couch.bulk.get_docs') as get_docs:
+            self.assertEqual(cached_open_docs(self.db, ['abc']), {})
+        self.assertFalse(get_docs.called)
+
+    def test_save_replaces_not_found(self):
+        with self.assertRaises(ResourceNotFound):
+            cached_open_doc(self.db, 'abc')
+        doc = {'_id': 'abc', 'doc_type': 'Foo'}
+        do_cache_doc(doc)
+        self.assertEqual(cached_open_doc(self.db, 'abc'), doc)
+
+    def test_invalidate_drops_not_found(self):
+        with self.assertRaises(ResourceNotFound):
+            cached_open_doc(self.db, 'abc')
+        self.assertFalse(invalidate_doc({'_id': 'abc'}, deleted=True))
+        self.assertIsNone(cache_core.rcache().get(cache_core.key_doc_id('abc')))
@@ -0,0 +1,79 @@
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase
+from mock import patch
+
+from dimagi.utils.couch.cache import cache_core
+from dimagi.utils.couch.cache.cache_core import key_doc_id
+from dimagi.utils.couch.cache.cache_core.sharding import HashRing, ShardedCache
+
+
+def _shards(names):
+    shards = dict((name, LocMemCache('sharding-test-%s' % name, {})) for name in names)
+    for shard in shards.values():
+        shard.clear()
+    return shards
+
+
+class HashRingTest(SimpleTestCase):
+
+    def test_adding_a_node_moves_few_keys(self):
+        keys = [key_doc_id('doc%s' % i) for i in range(2000)]
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in keys if before.get_node(key) != after.get_node(key)]
+        self.assertTrue(all(after.get_node(key) == 'd' for key in moved))
+        self.assertLess(len(moved), len(keys) * 0.4)
+
+    def test_keys_are_spread(self):
+        ring = HashRing(['a', 'b', 'c'])
+        counts = {}
+        for i in range(3000):
+            node = ring.get_node(key_doc_id('doc%s' % i))
+            counts[node] = counts.get(node, 0) + 1
+        self.assertEqual(sorted(counts), ['a', 'b', 'c'])
+        self.assertGreater(min(counts.values()), 600)
+
+
+class ShardedCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.shards = _shards(['redis', 'shard1', 'shard2'])
+        self.cache = ShardedCache(self.shards, 'redis')
+
+    def test_docs_and_views_are_sharded(self):
+        keys = [key_doc_id('doc%s' % i) for i in range(30)] + ['3:#cached_view_:v2:foo/bar:%s' % i for i in range(30)]
+        self.cache.set_many(dict((key, key) for key in keys))
+        self.assertEqual(self.cache.get_many(keys), dict((key, key) for key in keys))
+        for name, shard in self.shards.items():
+            self.assertTrue(shard.get_many(keys), name)
+
+    def test_other_keys_stay_on_primary(self):
+        self.cache.set('#gen_foo', 3)
+        self.cache.incr('#gen_foo')
+        self.assertEqual(self.shards['redis'].get('#gen_foo'), 4)
+        self.assertIs(self.cache.get_shard('redis-object-lock-Foo-1'), self.shards['redis'])
+
+    def test_delete_reaches_every_shard(self):
+        key = key_doc_id('abc')
+        for shard in self.shards.values():
+            shard.set(key, 'stale')
+        self.cache.delete(key)
+        self.assertEqual([shard.get(key) for shard in self.shards.values()], [None, None, None])
+
+    def test_key_methods_are_routed(self):
+        key = key_doc_id('abc')
+        self.cache.set(key, 1)
+        self.assertTrue(self.cache.has_key(key))
+        self.assertEqual(self.cache.make_key(key), self.cache.get_shard(key).make_key(key))
+        self.assertEqual(self.cache.version, self.shards['redis'].version)
+        # no quiet fallback to the primary for whatever isn't routed
+        with self.assertRaises(AttributeError):
+            self.cache.delete_pattern('*')
+        self.assertFalse(hasattr(self.cache, 'client'))
+
+    @patch('dimagi.utils.couch.cache.cache_core._sharded_cache', None)
+    @patch('dimagi.utils.couch.cache.cache_core.SHARDS', ['redis_shard_1', 'redis'])
+    def test_primary_must_be_redis(self):
+        with self.assertRaises(ImproperlyConfigured):
+            cache_core.get_sharded_cache()
@@ -0,0 +1,372 @@
+from collections import OrderedDict
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+from mock import patch, MagicMock
+
+from dimagi.utils.couch.cache import cache_core
+from dimagi.utils.couch.cache.cache_core import broadcast
+from dimagi.utils.couch.cache.cache_core.broadcast import LocalGenerations, GenerationListener, ListenerTimeout, PING
+from dimagi.utils.couch.cache.cache_core import GENERATION_CHANNEL, COUCH_CACHE_TIMEOUT
+from dimagi.utils.couch.cache.cache_core.gen import GenerationCache, validate_generational_caches, \
+    canonical_param_string, VIEW_KEY_HASH_MIN_LEN
+from dimagi.utils.couch.cache.cache_core.stampede import ViewFill, should_recompute_early, FILL_LOCK_SUFFIX
+from dimagi.utils.couch.cache.cache_core.policy import chunk_key
+from dimagi.utils.couch.cache.cache_core import ttl
+from dimagi.utils.couch.cache.cache_core.ttl import InvalidationTracker
+
+
+class FooCache(GenerationCache):
+    generation_key = '#gen_foo_views'
+    doc_types = ['Foo']
+    views = ['foo/by_name']
+
+
+class BarCache(GenerationCache):
+    generation_key = '#gen_bar_views'
+    doc_types = ['Bar', 'Foo']
+    views = ['bar/by_name']
+
+
+def _mock_view_db(docs):
+    db = MagicMock()
+    view_obj = MagicMock()
+    view_obj._result_cache = {
+        'rows': [{'id': doc['_id'], 'key': doc['name'], 'value': None, 'doc': doc} for doc in docs]
+    }
+    view_obj._total_rows = len(docs)
+    view_obj._offset = 0
+    db.view.return_value = view_obj
+    return db
+
+
+@patch('dimagi.utils.couch.cache.cache_core.gen.CACHE_VIEWS', True)
+@patch('dimagi.utils.couch.cache.cache_core.api.CACHE_DOCS', True)
+@patch('dimagi.utils.couch.cache.cache_core.lib.CACHE_DOCS', True)
+class CachedViewIncludeDocsTest(SimpleTestCase):
+
+    def setUp(self):
+        cache_core.MOCK_REDIS_CACHE = LocMemCache('cached-view-test', {})
+        cache_core.MOCK_REDIS_CACHE.clear()
+        self.docs = [{'_id': 'doc%s' % i, 'doc_type': 'Foo', 'name': 'foo%s' % i} for i in range(5)]
+
+    def tearDown(self):
+        cache_core.MOCK_REDIS_CACHE = None
+
+    def test_cache_hit_resolves_docs_in_bulk(self):
+        db = _mock_view_db(self.docs)
+        first = FooCache().cached_view(db, 'foo/by_name', include_docs=True)
+        self.assertEqual([row['doc'] for row in first], self.docs)
+
+        # drop two docs from the cache so they have to come from couch
+        cache_core.rcache().delete_many([cache_core.key_doc_id('doc1'), cache_core.key_doc_id('doc3')])
+        with patch('dimagi.utils.couch.bulk.get_docs') as get_docs, \
+                patch.object(cache_core.rcache(), 'get_many', wraps=cache_core.rcache().get_many) as get_many:
+            get_docs.return_value = [self.docs[1]]
+            second = FooCache().cached_view(db, 'foo/by_name', include_docs=True)
+
+        self.assertEqual(db.view.call_count, 1)
+        self.assertEqual(get_many.call_count, 1)
+        self.assertEqual(get_docs.call_count, 1)
+        self.assertEqual(sorted(get_docs.call_args[1]['keys']), ['doc1', 'doc3'])
+        # doc3 is gone from couch, so it is dropped from the results
+        self.assertEqual([row['id'] for row in second], ['doc0', 'doc1', 'doc2', 'doc4'])
+        self.assertEqual([row['doc'] for row in second], [self.docs[i] for i in (0, 1, 2, 4)])
+
+
+class LocalGenerationTest(SimpleTestCase):
+
+    def setUp(self):
+        cache_core.MOCK_REDIS_CACHE = LocMemCache('local-generation-test', {})
+        cache_core.MOCK_REDIS_CACHE.clear()
+        self.generations = LocalGenerations(timeout=60)
+        # no pub/sub in these tests
+        self.generations.listener = False
+        broadcast.LOCAL_GENERATIONS = self.generations
+
+    def tearDown(self):
+        cache_core.MOCK_REDIS_CACHE = None
+        broadcast.LOCAL_GENERATIONS = LocalGenerations()
+
+    def test_generation_served_locally(self):
+        cache = FooCache()
+        self.assertEqual(cache._get_generation(), '0')
+        with patch.object(cache_core.rcache(), 'get') as get:
+            self.assertEqual(cache._get_generation(), '0')
+        self.assertEqual(get.call_count, 0)
+
+    def test_invalidate_all_refreshes_local_copy(self):
+        cache = FooCache()
+        cache._get_generation()
+        with patch.object(self.generations, 'publish') as publish:
+            cache.invalidate_all()
+        publish.assert_called_with(FooCache.generation_key)
+        self.assertEqual(cache._get_generation(), '1')
+
+    def test_broadcast_invalidates_local_copy(self):
+        cache = FooCache()
+        cache._get_generation()
+        # another process bumps the generation and broadcasts it
+        cache_core.rcache().incr(FooCache.generation_key)
+        self.assertEqual(cache._get_generation(), '0')
+        self.generations.handle_message('{"generation_key": "%s"}' % FooCache.generation_key)
+        self.assertEqual(cache._get_generation(), '1')
+
+    def test_stale_read_not_stored_after_invalidation(self):
+        epoch = self.generations.epoch
+        self.generations.invalidate(FooCache.generation_key)
+        self.generations.set(FooCache.generation_key, '0', epoch=epoch)
+        self.assertIsNone(self.generations.get(FooCache.generation_key))
+
+    def test_untrusted_while_listener_reconnects(self):
+        self.generations.set(FooCache.generation_key, '0')
+        self.generations.trusted = False
+        self.assertIsNone(self.generations.get(FooCache.generation_key))
+
+    @patch('dimagi.utils.couch.cache.cache_core.broadcast.GenerationListener')
+    def test_forked_child_starts_its_own_listener(self, listener):
+        self.generations.set(FooCache.generation_key, '0')
+        self.generations.listener = MagicMock()
+        # as seen from a forked child
+        self.generations._pid = -1
+        self.assertIsNone(self.generations.get(FooCache.generation_key))
+        self.assertIs(self.generations.listener, listener.return_value)
+        listener.return_value.start.assert_called_once_with()
+        self.assertFalse(self.generations.trusted)
+
+    def test_listener_pings_quiet_channel(self):
+        client = MagicMock()
+        pubsub = MagicMock()
+        pubsub.get_message.return_value = None
+        listener = GenerationListener(self.generations)
+        with self.assertRaises(ListenerTimeout):
+            listener.listen(client, pubsub, interval=0)
+        client.publish.assert_called_once_with(GENERATION_CHANNEL, PING)
+
+
+class GenerationIndexTest(SimpleTestCase):
+
+    def tearDown(self):
+        GenerationCache.reload_generational_caches()
+
+    @override_settings(COUCH_CACHE_BACKENDS=[
+        'dimagi.utils.tests.test_cache_core_views.FooCache',
+        'dimagi.utils.tests.test_cache_core_views.BarCache',
+    ])
+    def test_indexes(self):
+        GenerationCache.reload_generational_caches()
+        view_map = GenerationCache.view_generation_map()
+        self.assertIs(view_map, GenerationCache.view_generation_map())
+        self.assertIsInstance(view_map['foo/by_name'], FooCache)
+        self.assertIsInstance(view_map['bar/by_name'], BarCache)
+        self.assertIsInstance(GenerationCache.doc_type_generation_map()['Bar'], BarCache)
+        with self.assertRaises(TypeError):
+            view_map['baz/by_name'] = FooCache()
+
+    def test_conflicts(self):
+        conflicts = validate_generational_caches([FooCache(), BarCache()])
+        self.assertEqual(conflicts, {'views': {}, 'doc_types': {'Foo': ['FooCache', 'BarCache']}})
+
+
+@patch('dimagi.utils.couch.cache.cache_core.gen.CACHE_VIEWS', True)
+@patch('dimagi.utils.couch.cache.cache_core.gen.STAMPEDE_PROTECTION', True)
+class StampedeProtectionTest(SimpleTestCase):
+
+    def setUp(self):
+        cache_core.MOCK_REDIS_CACHE = LocMemCache('stampede-test', {})
+        cache_core.MOCK_REDIS_CACHE.clear()
+        self.rows = [{'id': 'doc1', 'key': 'foo', 'value': 1}]
+        self.db = MagicMock()
+        self.db.view.return_value.all.return_value = self.rows
+
+    def tearDown(self):
+        cache_core.MOCK_REDIS_CACHE = None
+
+    def test_miss_fills_and_releases_lock(self):
+        cache = FooCache()
+        self.assertEqual(cache.cached_view(self.db, 'foo/by_name', key='foo'), self.rows)
+        cache_view_key = cache._mk_view_cache_key('foo/by_name', {'key': 'foo'})
+        self.assertIsNone(cache_core.rcache().get(cache_view_key + FILL_LOCK_SUFFIX))
+        self.assertEqual(cache.cached_view(self.db, 'foo/by_name', key='foo'), self.rows)
+        self.assertEqual(self.db.view.call_count, 1)
+
+    def test_hit_takes_no_fill(self):
+        cache = FooCache()
+        cache.cached_view(self.db, 'foo/by_name', key='foo')
+        with patch('dimagi.utils.couch.cache.cache_core.stampede.ViewFill') as view_fill:
+            self.assertEqual(cache.cached_view(self.db, 'foo/by_name', key='foo'), self.rows)
+        self.assertFalse(view_fill.called)
+
+    def test_waiter_uses_filled_key(self):
+        cache = FooCache()
+        cache_view_key = cache._mk_view_cache_key('foo/by_name', {'key': 'foo'})
+        # another worker is running the view
+        self.assertTrue(ViewFill(cache_view_key).acquire())
+
+        def other_worker_fills(seconds):
+            cache_core.rcache().set(cache_view_key, cache_core.codec.encode(self.rows))
+
+        with patch('dimagi.utils.couch.cache.cache_core.stampede.time.sleep', other_worker_fills):
+            self.assertEqual(cache.cached_view(self.db, 'foo/by_name', key='foo'), self.rows)
+        self.assertEqual(self.db.view.call_count, 0)
+
+    @patch('dimagi.utils.couch.cache.cache_core.stampede.STAMPEDE_WAIT', 0)
+    def test_waiter_gives_up(self):
+        cache = FooCache()
+        cache_view_key = cache._mk_view_cache_key('foo/by_name', {'key': 'foo'})
+        ViewFill(cache_view_key).acquire()
+        self.assertEqual(cache.cached_view(self.db, 'foo/by_name', key='foo'), self.rows)
+        self.assertEqual(self.db.view.call_count, 1)
+
+    def test_waiter_stops_when_holder_gives_up(self):
+        cache = FooCache()
+        cache_view_key = cache._mk_view_cache_key('foo/by_name', {'key': 'foo'})
+        fill = ViewFill(cache_view_key)
+        fill.acquire()
+        sleeps = []
+
+        def holder_fails(seconds):
+            sleeps.append(seconds)
+            fill.release()
+
+        with patch('dimagi.utils.couch.cache.cache_core.stampede.time.sleep', holder_fails):
+            self.assertEqual(cache.cached_view(self.db, 'foo/by_name', key='foo'), self.rows)
+        self.assertEqual(len(sleeps), 1)
+        self.assertEqual(self.db.view.call_count, 1)
+
+    def test_release_keeps_next_holders_lock(self):
+        fill = ViewFill('some-view-key')
+        fill.acquire()
+        cache_core.rcache().delete(fill.lock_key)
+        # the lock timed out and someone else took it
+        other = ViewFill('some-view-key')
+        other.acquire()
+        fill.release()
+        self.assertEqual(cache_core.rcache().get(fill.lock_key), other.token)
+
+    def test_release_compares_and_deletes_in_redis(self):
+        redis_cache = LocMemCache('stampede-redis-test', {})
+        redis_cache.client = MagicMock()
+        fill = ViewFill('some-view-key')
+        with patch('dimagi.utils.couch.cache.cache_core.stampede.rcache', return_value=redis_cache):
+            fill.release()
+        script = redis_cache.client.get_client.return_value.register_script.return_value
+        script.assert_called_once_with(keys=[redis_cache.make_key(fill.lock_key)],
+                                       args=[redis_cache.client.encode.return_value])
+        redis_cache.client.encode.assert_called_once_with(fill.token)
+
+    @patch('dimagi.utils.couch.cache.cache_core.stampede.EARLY_RECOMPUTE_BETA', 1.0)
+    def test_should_recompute_early(self):
+        self.assertFalse(should_recompute_early(None))
+        self.assertFalse(should_recompute_early({'delta': 0.1, 'expires': 1000000}, now=1))
+        self.assertTrue(should_recompute_early({'delta': 0.1, 'expires': 1000000}, now=1000001))
+
+
+class ViewCacheKeyTest(SimpleTestCase):
+
+    def test_param_order_does_not_matter(self):
+        a = OrderedDict([('startkey', ['a', 1]), ('endkey', ['a', 2, {}]), ('reduce', False)])
+        b = OrderedDict([('reduce', False), ('endkey', ['a', 2, {}]), ('startkey', ['a', 1])])
+        self.assertEqual(canonical_param_string(a), canonical_param_string(b))
+
+    def test_values_are_distinguished(self):
+        self.assertNotEqual(canonical_param_string({'key': 1}), canonical_param_string({'key': '1'}))
+
+    def test_long_params_are_hashed(self):
+        param_string = canonical_param_string({'keys': ['doc-%s' % i for i in range(100)]})
+        self.assertTrue(param_string.startswith('#'))
+        self.assertLessEqual(len(param_string), VIEW_KEY_HASH_MIN_LEN)
+
+    def test_key_format(self):
+        with patch.object(FooCache, '_get_generation', return_value='3'):
+            key = FooCache()._mk_view_cache_key('foo/by_name', {'key': 'foo'})
+        self.assertEqual(key, '3:#cached_view_:v2:foo/by_name:%7B%22key%22%3A%22foo%22%7D')
+
+
+class BigViewCache(GenerationCache):
+    generation_key = '#gen_big_views'
+    doc_types = []
+    views = ['big/rows', 'big/huge']
+    max_payload_size = 1000
+    view_policies = {
+        'big/rows': {'chunk_size': 100, 'cache_expire': 600},
+    }
+
+
+@patch('dimagi.utils.couch.cache.cache_core.gen.CACHE_VIEWS', True)
+class ViewCachePolicyTest(SimpleTestCase):
+
+    def setUp(self):
+        cache_core.MOCK_REDIS_CACHE = LocMemCache('view-policy-test', {})
+        cache_core.MOCK_REDIS_CACHE.clear()
+        self.cache = BigViewCache()
+
+    def tearDown(self):
+        cache_core.MOCK_REDIS_CACHE = None
+
+    def _db(self, n_rows):
+        db = MagicMock()
+        db.view.return_value.all.return_value = [{'key': 'k%s' % i, 'value': i} for i in range(n_rows)]
+        return db
+
+    def test_policy_overrides(self):
+        policy = self.cache.view_policy('big/rows')
+        self.assertEqual((policy.cache_expire, policy.max_payload_size, policy.chunk_size), (600, 1000, 100))
+        self.assertEqual(policy.expire(60), 600)
+        self.assertEqual(self.cache.view_policy('big/huge').expire(60), 60)
+
+    def test_chunked_payload_round_trip(self):
+        db = self._db(10)
+        first = self.cache.cached_view(db, 'big/rows', reduce=False)
+        key = self.cache._mk_view_cache_key('big/rows', {'reduce': False})
+        self.assertIsNotNone(cache_core.rcache().get(chunk_key(key, 1)))
+
+        self.assertEqual(self.cache.cached_view(db, 'big/rows', reduce=False), first)
+        self.assertEqual(db.view.call_count, 1)
+
+        cache_core.rcache().delete(chunk_key(key, 1))
+        self.assertEqual(self.cache.cached_view(db, 'big/rows', reduce=False), first)
+        self.assertEqual(db.view.call_count, 2)
+
+    def test_oversized_payload_is_not_cached(self):
+        db = self._db(100)
+        self.cache.cached_view(db, 'big/huge', reduce=False)
+        key = self.cache._mk_view_cache_key('big/huge', {'reduce': False})
+        self.assertIsNone(cache_core.rcache().get(key))
+
+
+@patch('dimagi.utils.couch.cache.cache_core.ttl.ADAPTIVE_TTL_MIN', 60)
+@patch('dimagi.utils.couch.cache.cache_core.ttl.ADAPTIVE_TTL_MAX', 100000)
+@patch('dimagi.utils.couch.cache.cache_core.ttl.ADAPTIVE_TTL_FACTOR', 2)
+class AdaptiveTTLTest(SimpleTestCase):
+
+    def setUp(self):
+        cache_core.MOCK_REDIS_CACHE = LocMemCache('adaptive-ttl-test', {})
+        cache_core.MOCK_REDIS_CACHE.clear()
+        ttl.reset()
+
+    def tearDown(self):
+        cache_core.MOCK_REDIS_CACHE = None
+        ttl.reset()
+
+    def test_tracker(self):
+        tracker = InvalidationTracker()
+        self.assertEqual(tracker.ttl(3600, now=10), 3600)
+        # no matter how long it has gone unchanged
+        self.assertEqual(tracker.ttl(3600, now=90000), 3600)
+        for now in (100, 110, 120, 130):
+            tracker.observe_bump(now=now)
+        self.assertEqual(tracker.ttl(3600, now=131), 60)
+        self.assertEqual(tracker.ttl(3600, now=1130), 2000)
+
+    @patch('dimagi.utils.couch.cache.cache_core.gen.ADAPTIVE_TTL', True)
+    def test_bumps_shorten_view_ttl(self):
+        cache = FooCache()
+        cache._get_generation()
+        self.assertEqual(cache.view_cache_expire('foo/by_name', COUCH_CACHE_TIMEOUT), COUCH_CACHE_TIMEOUT)
+        cache.invalidate_all()
+        cache.invalidate_all()
+        self.assertEqual(cache.view_cache_expire('foo/by_name', COUCH_CACHE_TIMEOUT), 60)
+        self.assertEqual(ttl.adaptive_ttls(COUCH_CACHE_TIMEOUT)[FooCache.generation_key]['bumps'], 2)
+        # an explicit cache_expire is kept
+        self.assertEqual(cache.view_cache_expire('foo/by_name', 3600), 3600)
@@ -0,0 +1,78 @@
+import datetime
+import os
+import tempfile
+import simplejson
+from django.test import SimpleTestCase
+from mock import patch, MagicMock
+
+from dimagi.utils.couch.cache.cache_core import warming, COUCH_CACHE_TIMEOUT
+
+
+class ViewConfigTest(SimpleTestCase):
+
+    def test_load_view_config(self):
+        fd, path = tempfile.mkstemp(suffix='.json')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as f:
+            simplejson.dump([
+                {'db': None, 'view': 'foo/by_name', 'params': [{'key': 'a'}, {'key': 'b'}]},
+                {'db': 'bar', 'view': 'bar/all', 'cache_expire': 60},
+            ], f)
+        self.assertEqual(warming.load_view_config(path), [
+            {'db': None, 'view': 'foo/by_name', 'params': {'key': 'a'}, 'cache_expire': COUCH_CACHE_TIMEOUT},
+            {'db': None, 'view': 'foo/by_name', 'params': {'key': 'b'}, 'cache_expire': COUCH_CACHE_TIMEOUT},
+            {'db': 'bar', 'view': 'bar/all', 'params': {}, 'cache_expire': 60},
+        ])
+
+
+class ViewWarmerTest(SimpleTestCase):
+
+    @patch('dimagi.utils.couch.cache.cache_core.api.cached_view')
+    def test_warm(self, cached_view):
+        cached_view.side_effect = [None, ValueError('boom')]
+        warmer = warming.ViewWarmer(concurrency=1)
+        db = MagicMock()
+        warmer.get_db = lambda db_name: db
+        results = warmer.warm([
+            {'db': None, 'view': 'foo/by_name', 'params': {u'key': 'a'}, 'cache_expire': 60},
+            {'db': None, 'view': 'foo/by_name', 'params': {u'key': 'b'}, 'cache_expire': 60},
+        ])
+        self.assertEqual([error for _, _, error in results][0], None)
+        self.assertIsInstance(results[1][2], ValueError)
+        cached_view.assert_any_call(db, 'foo/by_name', cache_expire=60, key='a')
+
+    def test_rate_limiter_spaces_calls(self):
+        limiter = warming.RateLimiter(rate=10)
+        with patch('dimagi.utils.couch.cache.cache_core.warming.time') as mock_time:
+            mock_time.time.return_value = 1000.0
+            limiter.wait()
+            limiter.wait()
+            limiter.wait()
+        sleeps = [c[0][0] for c in mock_time.sleep.call_args_list]
+        self.assertEqual(len(sleeps), 2)
+        self.assertAlmostEqual(sleeps[0], 0.1)
+        self.assertAlmostEqual(sleeps[1], 0.2)
+
+
+@patch('dimagi.utils.couch.cache.cache_core.warming.RECORD_VIEWS', 1)
+class RecordViewRequestTest(SimpleTestCase):
+
+    @patch('dimagi.utils.couch.cache.cache_core.warming._redis_client')
+    def test_unserializable_params_are_not_recorded(self, redis_client):
+        db = MagicMock(dbname='db')
+        warming.record_view_request(db, 'app/by_date', {'key': datetime.datetime(2014, 1, 1)})
+        warming.record_view_request(object(), 'app/by_date', {'key': 'a'})
+        self.assertFalse(redis_client.called)
+
+    @patch('dimagi.utils.couch.cache.cache_core.warming._redis_client')
+    def test_warming_is_not_recorded(self, redis_client):
+        db = MagicMock(dbname='db')
+        warmer = warming.ViewWarmer(concurrency=1)
+        warmer.get_db = lambda db_name: db
+        with patch('dimagi.utils.couch.cache.cache_core.api.cached_view',
+                   side_effect=lambda db, view_name, cache_expire, **params:
+                   warming.record_view_request(db, view_name, params, cache_expire)):
+            warmer.warm([{'db': None, 'view': 'foo/by_name', 'params': {'key': 'a'}}])
+        self.assertFalse(redis_client.called)
+        warming.record_view_request(db, 'foo/by_name', {'key': 'a'})
+        self.assertTrue(redis_client.called)
@@ -0,0 +1,82 @@
+import time
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import SimpleTestCase
+from mock import patch
+
+from dimagi.utils.couch.cache import cache_core
+from dimagi.utils.couch.cache.cache_core import writebehind
+from dimagi.utils.couch.cache.cache_core.api import do_cache_doc, do_cache_docs, do_cache_not_found, invalidate_doc
+from dimagi.utils.couch.cache.cache_core.writebehind import WriteBehindQueue
+
+
+@patch('dimagi.utils.couch.cache.cache_core.api.CACHE_DOCS', True)
+class WriteBehindTest(SimpleTestCase):
+
+    def setUp(self):
+        cache_core.MOCK_REDIS_CACHE = LocMemCache('write-behind-test', {})
+        cache_core.MOCK_REDIS_CACHE.clear()
+        self.queue = writebehind.WRITE_BEHIND_QUEUE = WriteBehindQueue(max_pending=3, batch_size=2)
+        # no background thread, the tests flush by hand
+        self.queue._thread = object()
+
+    def tearDown(self):
+        cache_core.MOCK_REDIS_CACHE = None
+        writebehind.WRITE_BEHIND_QUEUE = None
+
+    def test_fills_are_written_in_batches(self):
+        do_cache_docs([{'_id': 'doc%s' % i, 'doc_type': 'Foo'} for i in range(3)])
+        self.assertIsNone(cache_core.rcache().get(cache_core.key_doc_id('doc0')))
+        with patch.object(cache_core.rcache(), 'set_many', wraps=cache_core.rcache().set_many) as set_many:
+            self.queue.flush()
+        self.assertEqual(set_many.call_count, 2)
+        self.assertIsNotNone(cache_core.rcache().get(cache_core.key_doc_id('doc2')))
+        self.assertEqual(self.queue.stats()['written'], 3)
+
+    def test_overflow_is_dropped(self):
+        do_cache_docs([{'_id': 'doc%s' % i, 'doc_type': 'Foo'} for i in range(5)])
+        self.assertEqual(len(self.queue), 3)
+        self.assertEqual(self.queue.stats()['dropped'], 2)
+
+    def test_drops_are_logged(self):
+        with patch.object(writebehind.log, 'warning') as warning:
+            do_cache_docs([{'_id': 'doc%s' % i, 'doc_type': 'Foo'} for i in range(5)])
+        # only the first drop, then every thousandth
+        self.assertEqual(warning.call_count, 1)
+
+    @patch('dimagi.utils.couch.cache.cache_core.api.MISSING_DOC_TIMEOUT', 60)
+    def test_queued_fill_clears_not_found(self):
+        do_cache_not_found('abc')
+        do_cache_not_found('def')
+        do_cache_doc({'_id': 'abc', 'doc_type': 'Foo'})
+        self.assertIsNone(cache_core.rcache().get(cache_core.key_doc_id('abc')))
+        # even when the queue is full and the fill is dropped
+        do_cache_docs([{'_id': 'doc%s' % i, 'doc_type': 'Foo'} for i in range(2)] + [{'_id': 'def', 'doc_type': 'Foo'}])
+        self.assertEqual(self.queue.stats()['dropped'], 1)
+        self.assertIsNone(cache_core.rcache().get(cache_core.key_doc_id('def')))
+
+    def test_forked_child_starts_over(self):
+        do_cache_doc({'_id': 'abc', 'doc_type': 'Foo'})
+        with patch('dimagi.utils.couch.cache.cache_core.writebehind.os.getpid', return_value=-1), \
+                patch.object(self.queue, '_ensure_thread') as ensure_thread:
+            do_cache_doc({'_id': 'def', 'doc_type': 'Foo'})
+        ensure_thread.assert_called_once_with()
+        self.assertIsNone(self.queue._thread)
+        # the parent's pending write is the parent's to make
+        self.assertEqual(list(self.queue._pending), [cache_core.key_doc_id('def')])
+
+    def test_invalidate_discards_pending_write(self):
+        doc = {'_id': 'abc', 'doc_type': 'Foo'}
+        do_cache_doc(doc)
+        invalidate_doc(doc, deleted=True)
+        self.queue.flush()
+        self.assertIsNone(cache_core.rcache().get(cache_core.key_doc_id('abc')))
+
+    def test_background_thread_writes(self):
+        self.queue._thread = None
+        self.addCleanup(self.queue.stop)
+        do_cache_doc({'_id': 'abc', 'doc_type': 'Foo'})
+        for _ in range(100):
+            if self.queue.stats()['written']:
+                break
+            time.sleep(0.01)
+        self.assertIsNotNone(cache_core.rcache().get(cache_core.key_doc_id('abc')))
@@ -0,0 +1,152 @@
+import shutil
+import tempfile
+import threading
+import time
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+from mock import patch, MagicMock
+from redis.exceptions import LockError
+
+from dimagi.utils.couch import CriticalSection
+from dimagi.utils.load_balance import load_balance
+from dimagi.utils.locks.backends import (FileLockBackend, MemoryLockBackend, RedisLockBackend,
+                                         get_lock_backend, gcra, RateLimitResult, GCRA, GCRA_SCRIPT)
+from dimagi.utils.rate_limit import rate_limit, check_rate_limit, DomainRateLimiter
+
+
+@override_settings(LOCK_BACKEND='dimagi.utils.locks.backends.MemoryLockBackend')
+class MemoryLockBackendTest(SimpleTestCase):
+
+    def test_configured_backend(self):
+        self.assertIsInstance(get_lock_backend(), MemoryLockBackend)
+        self.assertIs(get_lock_backend(), get_lock_backend())
+
+    def test_lock_excludes_and_expires(self):
+        backend = MemoryLockBackend()
+        lock = backend.lock('a', 0.05)
+        self.assertTrue(lock.acquire(blocking=False))
+        self.assertFalse(backend.multi_lock(['b', 'a'], 1).acquire(blocking=False))
+        self.assertTrue(backend.lock('b', 1).acquire(blocking=False))
+        other = backend.lock('a', 1)
+        self.assertTrue(other.acquire(blocking_timeout=1))
+        with self.assertRaises(LockError):
+            lock.release()
+        other.release()
+
+    def test_release_wakes_waiter(self):
+        backend = MemoryLockBackend()
+        lock = backend.lock('a', 60)
+        lock.acquire()
+        acquired = []
+        waiter = threading.Thread(target=lambda: acquired.append(backend.lock('a', 60).acquire(blocking_timeout=5)))
+        waiter.start()
+        lock.release()
+        waiter.join()
+        self.assertEqual(acquired, [True])
+
+    def test_rate_limit(self):
+        self.assertEqual([rate_limit('rate-limit-test', actions_allowed=2, how_often=60) for _ in range(3)],
+                         [True, True, False])
+        limiter = DomainRateLimiter('rate-limit-domain-', 1, 60)
+        self.assertTrue(limiter.can_perform_action('d1'))
+        self.assertFalse(limiter.can_perform_action('d1'))
+        self.assertTrue(limiter.can_perform_action('d2'))
+        self.assertAlmostEqual(get_lock_backend().ttl('rate-limit-domain-d1'), 60, delta=1)
+
+    def test_gcra(self):
+        with patch('dimagi.utils.locks.backends.time') as mock_time:
+            mock_time.time.return_value = 1000
+            results = [check_rate_limit('gcra-test', 3, 3, mode=GCRA) for _ in range(4)]
+            self.assertEqual([result.allowed for result in results], [True, True, True, False])
+            self.assertEqual([result.remaining for result in results], [2, 1, 0, 0])
+            self.assertAlmostEqual(results[-1].retry_after, 1)
+            # one action per second comes back, not the whole window
+            mock_time.time.return_value = 1001
+            self.assertEqual(check_rate_limit('gcra-test', 3, 3, mode=GCRA), RateLimitResult(True, 0, 0))
+            self.assertFalse(rate_limit('gcra-test', 3, 3, mode=GCRA))
+
+    def test_load_balance(self):
+        self.assertEqual([load_balance('load-balance-test', ['a', 'b']) for _ in range(3)], ['a', 'b', 'a'])
+
+    def test_critical_section(self):
+        with CriticalSection(['a', 'b'], fail_hard=True):
+            self.assertFalse(get_lock_backend().lock('b', 1).acquire(blocking=False))
+        lock = get_lock_backend().lock('b', 1)
+        self.assertTrue(lock.acquire(blocking=False))
+        lock.release()
+
+
+class FileLockBackendTest(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.backend = FileLockBackend(self.directory)
+
+    def test_lock_excludes(self):
+        lock = self.backend.multi_lock(['a', 'b'], 60)
+        self.assertTrue(lock.acquire(blocking=False))
+        start = time.time()
+        self.assertFalse(self.backend.lock('b', 60).acquire(blocking_timeout=0.05))
+        self.assertGreaterEqual(time.time() - start, 0.05)
+        # nothing stays locked after a failed attempt
+        self.assertTrue(self.backend.lock('c', 60).acquire(blocking=False))
+        lock.release()
+        self.assertTrue(self.backend.lock('b', 60).acquire(blocking=False))
+
+    def test_counters(self):
+        self.assertEqual(self.backend.ttl('counter'), -2)
+        self.assertEqual([self.backend.incr('counter', timeout=60) for _ in range(3)], [1, 2, 3])
+        self.assertAlmostEqual(self.backend.ttl('counter'), 60, delta=1)
+        self.backend.delete('counter')
+        self.assertEqual(self.backend.incr('counter'), 1)
+        self.assertEqual(self.backend.ttl('counter'), -1)
+
+
+class GCRATest(SimpleTestCase):
+
+    def test_burst_then_steady_rate(self):
+        tat = None
+        for remaining in (1, 0):
+            result, tat = gcra(tat, 0, 2, 10)
+            self.assertEqual(result, RateLimitResult(True, remaining, 0))
+        result, new_tat = gcra(tat, 2, 2, 10)
+        self.assertEqual(result, RateLimitResult(False, 0, 3))
+        self.assertIsNone(new_tat)
+        result, tat = gcra(tat, 5, 2, 10)
+        self.assertTrue(result.allowed)
+        self.assertEqual(tat, 15)
+
+
+class RedisRateLimitTest(SimpleTestCase):
+
+    def setUp(self):
+        self.client = MagicMock()
+        patcher = patch.object(RedisLockBackend, '_client', return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.script = self.client.register_script.return_value
+
+    def test_one_script_call(self):
+        self.script.return_value = [0, 0, 1500]
+        result = RedisLockBackend().rate_limit('key', 10, 3)
+        self.assertEqual(result, RateLimitResult(False, 0, 1.5))
+        self.script.assert_called_once_with(keys=['key'], args=[10, 3000])
+        self.assertFalse(self.client.incr.called)
+
+    def test_gcra_uses_server_clock(self):
+        self.script.return_value = [1, 4, 0]
+        backend = RedisLockBackend()
+        for _ in range(2):
+            self.assertEqual(backend.rate_limit('key', 10, 3, mode=GCRA), RateLimitResult(True, 4, 0))
+        self.script.assert_called_with(keys=['key'], args=[10, 3000])
+        self.client.register_script.assert_called_once_with(GCRA_SCRIPT)
+
+    def test_domain_rate_limiter_cooldown(self):
+        self.script.return_value = [0, 0, 60000]
+        limiter = DomainRateLimiter('rate-limit-domain-', 10, 60)
+        with patch('dimagi.utils.rate_limit.get_lock_backend', return_value=RedisLockBackend()):
+            self.assertFalse(limiter.can_perform_action('d1'))
+            self.assertFalse(limiter.can_perform_action('d1'))
+        self.assertEqual(self.script.call_count, 1)
+        self.assertFalse(self.client.ttl.called)
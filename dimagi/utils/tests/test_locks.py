@@ -0,0 +1,411 @@
+import threading
+import time
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import SimpleTestCase
+from mock import patch, MagicMock
+from redis.exceptions import LockError, ConnectionError
+
+from dimagi.utils.couch import CriticalSection, RedisLockableMixIn, acquire_lock, release_lock
+from dimagi.utils.locks import MultiLock, try_acquire_locks, release_locks
+from dimagi.utils.locks.multi import RELEASE_SCRIPT
+from dimagi.utils.locks.local import LocalLockRegistry
+from dimagi.utils.locks.metrics import lock_key_prefix
+from dimagi.utils.metrics import InMemoryMetricsSink, metric_key
+from dimagi.utils.locks.watchdog import LockWatchdog, WATCHDOG
+
+
+def _mock_redis_cache():
+    cache = LocMemCache('locks-test', {})
+    cache.client = MagicMock()
+    return cache
+
+
+class MultiLockTest(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = _mock_redis_cache()
+
+    def test_keys_are_sorted(self):
+        lock = MultiLock(self.cache, ['b', 'a', 'c', 'a'])
+        self.assertEqual(lock.keys, ['a', 'b', 'c'])
+        self.assertEqual(lock.redis_keys, [self.cache.make_key(key) for key in ['a', 'b', 'c']])
+
+    @patch('dimagi.utils.locks.multi.time')
+    def test_blocking_timeout(self, mock_time):
+        mock_time.time.side_effect = [0, 0.5, 1.5]
+        lock = MultiLock(self.cache, ['a', 'b'])
+        lock._attempt = MagicMock(return_value=False)
+        self.assertFalse(lock.acquire(blocking_timeout=1))
+        self.assertEqual(lock._attempt.call_count, 2)
+        for call in mock_time.sleep.call_args_list:
+            self.assertLessEqual(call[0][0], 0.5)
+
+    def test_backoff_grows_with_jitter(self):
+        lock = MultiLock(self.cache, ['a'], sleep=0.1, max_sleep=1)
+        self.assertTrue(0.05 <= lock.backoff(0) <= 0.1)
+        self.assertTrue(0.5 <= lock.backoff(10) <= 1)
+
+    def test_release_in_one_call(self):
+        lock = MultiLock(self.cache, ['a', 'b'])
+        lock.token = 'token'
+        release = MagicMock(return_value=1)
+        lock._script = lambda script: release
+        with self.assertRaises(LockError):
+            lock.release()
+        release.assert_called_once_with(keys=lock.redis_keys, args=['token'])
+
+    def test_scripts_registered_once(self):
+        lock = MultiLock(self.cache, ['a'])
+        client = self.cache.client.get_client.return_value
+        client.register_script.return_value.return_value = 0
+        lock.acquire(blocking=False)
+        lock.acquire(blocking=False)
+        self.assertEqual(client.register_script.call_count, 1)
+
+
+@patch.object(LockWatchdog, '_ensure_thread')
+class LockWatchdogTest(SimpleTestCase):
+
+    def setUp(self):
+        self.watchdog = LockWatchdog()
+        self.lock = MultiLock(_mock_redis_cache(), ['a', 'b'], timeout=30)
+        self.lock.extend = MagicMock(return_value=True)
+
+    def test_renews_when_due(self, _):
+        lease = self.watchdog.keep_alive(self.lock, 30)
+        self.assertEqual(lease.interval, 10)
+        self.watchdog.renew_due(now=lease.next_renewal - 1)
+        self.assertFalse(self.lock.extend.called)
+        self.watchdog.renew_due(now=lease.next_renewal)
+        self.lock.extend.assert_called_once_with(30)
+        self.assertEqual(lease.renewals, 1)
+
+    def test_lost_lock(self, _):
+        on_lost = MagicMock()
+        lease = self.watchdog.keep_alive(self.lock, 30, on_lost=on_lost)
+        self.lock.extend.return_value = False
+        self.watchdog.renew_due(now=lease.next_renewal)
+        on_lost.assert_called_once_with(self.lock, None)
+        self.assertTrue(lease.lost)
+        self.assertIsNone(self.watchdog.forget(self.lock))
+
+    def test_redis_error_loses_lock(self, _):
+        on_lost = MagicMock()
+        lease = self.watchdog.keep_alive(self.lock, 30, on_lost=on_lost)
+        error = ConnectionError()
+        self.lock.extend.side_effect = error
+        self.watchdog.renew_due(now=lease.next_renewal)
+        on_lost.assert_called_once_with(self.lock, error)
+
+    def test_released_while_renewing(self, _):
+        on_lost = MagicMock()
+        lease = self.watchdog.keep_alive(self.lock, 30, on_lost=on_lost)
+
+        def release_first(ttl):
+            self.watchdog.forget(self.lock)
+            return False
+        self.lock.extend.side_effect = release_first
+        self.watchdog.renew_due(now=lease.next_renewal)
+        self.assertFalse(on_lost.called)
+        self.assertFalse(lease.lost)
+
+    def test_forked_child_drops_parent_leases(self, _):
+        self.watchdog.keep_alive(self.lock, 30)
+        self.watchdog._thread = MagicMock()
+        other = MultiLock(_mock_redis_cache(), ['c'], timeout=30)
+        with patch('dimagi.utils.locks.watchdog.os.getpid', return_value=-1):
+            self.watchdog.keep_alive(other, 30)
+        self.assertEqual(list(self.watchdog._leases), [id(other)])
+        # the parent's renewal thread didn't come along
+        self.assertIsNone(self.watchdog._thread)
+
+    def test_redis_py_lock_token_is_kept(self, _):
+        lock = MagicMock(spec=['redis', 'name', 'local'])
+        lock.name = 'lock-key'
+        lock.local.token = 'token'
+        script = lock.redis.register_script.return_value
+        script.return_value = 1
+        lease = self.watchdog.keep_alive(lock, 6)
+        lock.local.token = None
+        self.watchdog.renew_due(now=lease.next_renewal)
+        script.assert_called_once_with(keys=['lock-key'], args=['token', 6000])
+
+    def test_release_lock_stops_renewals(self, _):
+        WATCHDOG.keep_alive(self.lock, 30)
+        self.lock.release = MagicMock()
+        release_lock(self.lock, True)
+        self.assertIsNone(WATCHDOG.forget(self.lock))
+
+
+class LocalLockRegistryTest(SimpleTestCase):
+
+    def setUp(self):
+        self.registry = LocalLockRegistry()
+
+    def test_reentrant(self):
+        self.assertEqual(self.registry.acquire(['b', 'a']), ['a', 'b'])
+        self.assertEqual(self.registry.acquire(['a', 'c']), ['c'])
+        self.assertEqual(self.registry.stats['reentrant'], 1)
+        self.assertEqual(self.registry.stats['redis_acquires'], 3)
+        self.registry.release(['a', 'c'])
+        self.assertEqual(self.registry.held_keys(), ['a', 'b'])
+        self.registry.release(['b', 'a'])
+        self.assertEqual(self.registry.held_keys(), [])
+        self.assertEqual(self.registry._locks, {})
+
+    def test_other_threads_wait_locally(self):
+        self.registry.acquire(['a'])
+        results = []
+
+        def contend(timeout):
+            results.append(self.registry.acquire(['a', 'b'], timeout=timeout))
+
+        thread = threading.Thread(target=contend, args=(0.01,))
+        thread.start()
+        thread.join()
+        self.assertEqual(results, [None])
+        # a thread that timed out holds nothing
+        self.assertEqual(sorted(self.registry._locks), ['a'])
+
+        thread = threading.Thread(target=contend, args=(None,))
+        thread.start()
+        while self.registry.stats['local_waits'] < 2:
+            time.sleep(0.001)
+        self.registry.release(['a'])
+        thread.join()
+        self.assertEqual(results, [None, ['a', 'b']])
+        self.assertEqual(self.registry.stats['local_waits'], 2)
+
+    def test_duplicate_keys(self):
+        self.assertEqual(self.registry.acquire(['a', 'a']), ['a'])
+        self.registry.release(['a', 'a'])
+        self.assertEqual(self.registry._locks, {})
+
+    def test_forked_child_starts_over(self):
+        holding = threading.Event()
+        done = threading.Event()
+
+        def hold():
+            self.registry.acquire(['a'])
+            holding.set()
+            done.wait()
+        thread = threading.Thread(target=hold)
+        thread.start()
+        holding.wait()
+        self.addCleanup(done.set)
+        with patch('dimagi.utils.locks.local.os.getpid', return_value=-1):
+            # the holding thread doesn't exist in the child
+            self.assertEqual(self.registry.acquire(['a'], timeout=0), ['a'])
+            self.registry.release(['a'])
+            self.assertEqual(self.registry._locks, {})
+
+    def test_expired_lease_is_taken(self):
+        self.registry.acquire(['a'], lease=0.01)
+        self.registry.acquire(['a'])
+        results = []
+        thread = threading.Thread(target=lambda: results.append(self.registry.acquire(['a'])))
+        thread.start()
+        thread.join()
+        self.assertEqual(results, [['a']])
+        self.assertEqual(self.registry.stats['local_steals'], 1)
+        # the holder's releases only give up its own holds
+        self.registry.release(['a'])
+        self.registry.release(['a'])
+        self.assertEqual(sorted(self.registry._locks), ['a'])
+        self.assertEqual(self.registry._locks['a'].depth, 1)
+
+
+class LockMetricsTest(SimpleTestCase):
+
+    def setUp(self):
+        self.sink = InMemoryMetricsSink()
+        patcher = patch('dimagi.utils.locks.metrics.METRICS_SINK', self.sink)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lock_key_prefix(self):
+        self.assertEqual(lock_key_prefix('redis-object-lock-Thing-fa98e2c1'), 'redis-object-lock-Thing')
+        self.assertEqual(lock_key_prefix('redis-class-lock-Thing'), 'redis-class-lock-Thing')
+        self.assertEqual(lock_key_prefix('sms-queue:1234:x'), 'sms-queue')
+        self.assertEqual(lock_key_prefix('12-abc'), '*')
+
+    def test_contended_and_expired(self):
+        lock = MagicMock()
+        lock.name = 'redis-object-lock-Thing-1'
+        lock.acquire.side_effect = [False, True]
+        acquire_lock(lock, False)
+        lock.release.side_effect = LockError()
+        release_lock(lock, True)
+
+        snapshot = self.sink.snapshot()
+        tags = {'prefix': 'redis-object-lock-Thing'}
+        self.assertEqual(snapshot['counters'], {
+            metric_key('locks.acquired', tags): 1,
+            metric_key('locks.contended', tags): 1,
+            metric_key('locks.expired_before_release', tags): 1,
+        })
+        self.assertEqual(snapshot['timings'][metric_key('locks.wait', tags)]['count'], 1)
+        self.assertEqual(snapshot['timings'][metric_key('locks.hold', tags)]['count'], 1)
+
+    def test_made_key_name(self):
+        lock = MagicMock(spec=['name', 'acquire', 'release'])
+        lock.name = LocMemCache('locks-test', {}).make_key('redis-object-lock-Thing-1')
+        lock.acquire.return_value = True
+        acquire_lock(lock, False)
+        self.assertEqual(self.sink.snapshot()['counters'], {
+            metric_key('locks.acquired', {'prefix': 'redis-object-lock-Thing'}): 1,
+        })
+
+    def test_uncontended(self):
+        lock = MagicMock()
+        lock.name = 'redis-class-lock-Thing'
+        lock.acquire.return_value = True
+        acquire_lock(lock, False, blocking=True)
+        lock.acquire.assert_called_once_with(blocking=False)
+        self.assertNotIn(metric_key('locks.contended', {'prefix': 'redis-class-lock-Thing'}),
+                         self.sink.snapshot()['counters'])
+
+
+class CriticalSectionTest(SimpleTestCase):
+
+    def setUp(self):
+        patcher = patch('dimagi.utils.couch.get_lock_backend')
+        self.backend = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+
+    def test_fail_hard_on_timeout(self):
+        multi_lock = self.backend.multi_lock
+        multi_lock.return_value.acquire.return_value = False
+        with self.assertRaises(Exception):
+            with CriticalSection(['a', 'b'], fail_hard=True, blocking_timeout=1):
+                pass
+        kwargs = multi_lock.return_value.acquire.call_args[1]
+        self.assertTrue(kwargs['blocking'])
+        # less whatever was spent waiting for the keys in this process
+        self.assertAlmostEqual(kwargs['blocking_timeout'], 1, places=2)
+
+    def test_nested_section_skips_redis(self):
+        multi_lock = self.backend.multi_lock
+        with CriticalSection(['a', 'b']):
+            with CriticalSection(['a']):
+                pass
+            with CriticalSection(['b', 'c']):
+                pass
+        self.assertEqual([call[0][0] for call in multi_lock.call_args_list], [['a', 'b'], ['c']])
+        self.assertEqual(multi_lock.return_value.release.call_count, 2)
+
+    def test_duplicate_keys(self):
+        with CriticalSection(['a', 'a']):
+            pass
+        self.assertEqual(self.backend.multi_lock.call_args[0][0], ['a'])
+
+    @patch('dimagi.utils.couch.keep_alive')
+    def test_renew(self, keep_alive):
+        multi_lock = self.backend.multi_lock
+        on_lost = MagicMock()
+        with CriticalSection(['a'], timeout=10, renew=True, on_lock_lost=on_lost):
+            keep_alive.assert_called_once_with(multi_lock.return_value, 10, on_lost)
+
+
+class Thing(RedisLockableMixIn):
+    lock_by_lookup_args = True
+    objs = {}
+
+    @classmethod
+    def get_obj_id(cls, obj):
+        return obj
+
+    @classmethod
+    def get_obj(cls, name, domain=None):
+        return cls.objs.get((name, domain))
+
+    @classmethod
+    def get_obj_by_id(cls, _id):
+        return _id
+
+    @classmethod
+    def create_obj(cls, name, domain=None):
+        cls.objs[(name, domain)] = name
+        return name
+
+
+@patch.object(Thing, 'get_redis_lock')
+class LookupLockTest(SimpleTestCase):
+
+    def _locked_keys(self, get_redis_lock):
+        return [call[0][0] for call in get_redis_lock.call_args_list]
+
+    def test_lookup_args_pick_the_lock(self, get_redis_lock):
+        Thing.get_locked_obj('a', domain='x', create=True)
+        Thing.get_locked_obj('a', domain='y', create=True)
+        Thing.get_locked_obj('a', domain='x')
+        lookup_keys = [key for key in self._locked_keys(get_redis_lock) if key.startswith('redis-lookup-lock-')]
+        self.assertEqual(len(lookup_keys), 3)
+        self.assertNotEqual(lookup_keys[0], lookup_keys[1])
+        self.assertEqual(lookup_keys[0], lookup_keys[2])
+        self.assertNotIn(Thing._redis_class_lock_key(), self._locked_keys(get_redis_lock))
+
+    def test_class_lock_by_default(self, get_redis_lock):
+        with patch.object(Thing, 'lock_by_lookup_args', False):
+            Thing.get_locked_obj('b', create=True)
+        self.assertEqual(self._locked_keys(get_redis_lock)[0], Thing._redis_class_lock_key())
+
+
+class BatchLockTest(SimpleTestCase):
+
+    def setUp(self):
+        self.client = MagicMock()
+        self.held = set(['redis-object-lock-Thing-b'])
+
+        def set_(name, token, nx, px):
+            self.assertTrue(nx)
+            self.assertEqual(px, 30000)
+            if name in self.held:
+                return None
+            self.held.add(name)
+            return True
+
+        results = []
+        pipe = self.client.pipeline.return_value
+        pipe.set.side_effect = lambda name, token, nx, px: results.append(set_(name, token, nx, px))
+        pipe.execute.side_effect = lambda: [results.pop(0) for _ in list(results)]
+        self.release = self.client.register_script.return_value
+        self.release.side_effect = lambda keys, args: len(keys)
+
+    def _lock(self, key, timeout_seconds):
+        lock = MagicMock(spec=['redis', 'name', 'timeout', 'local'])
+        lock.redis = self.client
+        lock.name = key
+        lock.timeout = timeout_seconds
+        lock.local.token = None
+        return lock
+
+    def test_get_locked_objs(self):
+        with patch.object(Thing, 'get_redis_lock', side_effect=self._lock), \
+                patch.object(Thing, 'get_objs_by_ids', side_effect=lambda ids: [_id for _id in ids if _id != 'c']):
+            with Thing.get_locked_objs(['a', 'b', 'c', 'a', 'd'], timeout_seconds=30) as batch:
+                self.assertEqual(batch.objs, ['a', 'd'])
+                self.assertEqual(batch.not_locked, ['b'])
+                self.assertEqual(batch.missing, ['c'])
+                self.assertEqual(sorted(batch.locks), ['a', 'd'])
+                self.assertEqual(self.client.pipeline.call_count, 1)
+                # the lock of the missing object is released right away
+                self.assertEqual(self.release.call_args[1]['keys'], ['redis-object-lock-Thing-c'])
+        self.assertEqual(sorted(self.release.call_args[1]['keys']),
+                         ['redis-object-lock-Thing-a', 'redis-object-lock-Thing-d'])
+        self.assertEqual(batch.locks, {})
+
+    def test_release_reports_lost_locks(self):
+        locks = [self._lock('a', 30), self._lock('b', 30)]
+        self.assertEqual(try_acquire_locks(locks), locks)
+        self.release.side_effect = lambda keys, args: 1
+        with self.assertRaises(LockError):
+            release_locks(locks)
+        self.assertEqual([lock.local.token for lock in locks], [None, None])
+
+    def test_release_script_registered_once(self):
+        for key in ['a', 'c']:
+            locks = [self._lock(key, 30)]
+            try_acquire_locks(locks)
+            release_locks(locks)
+        self.client.register_script.assert_called_once_with(RELEASE_SCRIPT)
@@ -0,0 +1,96 @@
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase
+from mock import patch, MagicMock
+
+from dimagi.utils.couch.cache import cache_core
+from dimagi.utils.couch.cache.cache_core import metrics
+from dimagi.utils.couch.cache.cache_core.gen import GenerationCache
+from dimagi.utils.management.commands.cache_core_metrics import Command
+from dimagi.utils.metrics import InMemoryMetricsSink, StatsdMetricsSink, RedisMetricsSink, load_metrics_sink, \
+    metric_key
+
+
+class FooCache(GenerationCache):
+    generation_key = '#gen_foo_metrics'
+    doc_types = ['Foo']
+    views = ['foo/by_name']
+
+
+class MetricsSinkTest(SimpleTestCase):
+
+    def test_in_memory(self):
+        sink = InMemoryMetricsSink()
+        sink.incr('hits', tags={'view': 'a/b'})
+        sink.incr('hits', 2, tags={'view': 'a/b'})
+        sink.timing('latency', 0.5)
+        sink.timing('latency', 1.5)
+        self.assertEqual(sink.snapshot(), {
+            'counters': {'hits{view=a/b}': 3},
+            'timings': {'latency': {'count': 2, 'total': 2.0, 'max': 1.5}},
+        })
+        sink.reset()
+        self.assertEqual(sink.snapshot(), {'counters': {}, 'timings': {}})
+
+    def test_statsd_names(self):
+        sink = StatsdMetricsSink(prefix='hq')
+        with patch.object(sink, '_send') as send:
+            sink.incr('cache.hits', tags={'view': 'a/b', 'cache': 'Foo'})
+            sink.timing('cache.latency', 0.25)
+        send.assert_any_call('hq.cache.hits.Foo.a_b:1|c')
+        send.assert_any_call('hq.cache.latency:250|ms')
+
+    def test_redis_flush_keeps_deltas_on_error(self):
+        sink = RedisMetricsSink(flush_interval=3600)
+        client = MagicMock()
+        client.pipeline.return_value.execute.side_effect = [Exception(), None]
+        with patch.object(sink, '_client', return_value=client):
+            sink.incr('hits')
+            sink.timing('latency', 0.5)
+            sink.flush()
+            sink.incr('hits')
+            sink.flush()
+        pipeline = client.pipeline.return_value
+        pipeline.hincrbyfloat.assert_any_call('dimagi-metrics', 'c|hits', 2)
+        pipeline.hincrbyfloat.assert_any_call('dimagi-metrics', 'tc|latency', 1)
+        self.assertEqual(sink._counters, {})
+        self.assertEqual(sink._timings, {})
+
+    def test_dump_command_needs_redis_sink(self):
+        command = Command()
+        with patch.object(metrics, 'METRICS_SINK', InMemoryMetricsSink()):
+            with self.assertRaises(CommandError):
+                command.handle(reset=False)
+
+    def test_load(self):
+        self.assertIsInstance(load_metrics_sink(None), InMemoryMetricsSink)
+        sink = load_metrics_sink({'BACKEND': 'dimagi.utils.metrics.StatsdMetricsSink', 'OPTIONS': {'port': 9999}})
+        self.assertEqual(sink.address, ('localhost', 9999))
+
+
+@patch('dimagi.utils.couch.cache.cache_core.gen.CACHE_VIEWS', True)
+class CachedViewMetricsTest(SimpleTestCase):
+
+    def setUp(self):
+        cache_core.MOCK_REDIS_CACHE = LocMemCache('metrics-test', {})
+        cache_core.MOCK_REDIS_CACHE.clear()
+        self.sink = metrics.METRICS_SINK = InMemoryMetricsSink()
+
+    def tearDown(self):
+        cache_core.MOCK_REDIS_CACHE = None
+
+    def test_hits_and_misses(self):
+        db = MagicMock()
+        db.view.return_value.all.return_value = [{'key': 'foo', 'value': 1}]
+        FooCache().cached_view(db, 'foo/by_name', key='foo')
+        FooCache().cached_view(db, 'foo/by_name', key='foo')
+
+        tags = {'cache': 'FooCache', 'view': 'foo/by_name'}
+        snapshot = self.sink.snapshot()
+        self.assertEqual(snapshot['counters'][metric_key(metrics.VIEW_HITS, tags)], 1)
+        self.assertEqual(snapshot['counters'][metric_key(metrics.VIEW_MISSES, tags)], 1)
+        stored = snapshot['counters'][metric_key(metrics.VIEW_STORED_BYTES, tags)]
+        self.assertGreater(stored, 0)
+        self.assertEqual(snapshot['counters'][metric_key(metrics.VIEW_SERVED_BYTES, tags)], stored)
+        self.assertEqual(snapshot['timings'][metric_key(metrics.VIEW_COUCH_LATENCY, tags)]['count'], 1)
+        self.assertEqual(snapshot['timings'][metric_key(metrics.VIEW_REDIS_LATENCY, tags)]['count'], 2)